@@ -1,16 +1,14 @@
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from flask_assets import Environment
-from webassets.bundle import Bundle
 from config import config
-import markdown
-import bleach
+from .database import RoutingSession
 
-db = SQLAlchemy()
-assets = Environment()
+db = SQLAlchemy(session_options={'class_': RoutingSession})
 
-def create_app(config_name):
+def create_app(config_name=None):
+    # `flask --app run` and the like call the factory without arguments
+    config_name = config_name or os.getenv('FLASK_CONFIG') or 'default'
     flask_app = Flask(__name__, instance_relative_config=True)
     flask_app.config.from_object(config[config_name])
 
@@ -20,29 +18,13 @@ def create_app(config_name):
     except OSError:
         pass
 
+    from . import database
+    database.configure_read_bind(flask_app)
     db.init_app(flask_app)
-    assets.init_app(flask_app)
-
-    # Define asset bundles
-    js_bundle = Bundle(
-        'js/bootstrap.bundle.min.js',
-        'js/prism-core.min.js',
-        'js/prism-autoloader.min.js',
-        'js/quill.js',
-        'js/tagify.min.js',
-        'js/tagify.polyfills.min.js',
-        output='gen/packed.js')
-    assets.register('js_all', js_bundle)
-
-    css_bundle = Bundle(
-        'css/bootstrap.min.css',
-        'css/all.min.css',
-        'css/prism.min.css',
-        'css/tagify.css',
-        'css/quill.snow.css',
-        'css/custom.css', # Assuming you might have custom CSS
-        filters='cssrewrite', output='gen/packed.css')
-    assets.register('css_all', css_bundle)
+    database.init_app(flask_app)
+
+    from . import bundles
+    bundles.init_app(flask_app)
 
     from .main import main as main_blueprint
     flask_app.register_blueprint(main_blueprint)
@@ -50,53 +32,45 @@ def create_app(config_name):
     from .notes import notes as notes_blueprint
     flask_app.register_blueprint(notes_blueprint, url_prefix='/notes')
 
-    # Register Markdown filter
-    @flask_app.template_filter('markdown')
-    def markdown_filter(text):
-        """Convert Markdown to HTML with syntax highlighting support."""
-        if not text:
-            return ''
-        
-        # Configure markdown extensions
-        md = markdown.Markdown(extensions=[
-            'extra',  # Tables, fenced code blocks, etc.
-            'codehilite',  # Syntax highlighting
-            'nl2br',  # New line to <br>
-            'sane_lists'  # Better list handling
-        ])
-        
-        # Convert markdown to HTML
-        html = md.convert(text)
-        
-        # Sanitize HTML to prevent XSS (allow common tags)
-        allowed_tags = [
-            'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i', 
-            'li', 'ol', 'pre', 'strong', 'ul', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
-            'p', 'br', 'span', 'div', 'hr', 'table', 'thead', 'tbody', 'tr', 'th', 'td',
-            'img', 'del', 'ins', 'mark', 'sub', 'sup'
-        ]
-        allowed_attributes = {
-            '*': ['class', 'id'],
-            'a': ['href', 'title', 'target', 'rel'],
-            'img': ['src', 'alt', 'title', 'width', 'height'],
-            'code': ['class'],
-            'pre': ['class'],
-            'span': ['class'],
-            'div': ['class']
-        }
-        
-        safe_html = bleach.clean(
-            html,
-            tags=allowed_tags,
-            attributes=allowed_attributes,
-            strip=False
-        )
-        
-        return safe_html
-
-    # Import models to ensure they are registered with SQLAlchemy
-    with flask_app.app_context():
-        import app.models
+    from .api import api as api_blueprint
+    flask_app.register_blueprint(api_blueprint, url_prefix='/api/v1')
+
+    # Register Markdown filter (backed by the render cache)
+    from . import rendering
+    rendering.init_app(flask_app)
+
+    from . import instrumentation
+    instrumentation.init_app(flask_app)
+
+    from . import schema
+    schema.init_app(flask_app)
+
+    from . import render_tasks
+    render_tasks.init_app(flask_app)
+
+    from . import search
+    search.init_app(flask_app)
+
+    from . import caching
+    caching.init_app(flask_app)
+
+    from .images import image_processor
+    image_processor.init_app(flask_app)
+
+    from . import transfer
+    transfer.init_app(flask_app)
+
+    from . import revisions
+    revisions.init_app(flask_app)
+
+    from . import relations
+    relations.init_app(flask_app)
+
+    from . import suggest
+    suggest.init_app(flask_app)
+
+    from . import image_refs
+    image_refs.init_app(flask_app)
 
     def make_shell_context():
         from app.models import LearningNote
@@ -0,0 +1,263 @@
+import gzip
+import json
+import zlib
+
+import sqlalchemy as sa
+from flask import Response, abort, current_app, jsonify, request, stream_with_context, url_for
+from werkzeug.exceptions import HTTPException
+
+from . import api
+from .. import db
+from ..caching import category_cache
+from ..database import read_only
+from ..models import Category, LearningNote, Tag, note_tags
+from ..pagination import paginate_by_updated
+from ..rendering import RENDER_VERSION, markdown_excerpt, render_markdown
+from ..search import search_notes
+
+# Columns each field needs; id and updated_at are always loaded for the cursor
+FIELDS = {
+    'id': (),
+    'title': (LearningNote.title,),
+    'category': (LearningNote.category_id,),
+    'category_id': (LearningNote.category_id,),
+    'tags': (LearningNote.tags,),
+    'excerpt': (LearningNote.excerpt, LearningNote.render_version),
+    'content': (LearningNote.content,),
+    'content_html': (LearningNote.content_html, LearningNote.render_version),
+    'created_at': (LearningNote.created_at,),
+    'updated_at': (),
+    'url': (),
+}
+# Note bodies are only sent when a client asks for them
+DEFAULT_FIELDS = ('id', 'title', 'category', 'tags', 'excerpt', 'created_at', 'updated_at', 'url')
+
+
+@api.errorhandler(HTTPException)
+def _json_error(error):
+    return jsonify({'error': error.description}), error.code
+
+
+@api.after_request
+def _gzip_response(response):
+    # Streamed responses compress themselves (see _stream)
+    if (response.is_streamed or response.direct_passthrough or response.content_encoding
+            or not request.accept_encodings['gzip']
+            or response.content_length is None
+            or response.content_length < current_app.config['API_GZIP_MIN_SIZE']):
+        return response
+    response.set_data(gzip.compress(response.get_data(), compresslevel=6))
+    response.content_encoding = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _requested_fields():
+    raw = request.args.get('fields')
+    if not raw:
+        return DEFAULT_FIELDS
+    fields = tuple(dict.fromkeys(name.strip() for name in raw.split(',') if name.strip()))
+    unknown = [name for name in fields if name not in FIELDS]
+    if unknown or not fields:
+        abort(400, f"Unknown fields: {', '.join(unknown)}. Available: {', '.join(FIELDS)}")
+    return fields
+
+
+def _page_size():
+    limit = request.args.get('limit', type=int) or current_app.config['API_PAGE_SIZE']
+    return max(1, min(limit, current_app.config['API_MAX_PAGE_SIZE']))
+
+
+def _wants_stream():
+    if request.args.get('format') == 'ndjson':
+        return True
+    best = request.accept_mimetypes.best_match(['application/json', 'application/x-ndjson'])
+    return best == 'application/x-ndjson'
+
+
+def note_query(fields):
+    """
+    LearningNote query that loads only the columns `fields` need.
+
+    Every other column, note bodies included, is deferred with raiseload,
+    so a listing can never pull `content` from the database by accident.
+    """
+    columns = [LearningNote.id, LearningNote.updated_at]
+    for name in fields:
+        columns.extend(FIELDS[name])
+    options = [db.load_only(*dict.fromkeys(columns), raiseload=True)]
+    if 'category' in fields:
+        options.append(db.joinedload(LearningNote.category))
+    if 'tags' in fields:
+        options.append(db.selectinload(LearningNote.tag_objects))
+    return LearningNote.query.options(*options)
+
+
+def serialize(notes, fields, snippets=None):
+    """Dicts holding `fields` of each note, plus the search snippet if there is one."""
+    # Rows rendered under an older configuration need their body after all;
+    # fetch it for just those rows, in one query
+    stale = set()
+    if 'excerpt' in fields:
+        stale.update(note.id for note in notes
+                     if note.render_version != RENDER_VERSION or note.excerpt is None)
+    if 'content_html' in fields:
+        stale.update(note.id for note in notes
+                     if note.render_version != RENDER_VERSION or note.content_html is None)
+    bodies = {}
+    if stale and 'content' not in fields:
+        bodies = dict(db.session.execute(
+            sa.select(LearningNote.id, LearningNote.content).where(LearningNote.id.in_(stale))
+        ).all())
+    elif stale:
+        bodies = {note.id: note.content for note in notes if note.id in stale}
+
+    items = []
+    for note in notes:
+        item = {}
+        for name in fields:
+            if name == 'category':
+                value = note.category.name
+            elif name == 'tags':
+                value = note.processed_tags
+            elif name == 'excerpt':
+                value = note.excerpt if note.id not in stale else \
+                    markdown_excerpt(bodies[note.id], current_app.config['EXCERPT_LENGTH'])
+            elif name == 'content_html':
+                value = note.content_html if note.id not in stale else render_markdown(bodies[note.id])
+            elif name in ('created_at', 'updated_at'):
+                value = getattr(note, name)
+                value = value.isoformat() if value else None
+            elif name == 'url':
+                value = url_for('notes.view_note', id=note.id, _external=True)
+            else:
+                value = getattr(note, name)
+            item[name] = value
+        if snippets and note.id in snippets:
+            item['snippet'] = str(snippets[note.id])
+        items.append(item)
+    return items
+
+
+def _stream(fetch, fields):
+    """
+    NDJSON of every item from `fetch(cursor)` pages, one note per line,
+    gzip-compressed on the fly when the client accepts it.
+    """
+    compress = request.accept_encodings['gzip']
+
+    def generate():
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS) if compress else None
+        cursor = request.args.get('cursor')
+        while True:
+            page = fetch(cursor)
+            lines = ''.join(json.dumps(item, ensure_ascii=False) + '\n'
+                            for item in serialize(page.items, fields, page.snippets))
+            chunk = lines.encode('utf-8')
+            if compressor:
+                chunk = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+            if chunk:
+                yield chunk
+            # Rows already sent are not needed again; keep memory flat
+            db.session.expunge_all()
+            if not page.next_cursor:
+                break
+            cursor = page.next_cursor
+        if compressor:
+            yield compressor.flush()
+
+    response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+    if compress:
+        response.content_encoding = 'gzip'
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def _listing(query):
+    """A page of `query` (newest first) as JSON, or all of it as NDJSON."""
+    fields = _requested_fields()
+    if _wants_stream():
+        batch = current_app.config['API_STREAM_BATCH']
+        return _stream(lambda cursor: paginate_by_updated(query(fields), LearningNote, cursor, batch), fields)
+    page = paginate_by_updated(query(fields), LearningNote, request.args.get('cursor'), _page_size())
+    return jsonify({'items': serialize(page.items, fields), 'next_cursor': page.next_cursor})
+
+
+def _parse_ids(raw):
+    try:
+        ids = list(dict.fromkeys(int(value) for value in raw.split(',') if value.strip()))
+    except ValueError:
+        abort(400, 'ids must be a comma-separated list of integers.')
+    if len(ids) > current_app.config['API_MAX_IDS']:
+        abort(400, f"At most {current_app.config['API_MAX_IDS']} ids per request.")
+    return ids
+
+
+@api.route('/notes')
+@read_only
+def list_notes():
+    """Notes newest first; `ids=1,2,3` fetches those notes in one query instead."""
+    if 'ids' in request.args:
+        fields = _requested_fields()
+        ids = _parse_ids(request.args['ids'])
+        found = {note.id: note for note in note_query(fields).filter(LearningNote.id.in_(ids))} if ids else {}
+        return jsonify({
+            'items': serialize([found[note_id] for note_id in ids if note_id in found], fields),
+            'missing': [note_id for note_id in ids if note_id not in found],
+        })
+
+    category_id = request.args.get('category_id', type=int)
+    tag_name = request.args.get('tag')
+    tag_id = None
+    if tag_name:
+        tag_id = db.session.execute(sa.select(Tag.id).where(Tag.name == tag_name)).scalar()
+        if tag_id is None:
+            abort(404, f'No tag named {tag_name!r}.')
+
+    def query(fields):
+        notes = note_query(fields)
+        if category_id is not None:
+            notes = notes.filter(LearningNote.category_id == category_id)
+        if tag_id is not None:
+            notes = notes.join(note_tags).filter(note_tags.c.tag_id == tag_id)
+        return notes
+
+    return _listing(query)
+
+
+@api.route('/notes/<int:id>')
+@read_only
+def get_note(id):
+    fields = _requested_fields()
+    note = note_query(fields).filter(LearningNote.id == id).first()
+    if note is None:
+        abort(404, f'Note {id} does not exist.')
+    return jsonify(serialize([note], fields)[0])
+
+
+@api.route('/search')
+@read_only
+def search():
+    query = request.args.get('q', '').strip()
+    if not query:
+        abort(400, 'q is required.')
+    fields = _requested_fields()
+    if _wants_stream():
+        batch = current_app.config['API_STREAM_BATCH']
+        return _stream(lambda cursor: search_notes(query, cursor, batch, note_query(fields)), fields)
+    page = search_notes(query, request.args.get('cursor'), _page_size(), note_query(fields))
+    return jsonify({'items': serialize(page.items, fields, page.snippets), 'next_cursor': page.next_cursor})
+
+
+@api.route('/categories')
+@read_only
+def list_categories():
+    return jsonify({'items': [category._asdict() for category in category_cache.get()]})
+
+
+@api.route('/categories/<int:id>/notes')
+@read_only
+def category_notes(id):
+    if db.session.get(Category, id) is None:
+        abort(404, f'Category {id} does not exist.')
+    return _listing(lambda fields: note_query(fields).filter(LearningNote.category_id == id))
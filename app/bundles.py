@@ -0,0 +1,161 @@
+import gzip
+import mimetypes
+import os
+import re
+import threading
+
+import click
+from flask import current_app, request, send_from_directory
+from flask.cli import AppGroup
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+bundles_cli = AppGroup('bundles', help='Build the fingerprinted, precompressed asset bundles.')
+
+# Every page loads the *_all bundles; only add_note/edit_note load *_editor
+BUNDLES = {
+    'css_all': dict(
+        contents=('css/bootstrap.min.css', 'css/all.min.css', 'css/prism.min.css', 'css/custom.css'),
+        filters='cssrewrite', output='gen/packed.%(version)s.css'),
+    'js_all': dict(
+        contents=('js/bootstrap.bundle.min.js', 'js/prism-core.min.js', 'js/prism-autoloader.min.js'),
+        output='gen/packed.%(version)s.js'),
+    'css_editor': dict(
+        contents=('css/tagify.css', 'css/quill.snow.css', 'css/toastui-editor.min.css',
+                  'css/toastui-editor-dark.css'),
+        filters='cssrewrite', output='gen/editor.%(version)s.css'),
+    'js_editor': dict(
+        contents=('js/quill.js', 'js/tagify.min.js', 'js/tagify.polyfills.min.js',
+                  'js/toastui-editor.min.js', 'js/toastui-editor-zh-tw.min.js'),
+        output='gen/editor.%(version)s.js'),
+}
+
+_assets = None
+_assets_lock = threading.Lock()
+
+
+# Settings webassets' Environment gives a default value on creation
+_WEBASSETS_DEFAULTS = ('debug', 'cache', 'url_expire', 'auto_build', 'manifest', 'versions',
+                       'updater', 'load_path', 'url_mapping', 'resolver', 'cache_file_mode')
+
+
+def get_assets():
+    """
+    The webassets Environment with every bundle registered, created on
+    first use. It is shared by every app in the process (the benchmarks
+    create several); settings are read from current_app.
+    """
+    global _assets
+    with _assets_lock:
+        if _assets is None:
+            from flask_assets import Bundle, Environment
+            environment = Environment()
+            # webassets saves its defaults (resolver, cache, ...) in the config
+            # of the app that is current here, where other apps never look
+            storage = environment.config
+            for key in _WEBASSETS_DEFAULTS:
+                storage._defaults[key] = storage[key]
+            for name, spec in BUNDLES.items():
+                environment.register(name, Bundle(*spec['contents'], filters=spec.get('filters'),
+                                                  output=spec['output']))
+            _assets = environment
+    return _assets
+
+
+def install_assets(app):
+    """Add the {% assets %} tag to the app's templates."""
+    if 'assets' not in app.extensions:
+        environment = get_assets()
+        environment.init_app(app)
+        app.extensions['assets'] = environment
+
+
+# Bundle outputs carry a content hash in their name, so they never change
+_FINGERPRINTED = re.compile(r'^gen/[\w-]+\.[0-9a-f]{8,}\.(?:css|js)$')
+_ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+IMMUTABLE_MAX_AGE = 365 * 24 * 3600
+
+
+def compress_file(path):
+    """Write .gz (and, if brotli is installed, .br) siblings of `path`; returns their paths."""
+    with open(path, 'rb') as f:
+        data = f.read()
+    written = []
+    # mtime=0 keeps the .gz byte-identical between builds
+    outputs = [(path + '.gz', gzip.compress(data, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        outputs.append((path + '.br', brotli.compress(data, quality=11)))
+    for target, compressed in outputs:
+        tmp_path = f'{target}.{os.getpid()}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(compressed)
+        os.replace(tmp_path, target)
+        written.append(target)
+    return written
+
+
+def build_bundles():
+    """Build every bundle, record it in the manifest and precompress it. Returns the output paths."""
+    assets = get_assets()
+    outputs = []
+    for name in BUNDLES:
+        bundle = assets[name]
+        bundle.build(force=True)
+        # Resolving the URL with a manifest configured stores the version in it
+        bundle.urls()
+        version = bundle.get_version()
+        path = os.path.join(assets.directory, bundle.output % {'version': version})
+        compress_file(path)
+        outputs.append(path)
+    return outputs
+
+
+def _send_bundle(filename):
+    static_folder = current_app.static_folder
+    mimetype = mimetypes.guess_type(filename)[0]
+    response = None
+    for encoding, suffix in _ENCODINGS:
+        if request.accept_encodings[encoding] and os.path.isfile(os.path.join(static_folder, filename + suffix)):
+            response = send_from_directory(static_folder, filename + suffix, mimetype=mimetype,
+                                           max_age=IMMUTABLE_MAX_AGE)
+            response.content_encoding = encoding
+            break
+    if response is None:
+        response = send_from_directory(static_folder, filename, mimetype=mimetype,
+                                       max_age=IMMUTABLE_MAX_AGE)
+    response.vary.add('Accept-Encoding')
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def init_app(app):
+    app.cli.add_command(bundles_cli)
+
+    # webassets is only loaded once the app serves a request, so CLI
+    # commands and scripts that never render a page skip it entirely
+    @app.before_request
+    def _install_assets():
+        if 'assets' not in app.extensions:
+            install_assets(app)
+
+    serve_static = app.view_functions['static']
+
+    def static(filename):
+        if _FINGERPRINTED.match(filename):
+            return _send_bundle(filename)
+        return serve_static(filename=filename)
+
+    app.view_functions['static'] = static
+
+
+@bundles_cli.command('build')
+def build_command():
+    """Build the bundles with hashed names, update the manifest and write .gz/.br files."""
+    for path in build_bundles():
+        click.echo(f'Built {os.path.relpath(path, current_app.static_folder)}')
+    if brotli is None:
+        click.echo('brotli is not installed; only .gz files were written.')
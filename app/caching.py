@@ -0,0 +1,201 @@
+import threading
+import time
+from collections import namedtuple
+
+import sqlalchemy as sa
+from flask import current_app
+
+from . import db
+from .models import CacheVersion, Category, LearningNote
+from .rendering import LRUCache
+
+_version_table_ready = set()
+
+
+def _has_version_table(connection):
+    url = str(connection.engine.url)
+    if url not in _version_table_ready:
+        if not sa.inspect(connection).has_table(CacheVersion.__tablename__):
+            return False
+        _version_table_ready.add(url)
+    return True
+
+
+def read_version(name, connection=None):
+    """Current value of the version stamp `name` (0 if it was never bumped)."""
+    connection = connection or db.session.connection()
+    if not _has_version_table(connection):
+        return 0
+    table = CacheVersion.__table__
+    version = connection.execute(
+        sa.select(table.c.version).where(table.c.name == name)
+    ).scalar()
+    return version or 0
+
+
+def bump_version(name, connection):
+    """Increment the version stamp `name` inside the caller's transaction."""
+    if not _has_version_table(connection):
+        return
+    table = CacheVersion.__table__
+    result = connection.execute(
+        table.update().where(table.c.name == name).values(version=table.c.version + 1)
+    )
+    if result.rowcount == 0:
+        connection.execute(table.insert().values(name=name, version=1))
+
+
+CachedCategory = namedtuple('CachedCategory', 'id name note_count')
+
+
+class CategoryCache:
+    """
+    Categories with their note counts, shared by every request in a process.
+
+    The DB version stamp is checked at most once per
+    CATEGORY_CACHE_CHECK_INTERVAL seconds, so other workers see changes
+    within that window; changes made by this process are seen immediately.
+    """
+
+    VERSION_NAME = 'categories'
+
+    def __init__(self):
+        self._categories = None
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+        self.loads = 0
+        self.version_checks = 0
+        self.queries_saved = 0
+
+    def _load(self):
+        note_counts = sa.select(
+            LearningNote.category_id, sa.func.count().label('note_count')
+        ).group_by(LearningNote.category_id).subquery()
+        rows = db.session.execute(
+            sa.select(Category.id, Category.name, sa.func.coalesce(note_counts.c.note_count, 0))
+            .outerjoin(note_counts, note_counts.c.category_id == Category.id)
+            .order_by(Category.name)
+        ).all()
+        return [CachedCategory(*row) for row in rows]
+
+    def get(self):
+        now = time.monotonic()
+        interval = current_app.config['CATEGORY_CACHE_CHECK_INTERVAL']
+        with self._lock:
+            categories, version, checked_at = self._categories, self._version, self._checked_at
+        if categories is not None and now - checked_at < interval:
+            self.queries_saved += 1
+            return categories
+
+        current = read_version(self.VERSION_NAME)
+        self.version_checks += 1
+        if categories is not None and current == version:
+            with self._lock:
+                self._checked_at = now
+            return categories
+
+        categories = self._load()
+        self.loads += 1
+        with self._lock:
+            self._categories, self._version, self._checked_at = categories, current, now
+        return categories
+
+    @property
+    def version(self):
+        """Version stamp the cached list was loaded at (call get() first)."""
+        return self._version
+
+    def invalidate(self):
+        with self._lock:
+            self._categories = None
+
+    def stats(self):
+        return {
+            'cached': self._categories is not None,
+            'version': self._version,
+            'loads': self.loads,
+            'version_checks': self.version_checks,
+            'queries_saved': self.queries_saved,
+        }
+
+
+category_cache = CategoryCache()
+
+
+class PageCache:
+    """
+    Fully rendered pages keyed by note id, for viewers who are not admins.
+
+    Each entry carries the stamp it was rendered for (updated_at, render
+    version, category version); a lookup with a different stamp is a miss,
+    so a worker never serves a page another worker has since changed.
+    """
+
+    def __init__(self, maxsize=128):
+        self._pages = LRUCache(maxsize)
+        self.hits = 0
+        self.misses = 0
+        self.purges = 0
+
+    def configure(self, maxsize):
+        self._pages = LRUCache(maxsize)
+
+    def get(self, note_id, stamp):
+        entry = self._pages.get(note_id)
+        if entry is not None and entry[0] == stamp:
+            self.hits += 1
+            return entry[1]
+        self.misses += 1
+        return None
+
+    def set(self, note_id, stamp, body):
+        self._pages.set(note_id, (stamp, body))
+
+    def purge(self, note_id):
+        self._pages.discard(note_id)
+        self.purges += 1
+
+    def stats(self):
+        return {
+            'size': len(self._pages),
+            'maxsize': self._pages.maxsize,
+            'hits': self.hits,
+            'misses': self.misses,
+            'purges': self.purges,
+        }
+
+
+page_cache = PageCache()
+
+
+def init_app(app):
+    page_cache.configure(app.config['PAGE_CACHE_SIZE'])
+
+
+@db.event.listens_for(LearningNote, 'after_update')
+@db.event.listens_for(LearningNote, 'after_delete')
+def _purge_note_page(mapper, connection, note):
+    page_cache.purge(note.id)
+
+
+def _affects_categories(session):
+    for obj in session.new:
+        if isinstance(obj, (Category, LearningNote)):
+            return True
+    for obj in session.deleted:
+        if isinstance(obj, (Category, LearningNote)):
+            return True
+    for obj in session.dirty:
+        if isinstance(obj, Category):
+            return True
+        if isinstance(obj, LearningNote) and db.inspect(obj).attrs.category_id.history.has_changes():
+            return True
+    return False
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _bump_category_version(session, flush_context):
+    if _affects_categories(session):
+        bump_version(CategoryCache.VERSION_NAME, session.connection())
+        category_cache.invalidate()
@@ -0,0 +1,104 @@
+import functools
+import os
+from urllib.parse import quote
+
+import sqlalchemy as sa
+from flask import g, has_app_context
+from flask_sqlalchemy.session import Session
+
+# Bind key of the read-only engine used by @read_only views
+READ_BIND = 'read'
+
+
+class RoutingSession(Session):
+    """
+    Sends the statements of @read_only views to the read-only engine.
+
+    Flushes always go to the primary engine, and so does everything outside
+    a read-only view, including background threads.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get('db_read_only'):
+            engine = self._db.engines.get(READ_BIND)
+            if engine is not None:
+                return engine
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+def read_only(view):
+    """Route the view's queries to the read-only engine, if one is configured."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _sqlite_file(uri, instance_path):
+    url = sa.engine.make_url(uri)
+    if url.get_backend_name() != 'sqlite' or url.database in (None, '', ':memory:'):
+        return None
+    if url.query.get('uri'):
+        return None
+    # Relative paths are resolved the way Flask-SQLAlchemy resolves them
+    return os.path.join(instance_path, url.database)
+
+
+def read_database_uri(app):
+    """
+    URI of the read-only engine: SQLALCHEMY_READ_DATABASE_URI if set,
+    otherwise the primary SQLite file opened with mode=ro.
+    """
+    uri = app.config['SQLALCHEMY_READ_DATABASE_URI']
+    if uri or not app.config['SQLITE_READ_ONLY_ROUTE']:
+        return uri
+    path = _sqlite_file(app.config['SQLALCHEMY_DATABASE_URI'], app.instance_path)
+    if path is None:
+        return None
+    path = quote(path.replace(os.sep, '/'), safe='/:')
+    return f'sqlite:///file:{path}?mode=ro&uri=true'
+
+
+def configure_read_bind(app):
+    """Add the read-only bind; must run before db.init_app()."""
+    uri = read_database_uri(app)
+    if uri:
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        binds[READ_BIND] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds
+
+
+def _pragma_listener(pragmas, read_only_connection):
+    def apply_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        try:
+            for name, value in pragmas.items():
+                # The journal mode can only be changed through a writable connection
+                if read_only_connection and name == 'journal_mode':
+                    continue
+                cursor.execute(f'PRAGMA {name} = {value}')
+            if read_only_connection:
+                cursor.execute('PRAGMA query_only = ON')
+        finally:
+            cursor.close()
+    return apply_pragmas
+
+
+def init_app(app):
+    from . import db
+    pragmas = app.config['SQLITE_PRAGMAS']
+    path = _sqlite_file(app.config['SQLALCHEMY_DATABASE_URI'], app.instance_path)
+    if path is not None:
+        # sqlite3 creates the database file, but not the folder it goes in
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with app.app_context():
+        engines = db.engines
+        for key, engine in engines.items():
+            if engine.dialect.name == 'sqlite':
+                sa.event.listen(engine, 'connect', _pragma_listener(pragmas, key == READ_BIND))
+        if READ_BIND in engines and engines[None].dialect.name == 'sqlite':
+            # A mode=ro connection can't create the WAL index, so let the
+            # primary engine open the file (and switch it to WAL) first.
+            with engines[None].connect():
+                pass
@@ -0,0 +1,290 @@
+import os
+import re
+import time
+from collections import namedtuple
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import AppGroup
+
+from . import db
+from .images import DIGEST_LENGTH
+from .models import Category, LearningNote, NoteRevision, note_images
+from .revisions import RevisionError, revision_store
+
+images_cli = AppGroup('images', help='Track uploaded images and remove the ones no note uses.')
+
+# Any reference to an uploaded file: Markdown image, HTML <img>/<source> or plain link
+_IMAGE_URL = re.compile(r'/static/images/([\w.-]+)')
+# An upload and its variants share the digest (abc.jpg, abc-320.webp, ...)
+_DIGEST_NAME = re.compile(r'^([0-9a-f]{%d})(?:-\d+)?\.\w+$' % DIGEST_LENGTH)
+
+ImageFile = namedtuple('ImageFile', 'name size mtime')
+GcResult = namedtuple('GcResult', 'removed removed_bytes kept too_new')
+
+
+class ImageIndexMissing(RuntimeError):
+    """The image reference index does not exist or was never filled in."""
+
+
+def extract_images(content):
+    """File names of the uploaded images `content` refers to."""
+    return set(_IMAGE_URL.findall(content or ''))
+
+
+def group_key(filename):
+    """The digest for content-hashed uploads and their variants, otherwise the name itself."""
+    match = _DIGEST_NAME.match(filename)
+    return match.group(1) if match else filename
+
+
+def index_note_images(connection, note_id, content):
+    connection.execute(note_images.delete().where(note_images.c.note_id == note_id))
+    names = extract_images(content)
+    if names:
+        connection.execute(note_images.insert(),
+                           [{'note_id': note_id, 'filename': name} for name in sorted(names)])
+
+
+_refs_ready = set()
+
+
+def refs_available(connection):
+    url = str(connection.engine.url)
+    if url not in _refs_ready:
+        if not sa.inspect(connection).has_table(note_images.name):
+            return False
+        _refs_ready.add(url)
+    return True
+
+
+@db.event.listens_for(LearningNote, 'after_insert')
+def _index_new_note_images(mapper, connection, note):
+    if refs_available(connection):
+        index_note_images(connection, note.id, note.content)
+
+
+@db.event.listens_for(LearningNote, 'after_update')
+def _index_updated_note_images(mapper, connection, note):
+    if db.inspect(note).attrs.content.history.has_changes() and refs_available(connection):
+        index_note_images(connection, note.id, note.content)
+
+
+@db.event.listens_for(LearningNote, 'before_delete')
+def _unindex_note_images(mapper, connection, note):
+    if refs_available(connection):
+        connection.execute(note_images.delete().where(note_images.c.note_id == note.id))
+
+
+def rebuild_index(batch_size=200):
+    """Re-read every note's content into note_image; returns the number of notes."""
+    engine = db.engine
+    table = LearningNote.__table__
+    with engine.begin() as connection:
+        connection.execute(note_images.delete())
+    last_id = 0
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                sa.select(table.c.id, table.c.content).where(table.c.id > last_id)
+                .order_by(table.c.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            params = [{'note_id': note_id, 'filename': name}
+                      for note_id, content in rows for name in sorted(extract_images(content))]
+            if params:
+                connection.execute(note_images.insert(), params)
+        total += len(rows)
+        last_id = rows[-1][0]
+    return total
+
+
+def scan_images(images_dir):
+    """Files in the upload directory, grouped by group_key()."""
+    groups = {}
+    if not os.path.isdir(images_dir):
+        return groups
+    with os.scandir(images_dir) as entries:
+        for entry in entries:
+            if entry.is_file():
+                stat = entry.stat()
+                groups.setdefault(group_key(entry.name), []).append(
+                    ImageFile(entry.name, stat.st_size, stat.st_mtime))
+    return groups
+
+
+def referenced_keys(include_revisions=True):
+    """
+    Mark phase: group keys of every image a note embeds, and, with
+    `include_revisions`, that a stored revision embeds, so restoring a
+    revision never brings back a broken image.
+    """
+    keys = {group_key(name) for name in
+            db.session.execute(sa.select(note_images.c.filename).distinct()).scalars()}
+    if include_revisions:
+        note_ids = db.session.execute(sa.select(NoteRevision.note_id).distinct()).scalars().all()
+        unreadable = []
+        for note_id in note_ids:
+            try:
+                for _, content in revision_store.contents(note_id):
+                    keys.update(group_key(name) for name in extract_images(content))
+            except RevisionError:
+                unreadable.append(note_id)
+        if unreadable:
+            # Their images can't be told apart from garbage, so sweep nothing
+            raise RevisionError('Cannot read the revisions of notes ' + ', '.join(map(str, unreadable))
+                                + '; fix them or run with --ignore-revisions')
+    return keys
+
+
+def _require_table():
+    if not refs_available(db.session.connection()):
+        raise ImageIndexMissing("There is no note_image table; run 'flask schema upgrade' "
+                                "and 'flask images reindex' first")
+
+
+def _check_index():
+    _require_table()
+    if db.session.execute(sa.select(note_images.c.note_id).limit(1)).first() is not None:
+        return
+    table = LearningNote.__table__
+    if db.session.execute(sa.select(table.c.id).where(table.c.content.contains('/static/images/'))
+                          .limit(1)).first() is not None:
+        raise ImageIndexMissing("note_image is empty but notes embed images; run 'flask images reindex' first")
+
+
+def collect_garbage(images_dir, grace_seconds, include_revisions=True, dry_run=False):
+    """
+    Remove uploaded files no note (or revision) refers to.
+
+    A file is only removed once it is older than `grace_seconds`, so an
+    image uploaded in the editor survives until the note is saved. Keys
+    are checked against the index once more right before the sweep, in case
+    a note picked the file up while the mark phase ran.
+    """
+    _check_index()
+    marked = referenced_keys(include_revisions)
+    groups = scan_images(images_dir)
+    cutoff = time.time() - grace_seconds
+    candidates = {}
+    too_new = 0
+    for key, files in groups.items():
+        if key in marked:
+            continue
+        if max(f.mtime for f in files) > cutoff:
+            too_new += len(files)
+        else:
+            candidates[key] = files
+
+    if candidates:
+        # A fresh read transaction sees notes saved since the mark phase began
+        db.session.commit()
+        names = [f.name for files in candidates.values() for f in files]
+        for start in range(0, len(names), 500):
+            for name in db.session.execute(sa.select(note_images.c.filename).distinct()
+                                           .where(note_images.c.filename.in_(names[start:start + 500]))).scalars():
+                candidates.pop(group_key(name), None)
+
+    removed = removed_bytes = 0
+    for files in candidates.values():
+        for f in files:
+            if not dry_run:
+                try:
+                    os.remove(os.path.join(images_dir, f.name))
+                except FileNotFoundError:
+                    continue
+            removed += 1
+            removed_bytes += f.size
+    kept = sum(len(files) for key, files in groups.items() if key in marked)
+    return GcResult(removed, removed_bytes, kept, too_new)
+
+
+def storage_usage(images_dir):
+    """
+    Bytes of uploads (variants included) per note and per category, and the
+    directory totals. An image shared by several notes counts fully for each
+    of them, and once per category.
+    """
+    _require_table()
+    groups = scan_images(images_dir)
+    sizes = {key: sum(f.size for f in files) for key, files in groups.items()}
+    table = LearningNote.__table__
+    rows = db.session.execute(
+        sa.select(table.c.id, table.c.title, Category.__table__.c.name, note_images.c.filename)
+        .join(note_images, note_images.c.note_id == table.c.id)
+        .join(Category.__table__, Category.__table__.c.id == table.c.category_id)
+    ).all()
+    notes, categories = {}, {}
+    referenced = set()
+    for note_id, title, category, filename in rows:
+        key = group_key(filename)
+        if key not in sizes:
+            continue
+        referenced.add(key)
+        notes.setdefault((note_id, title, category), set()).add(key)
+        categories.setdefault(category, set()).add(key)
+    return {
+        'total_files': sum(len(files) for files in groups.values()),
+        'total_bytes': sum(sizes.values()),
+        'referenced_bytes': sum(sizes[key] for key in referenced),
+        'unreferenced_bytes': sum(size for key, size in sizes.items() if key not in referenced),
+        'notes': sorted(((note_id, title, category, len(keys), sum(sizes[key] for key in keys))
+                         for (note_id, title, category), keys in notes.items()),
+                        key=lambda row: row[4], reverse=True),
+        'categories': sorted(((category, len(keys), sum(sizes[key] for key in keys))
+                              for category, keys in categories.items()),
+                             key=lambda row: row[2], reverse=True),
+    }
+
+
+def init_app(app):
+    app.cli.add_command(images_cli)
+
+
+@images_cli.command('reindex')
+@click.option('--batch-size', default=200, type=int, help='Rows per transaction.')
+def reindex_command(batch_size):
+    """Rebuild the image reference index from every note's content."""
+    count = rebuild_index(batch_size)
+    click.echo(f'Indexed the images of {count} notes.')
+
+
+@images_cli.command('gc')
+@click.option('--grace-hours', default=None, type=float, help='Keep unreferenced files newer than this (default: IMAGE_GC_GRACE_HOURS).')
+@click.option('--ignore-revisions', is_flag=True, help='Also remove images only older revisions use.')
+@click.option('--dry-run', is_flag=True, help='Only report what would be removed.')
+def gc_command(grace_hours, ignore_revisions, dry_run):
+    """Delete uploaded images that no note refers to."""
+    if grace_hours is None:
+        grace_hours = current_app.config['IMAGE_GC_GRACE_HOURS']
+    try:
+        result = collect_garbage(current_app.config['UPLOAD_FOLDER'], grace_hours * 3600,
+                                 include_revisions=not ignore_revisions, dry_run=dry_run)
+    except (ImageIndexMissing, RevisionError) as exc:
+        raise click.ClickException(str(exc))
+    verb = 'Would remove' if dry_run else 'Removed'
+    click.echo(f'{verb} {result.removed} files ({result.removed_bytes:,} bytes); '
+               f'{result.kept} in use, {result.too_new} unreferenced but newer than {grace_hours:g}h.')
+
+
+@images_cli.command('usage')
+@click.option('--top', default=10, type=int, show_default=True, help='Notes to list.')
+def usage_command(top):
+    """Show how much space uploaded images take, per note and per category."""
+    try:
+        usage = storage_usage(current_app.config['UPLOAD_FOLDER'])
+    except ImageIndexMissing as exc:
+        raise click.ClickException(str(exc))
+    click.echo(f"{usage['total_files']} files, {usage['total_bytes']:,} bytes "
+               f"({usage['referenced_bytes']:,} referenced, {usage['unreferenced_bytes']:,} unreferenced)")
+    if usage['categories']:
+        click.echo('Per category:')
+        for category, count, size in usage['categories']:
+            click.echo(f'  {size:>12,}  {count:>4} images  {category}')
+    if usage['notes']:
+        click.echo('Largest notes:')
+        for note_id, title, category, count, size in usage['notes'][:top]:
+            click.echo(f'  {size:>12,}  {count:>4} images  #{note_id} {title} [{category}]')
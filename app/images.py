@@ -0,0 +1,264 @@
+import glob
+import hashlib
+import logging
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .instrumentation import timed
+
+logger = logging.getLogger(__name__)
+
+# Pillow's decompression-bomb limit; set from IMAGE_MAX_PIXELS by init_app()
+max_image_pixels = None
+
+
+def _pillow():
+    # Pillow is imported on first use, so processes that never see an
+    # upload (CLI commands, most workers) don't pay for loading it.
+    from PIL import Image
+    if max_image_pixels is not None:
+        Image.MAX_IMAGE_PIXELS = max_image_pixels
+    return Image
+
+
+def is_valid_image(stream):
+    """Check the upload is a readable image within IMAGE_MAX_PIXELS, without decoding its pixels."""
+    try:
+        with _pillow().open(stream) as img:
+            # Pillow only refuses images twice over its limit and warns below that
+            if max_image_pixels is not None and img.width * img.height > max_image_pixels:
+                return False
+            img.verify()
+        return True
+    except Exception:
+        return False
+    finally:
+        stream.seek(0)
+
+
+# Uploads are stored as <sha256 prefix>.<ext>; variants as <digest>-<width>.<format>
+DIGEST_LENGTH = 32
+_VARIANT_NAME = re.compile(r'^([0-9a-f]{%d})-(\d+)\.(\w+)$' % DIGEST_LENGTH)
+_CANONICAL_EXT = {'jpeg': 'jpg'}
+# Encoder options per variant format. libavif's own thread pool can hang
+# interpreter shutdown when driven from worker threads, and the pool already
+# parallelizes across images, so AVIF encodes on one thread.
+_VARIANT_ENCODERS = {
+    'webp': {'format': 'WEBP'},
+    'avif': {'format': 'AVIF', 'max_threads': 1},
+}
+
+
+def content_filename(stream, ext):
+    """Name an upload after a hash of its bytes so duplicates share one file."""
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(1024 * 64), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    ext = _CANONICAL_EXT.get(ext, ext)
+    return f'{digest.hexdigest()[:DIGEST_LENGTH]}.{ext}'
+
+
+def supported_variant_formats(formats):
+    from PIL import features
+    return [fmt for fmt in formats if fmt in _VARIANT_ENCODERS and features.check(fmt)]
+
+
+def variant_filename(filename, width, fmt):
+    return f"{filename.rsplit('.', 1)[0]}-{width}.{fmt}"
+
+
+def find_variants(images_dir, digest):
+    """Map each variant format to the widths available on disk for `digest`."""
+    variants = {}
+    for path in glob.glob(os.path.join(images_dir, f'{digest}-*.*')):
+        match = _VARIANT_NAME.match(os.path.basename(path))
+        if match:
+            variants.setdefault(match.group(3), []).append(int(match.group(2)))
+    for widths in variants.values():
+        widths.sort()
+    return variants
+
+
+def _save_atomic(img, path, **params):
+    tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        img.save(tmp_path, **params)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def process_image(path, max_width, quality):
+    """
+    Downscale the image at `path` to `max_width` in place.
+
+    JPEG sources are decoded at a reduced scale with Image.draft(), so a
+    huge photo is never materialized at full resolution; for every format
+    resize() first shrinks by an integer factor with Image.reduce() before
+    the LANCZOS pass. The result is
+    written to a temporary file and swapped in atomically, so readers see
+    either the original upload or the finished image.
+    """
+    Image = _pillow()
+    with Image.open(path) as img:
+        if img.width <= max_width:
+            return False
+        height = int(img.height * max_width / float(img.width))
+        if img.format == 'JPEG':
+            img.draft('RGB', (max_width, height))
+        image_format = img.format
+        resized = img.resize((max_width, height), Image.LANCZOS, reducing_gap=3.0)
+
+    _save_atomic(resized, path, format=image_format, quality=quality)
+    return True
+
+
+def make_variants(path, widths, formats, quality):
+    """
+    Write width variants of the (already downscaled) image at `path` in
+    each of `formats`, e.g. abc-320.webp. Widths larger than the image are
+    replaced by the image's own width. Returns the variant file names.
+    """
+    Image = _pillow()
+    written = []
+    with Image.open(path) as img:
+        img.load()
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'transparency' in img.info or img.mode in ('LA', 'PA') else 'RGB')
+        targets = sorted({min(width, img.width) for width in widths})
+        for width in targets:
+            height = max(1, int(img.height * width / float(img.width)))
+            scaled = img if width == img.width else img.resize((width, height), Image.LANCZOS, reducing_gap=3.0)
+            for fmt in formats:
+                variant = os.path.join(os.path.dirname(path), variant_filename(os.path.basename(path), width, fmt))
+                _save_atomic(scaled, variant, quality=quality, **_VARIANT_ENCODERS[fmt])
+                written.append(os.path.basename(variant))
+    return written
+
+
+class ImageProcessor:
+    """
+    Runs process_image() and make_variants() on a bounded thread pool, off
+    the request thread.
+
+    At most IMAGE_QUEUE_SIZE jobs may be pending; beyond that the upload is
+    processed inline, which slows the uploader down instead of letting the
+    backlog grow without bound.
+    """
+
+    def __init__(self):
+        self._executor = None
+        self._slots = None
+        self._lock = threading.Lock()
+        self.workers = 2
+        self.queue_size = 32
+        self.run_async = True
+        self.max_width = 800
+        self.quality = 85
+        self.variant_widths = ()
+        self.requested_formats = ()
+        self._variant_formats = None
+        self.submitted = 0
+        self.inline = 0
+        self.failed = 0
+        self.duplicates = 0
+        self._app = None
+
+    def init_app(self, app):
+        global max_image_pixels
+        self._app = app
+        self.workers = app.config['IMAGE_WORKERS']
+        self.queue_size = app.config['IMAGE_QUEUE_SIZE']
+        self.run_async = app.config['IMAGE_ASYNC']
+        self.max_width = app.config['MAX_IMAGE_WIDTH']
+        self.quality = app.config['IMAGE_QUALITY']
+        self.variant_widths = app.config['IMAGE_VARIANT_WIDTHS']
+        self.requested_formats = app.config['IMAGE_VARIANT_FORMATS']
+        self._variant_formats = None
+        max_image_pixels = app.config['IMAGE_MAX_PIXELS']
+
+    @property
+    def variant_formats(self):
+        # Probing the encoders imports Pillow, so it waits for the first job
+        if self._variant_formats is None:
+            self._variant_formats = supported_variant_formats(self.requested_formats)
+        return self._variant_formats
+
+    def _ensure_executor(self):
+        # Created lazily so each pre-forked worker process gets its own threads
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                    thread_name_prefix='image-worker')
+                self._slots = threading.BoundedSemaphore(self.queue_size)
+        return self._executor
+
+    def _run(self, path):
+        try:
+            with timed('image_resize'):
+                process_image(path, self.max_width, self.quality)
+            if self.variant_widths and self.variant_formats:
+                with timed('image_variants'):
+                    written = make_variants(path, self.variant_widths, self.variant_formats, self.quality)
+                if written:
+                    self._variants_ready(path)
+        except Exception:
+            self.failed += 1
+            # The original upload stays in place and is still served
+            logger.exception('Image processing failed for %s', path)
+
+    def _variants_ready(self, path):
+        # A note may have been saved while the variants were being written
+        if self._app is None:
+            return
+        from .render_tasks import rerender_image_notes
+        digest = os.path.basename(path).rsplit('.', 1)[0]
+        with self._app.app_context():
+            rerender_image_notes(digest)
+
+    def _run_queued(self, path):
+        try:
+            self._run(path)
+        finally:
+            self._slots.release()
+
+    def submit(self, path):
+        if not self.run_async:
+            self.inline += 1
+            self._run(path)
+            return
+        executor = self._ensure_executor()
+        if not self._slots.acquire(blocking=False):
+            self.inline += 1
+            self._run(path)
+            return
+        self.submitted += 1
+        executor.submit(self._run_queued, path)
+
+    def wait_idle(self):
+        """Block until every queued job has finished."""
+        if self._slots is None:
+            return
+        # Holding every slot means no job is pending or running
+        for _ in range(self.queue_size):
+            self._slots.acquire()
+        for _ in range(self.queue_size):
+            self._slots.release()
+
+    def stats(self):
+        return {
+            'workers': self.workers,
+            'queue_size': self.queue_size,
+            'variant_formats': self.variant_formats,
+            'submitted': self.submitted,
+            'inline': self.inline,
+            'failed': self.failed,
+            'duplicates': self.duplicates,
+        }
+
+
+image_processor = ImageProcessor()
@@ -0,0 +1,320 @@
+import cProfile
+import glob
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from flask import (Response, before_render_template, g, has_request_context, request,
+                   session, template_rendered)
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError:
+    SamplingProfiler = None
+
+
+class QueryCountExceeded(AssertionError):
+    """Raised (when QUERY_COUNT_RAISE is set) if a request runs too many statements."""
+
+
+_counters = threading.local()
+
+
+@contextmanager
+def count_queries():
+    """Collect every statement executed in this thread inside the block."""
+    stack = getattr(_counters, 'stack', None)
+    if stack is None:
+        stack = _counters.stack = []
+    statements = []
+    stack.append(statements)
+    try:
+        yield statements
+    finally:
+        stack.remove(statements)
+
+
+# --- Metrics ------------------------------------------------------------------
+
+class Metrics:
+    """
+    Process-wide counters and histograms, rendered in the Prometheus text format.
+
+    Each worker process keeps its own values; Prometheus sums them when it
+    scrapes every worker.
+    """
+
+    BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._help = {}
+        self._counters = {}
+        self._histograms = {}
+
+    def describe(self, name, kind, text):
+        self._help[name] = (kind, text)
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            for index, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def reset(self):
+        with self._lock:
+            self._counters.clear()
+            self._histograms.clear()
+
+    @staticmethod
+    def _labels(labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                   for _, value in pairs)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+    def render(self, extra_counters=()):
+        """
+        The exposition text. `extra_counters` are (name, labels dict, value)
+        triples read from elsewhere, such as the cache statistics.
+        """
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(buckets), total, count)
+                          for key, (buckets, total, count) in self._histograms.items()}
+        for name, labels, value in extra_counters:
+            counters[(name, tuple(sorted(labels.items())))] = value
+
+        lines = []
+        described = set()
+
+        def header(name, default_kind):
+            if name in described:
+                return
+            described.add(name)
+            kind, text = self._help.get(name, (default_kind, ''))
+            if text:
+                lines.append(f'# HELP {name} {text}')
+            lines.append(f'# TYPE {name} {kind}')
+
+        for (name, labels), value in sorted(counters.items()):
+            header(name, 'counter')
+            lines.append(f'{name}{self._labels(labels)} {value}')
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            header(name, 'histogram')
+            for bound, bucket_count in zip(self.BUCKETS, buckets):
+                lines.append(f'{name}_bucket{self._labels(labels, [("le", bound)])} {bucket_count}')
+            lines.append(f'{name}_bucket{self._labels(labels, [("le", "+Inf")])} {count}')
+            lines.append(f'{name}_sum{self._labels(labels)} {total:.6f}')
+            lines.append(f'{name}_count{self._labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('study_web_timer_seconds', 'histogram',
+                 'Time spent in instrumented sections (sql, markdown, bleach, jinja, image_*).')
+metrics.describe('study_web_request_duration_seconds', 'histogram', 'Time to handle a request.')
+metrics.describe('study_web_requests_total', 'counter', 'Requests handled, by endpoint and status.')
+
+
+def record(name, seconds):
+    """Add `seconds` to the `name` timer of this process and of the current request."""
+    metrics.observe('study_web_timer_seconds', seconds, timer=name)
+    if has_request_context():
+        timings = g.setdefault('timings', {})
+        total, count = timings.get(name, (0.0, 0))
+        timings[name] = (total + seconds, count + 1)
+
+
+@contextmanager
+def timed(name):
+    """Time the block as one `name` section (see record())."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(name, time.perf_counter() - started)
+
+
+# --- SQL ----------------------------------------------------------------------
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _record_statement(conn, cursor, statement, parameters, context, executemany):
+    for statements in getattr(_counters, 'stack', ()):
+        statements.append(statement)
+    if has_request_context():
+        g.setdefault('sql_statements', []).append(statement)
+    if context is not None:
+        context._instrumentation_started = time.perf_counter()
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _record_statement_time(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, '_instrumentation_started', None)
+    if started is not None:
+        record('sql', time.perf_counter() - started)
+
+
+# --- Per request --------------------------------------------------------------
+
+def _server_timing(timings, total):
+    parts = []
+    for name, (seconds, count) in sorted(timings.items()):
+        part = f'{name};dur={seconds * 1000:.2f}'
+        if count > 1:
+            part += f';desc="{count}x"'
+        parts.append(part)
+    parts.append(f'total;dur={total * 1000:.2f}')
+    return ', '.join(parts)
+
+
+def _cache_counters():
+    from .caching import category_cache, page_cache
+    from .rendering import render_cache
+    for cache, stats in (('render', render_cache.stats()), ('pages', page_cache.stats()),
+                         ('categories', category_cache.stats())):
+        for field in ('hits', 'misses', 'evictions', 'disk_hits', 'purges'):
+            if field in stats:
+                yield 'study_web_cache_events_total', {'cache': cache, 'event': field}, stats[field]
+
+
+def _start_profiler():
+    mode = request.headers.get('X-Profile', '').lower()
+    if mode not in ('1', 'cprofile', 'pyinstrument') or not session.get('is_admin'):
+        return
+    if mode == 'pyinstrument' and SamplingProfiler is not None:
+        profiler = SamplingProfiler()
+        profiler.start()
+    else:
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active in this thread
+            return
+    g.profiler = profiler
+
+
+def _stop_profiler(app):
+    profiler = g.pop('profiler', None)
+    if profiler is None:
+        return None
+    directory = app.config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    stamp = datetime.utcnow().strftime('%Y%m%dT%H%M%S%f')
+    name = f"{stamp}-{(request.endpoint or 'unknown').replace('.', '_')}"
+    if isinstance(profiler, cProfile.Profile):
+        profiler.disable()
+        path = os.path.join(directory, f'{name}.prof')
+        profiler.dump_stats(path)
+    else:
+        profiler.stop()
+        path = os.path.join(directory, f'{name}.html')
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(profiler.output_html())
+
+    # Keep only the newest PROFILE_KEEP dumps
+    dumps = sorted(glob.glob(os.path.join(directory, '*.prof')) + glob.glob(os.path.join(directory, '*.html')))
+    for old in dumps[:-app.config['PROFILE_KEEP']]:
+        os.remove(old)
+    return os.path.basename(path)
+
+
+def init_app(app):
+    limit = app.config['QUERY_COUNT_LIMIT']
+
+    @app.before_request
+    def _start_request_timer():
+        g.request_started = time.perf_counter()
+        # A request inside an app context that is already pushed (the test
+        # client, scripts) shares its g; count this request's statements only
+        g.sql_statements = []
+        if app.config['PROFILING_ENABLED']:
+            _start_profiler()
+
+    def _before_template(sender, template, context, **extra):
+        g.setdefault('template_started', []).append(time.perf_counter())
+
+    def _after_template(sender, template, context, **extra):
+        stack = g.get('template_started')
+        if stack:
+            record('jinja', time.perf_counter() - stack.pop())
+
+    # Local functions: keep strong references so blinker doesn't drop them
+    before_render_template.connect(_before_template, app, weak=False)
+    template_rendered.connect(_after_template, app, weak=False)
+
+    @app.after_request
+    def _finish_request(response):
+        profile = _stop_profiler(app)
+        if profile:
+            response.headers['X-Profile-File'] = profile
+
+        started = g.get('request_started')
+        if started is None:
+            return response
+        total = time.perf_counter() - started
+        endpoint = request.endpoint or 'unknown'
+        metrics.observe('study_web_request_duration_seconds', total,
+                        endpoint=endpoint, method=request.method)
+        metrics.inc('study_web_requests_total', endpoint=endpoint, method=request.method,
+                    status=response.status_code)
+        # Static files skip the session lookup, which would add Vary: Cookie
+        if app.config['SERVER_TIMING'] or (endpoint != 'static' and session.get('is_admin')):
+            response.headers['Server-Timing'] = _server_timing(g.get('timings', {}), total)
+        return response
+
+    @app.teardown_request
+    def _discard_profiler(exc):
+        # The request failed before after_request could stop it
+        profiler = g.pop('profiler', None)
+        if isinstance(profiler, cProfile.Profile):
+            profiler.disable()
+        elif profiler is not None:
+            profiler.stop()
+
+    if app.config['METRICS_ENABLED']:
+        @app.route('/metrics')
+        def prometheus_metrics():
+            token = app.config['METRICS_TOKEN']
+            if token or not app.config['METRICS_PUBLIC']:
+                if not (token and request.headers.get('Authorization') == f'Bearer {token}') \
+                        and not session.get('is_admin'):
+                    return Response('Forbidden\n', status=403, mimetype='text/plain')
+            return Response(metrics.render(_cache_counters()),
+                            mimetype='text/plain; version=0.0.4')
+
+    if not limit:
+        return
+
+    @app.after_request
+    def _check_query_count(response):
+        # Writes legitimately fan out (FTS, tags, version stamps); the guard
+        # is meant for read paths, where a growing count means N+1.
+        if request.method not in ('GET', 'HEAD'):
+            return response
+        statements = g.get('sql_statements', [])
+        if len(statements) <= limit:
+            return response
+        message = f'{request.method} {request.path} issued {len(statements)} SQL statements (limit {limit})'
+        if app.config['QUERY_COUNT_RAISE']:
+            raise QueryCountExceeded(message + ':\n' + '\n'.join(statements))
+        app.logger.warning('%s; possible N+1 query', message)
+        return response
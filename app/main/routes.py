@@ -1,68 +1,109 @@
-from flask import render_template, request, current_app, session, jsonify, flash, redirect, url_for
+from flask import render_template, request, current_app, session, jsonify, flash, redirect, url_for, make_response
 from . import main
 from .. import db
-from ..models import LearningNote, Category
+from ..models import LearningNote, Category, Tag, note_tags
+from ..rendering import render_cache
+from ..caching import category_cache, page_cache
+from ..images import image_processor
+from ..search import search_notes
+from ..suggest import suggest_index
+from ..pagination import KeysetPage, count_cache, paginate_by_updated
+from ..database import read_only
 
 @main.app_context_processor
 def inject_categories():
     """Injects categories into all templates."""
     try:
-        categories = Category.query.order_by(Category.name).all()
-        return dict(categories=categories)
+        return dict(categories=category_cache.get())
     except Exception:
         # Return an empty list if the database isn't set up yet
         return dict(categories=[])
 
+def _listing_response(page, count_key, **context):
+    """Render a page of note cards, or only the cards for infinite scroll."""
+    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
+        response = make_response(render_template('_note_cards.html', notes=page.items,
+                                                  snippets=page.snippets))
+        if page.next_cursor:
+            response.headers['X-Next-Cursor'] = page.next_cursor
+        return response
+
+    total = None
+    if not request.args.get('cursor'):
+        # Only the first page shows the (cached, approximate) total
+        total = count_cache.get(count_key, page.count, current_app.config['LISTING_COUNT_TTL'])
+    return render_template('index.html', notes=page.items, next_cursor=page.next_cursor,
+                           snippets=page.snippets, total=total, **context)
+
 @main.route('/')
+@read_only
 def index():
     NOTES_PER_PAGE = current_app.config['NOTES_PER_PAGE']
-    page = request.args.get('page', 1, type=int)
-    pagination = LearningNote.query.order_by(LearningNote.updated_at.desc()).paginate(
-        page=page, per_page=NOTES_PER_PAGE, error_out=False
-    )
-    notes = pagination.items
+    cursor = request.args.get('cursor')
+    page = paginate_by_updated(LearningNote.eager_query(), LearningNote, cursor, NOTES_PER_PAGE)
 
-    if request.headers.get('X-Requested-With') == 'XMLHttpRequest':
-        return render_template('_note_cards.html', notes=notes)
-
-    return render_template('index.html', notes=notes, pagination=pagination)
+    tag_cloud = []
+    if not cursor and request.headers.get('X-Requested-With') != 'XMLHttpRequest':
+        tag_cloud = Tag.query.filter(Tag.note_count > 0).order_by(
+            Tag.note_count.desc(), Tag.name
+        ).limit(current_app.config['TAG_CLOUD_SIZE']).all()
+    return _listing_response(page, ('index',), tag_cloud=tag_cloud)
 
 @main.route('/search')
+@read_only
 def search():
     NOTES_PER_PAGE = current_app.config['NOTES_PER_PAGE']
     query = request.args.get('q', '')
-    page = request.args.get('page', 1, type=int)
+    cursor = request.args.get('cursor')
 
     if query:
-        search_query = LearningNote.query.filter(
-            LearningNote.title.ilike(f'%{query}%') |
-            LearningNote.content.ilike(f'%{query}%') |
-            LearningNote.tags.ilike(f'%{query}%')
-        ).order_by(LearningNote.updated_at.desc())
-        
-        pagination = search_query.paginate(
-            page=page, per_page=NOTES_PER_PAGE, error_out=False
-        )
-        notes = pagination.items
+        page = search_notes(query, cursor, NOTES_PER_PAGE)
     else:
-        notes = []
-        pagination = None
+        page = KeysetPage([])
+
+    return _listing_response(page, ('search', query), search_query=query)
 
-    return render_template('index.html', notes=notes, search_query=query, pagination=pagination)
+@main.route('/search/suggest')
+@read_only
+def search_suggest():
+    """Titles, tags and categories matching what has been typed so far, from memory."""
+    limit = request.args.get('limit', type=int) or current_app.config['SUGGEST_LIMIT']
+    limit = max(1, min(limit, current_app.config['SUGGEST_MAX_LIMIT']))
+    query = request.args.get('q', '')[:100]
+    results = suggest_index.suggest(query, limit)
+    return jsonify({
+        'query': query,
+        'notes': [{'id': entry.id, 'title': entry.label, 'url': url_for('notes.view_note', id=entry.id)}
+                  for entry in results['notes']],
+        'tags': [{'name': entry.label, 'count': entry.weight,
+                  'url': url_for('main.tag_view', tag_name=entry.label)} for entry in results['tags']],
+        'categories': [{'name': entry.label, 'count': entry.weight,
+                        'url': url_for('main.category_view', category_name=entry.label)}
+                       for entry in results['categories']],
+    })
 
 @main.route('/category/<category_name>')
+@read_only
 def category_view(category_name):
     NOTES_PER_PAGE = current_app.config['NOTES_PER_PAGE']
-    page = request.args.get('page', 1, type=int)
-    
+    cursor = request.args.get('cursor')
+
     # Query using the relationship
     category = Category.query.filter_by(name=category_name).first_or_404()
-    pagination = LearningNote.query.with_parent(category).order_by(LearningNote.updated_at.desc()).paginate(
-        page=page, per_page=NOTES_PER_PAGE, error_out=False
-    )
-    
-    notes = pagination.items
-    return render_template('index.html', notes=notes, current_category=category_name, pagination=pagination)
+    page = paginate_by_updated(LearningNote.eager_query().with_parent(category), LearningNote,
+                               cursor, NOTES_PER_PAGE)
+    return _listing_response(page, ('category', category.id), current_category=category_name)
+
+@main.route('/tag/<path:tag_name>')
+@read_only
+def tag_view(tag_name):
+    NOTES_PER_PAGE = current_app.config['NOTES_PER_PAGE']
+    cursor = request.args.get('cursor')
+
+    tag = Tag.query.filter_by(name=tag_name).first_or_404()
+    query = LearningNote.eager_query().join(note_tags).filter(note_tags.c.tag_id == tag.id)
+    page = paginate_by_updated(query, LearningNote, cursor, NOTES_PER_PAGE)
+    return _listing_response(page, ('tag', tag.id), current_tag=tag.name)
 
 @main.route('/check_admin', methods=['POST'])
 def check_admin():
@@ -83,3 +124,15 @@ def admin_logout():
     session.pop('is_admin', None)
     flash('您已登出管理員模式。', 'info')
     return redirect(url_for('main.index'))
+
+@main.route('/admin/cache_stats')
+def cache_stats():
+    if not session.get('is_admin'):
+        return jsonify({'error': 'Admin privileges required.'}), 403
+    return jsonify({
+        'render': render_cache.stats(),
+        'categories': category_cache.stats(),
+        'pages': page_cache.stats(),
+        'images': image_processor.stats(),
+        'suggest': suggest_index.stats(),
+    })
@@ -0,0 +1,62 @@
+"""Markdown extension that serves uploaded images through <picture> variants."""
+import re
+from xml.etree import ElementTree as etree
+
+from markdown.extensions import Extension
+from markdown.treeprocessors import Treeprocessor
+
+from . import rendering
+from .images import DIGEST_LENGTH, find_variants
+
+_UPLOADED_IMAGE = re.compile(r'^(?P<base>.*/static/images/)(?P<digest>[0-9a-f]{%d})\.\w+$' % DIGEST_LENGTH)
+# MIME types in the order the browser should prefer them
+_VARIANT_TYPES = (('avif', 'image/avif'), ('webp', 'image/webp'))
+
+
+class ResponsiveImageProcessor(Treeprocessor):
+    """Wrap uploaded images that have generated variants in <picture>."""
+
+    def run(self, root):
+        if rendering.images_dir is None:
+            return
+        # Collected first: the tree must not be walked while it is rewritten
+        images = [(parent, child) for parent in root.iter() for child in parent if child.tag == 'img']
+        for parent, img in images:
+            picture = self._picture(img)
+            if picture is not None:
+                index = list(parent).index(img)
+                picture.tail, img.tail = img.tail, None
+                parent.remove(img)
+                parent.insert(index, picture)
+
+    def _picture(self, img):
+        match = _UPLOADED_IMAGE.match(img.get('src', ''))
+        if not match:
+            return None
+        variants = find_variants(rendering.images_dir, match.group('digest'))
+        if not variants:
+            return None
+        picture = etree.Element('picture')
+        base, digest = match.group('base'), match.group('digest')
+        largest = 0
+        for fmt, mime in _VARIANT_TYPES:
+            widths = variants.get(fmt)
+            if not widths:
+                continue
+            largest = max(largest, widths[-1])
+            srcset = ', '.join(f'{base}{digest}-{width}.{fmt} {width}w' for width in widths)
+            etree.SubElement(picture, 'source', type=mime, srcset=srcset)
+        if not len(picture):
+            return None
+        for source in picture:
+            source.set('sizes', f'(max-width: {largest}px) 100vw, {largest}px')
+        img.set('loading', 'lazy')
+        img.set('decoding', 'async')
+        picture.append(img)
+        return picture
+
+
+class ResponsiveImageExtension(Extension):
+    def extendMarkdown(self, md):
+        # After 'inline' (which creates the <img> elements), before 'prettify'
+        md.treeprocessors.register(ResponsiveImageProcessor(md), 'responsive_images', 15)
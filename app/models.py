@@ -1,15 +1,122 @@
 from . import db
+from .rendering import RENDER_VERSION, render_markdown, markdown_excerpt, excerpt_cache
 from datetime import datetime
+from flask import current_app
 import json
 
+def parse_tags(raw):
+    """Tag names from a Tagify JSON value or a comma-separated string."""
+    if not raw: # If tags is None or empty string
+        return []
+    try:
+        tags_list = json.loads(raw)
+        if isinstance(tags_list, list) and all(isinstance(tag, dict) and 'value' in tag for tag in tags_list):
+            return [tag['value'] for tag in tags_list]
+        else:
+            # Fallback for non-Tagify JSON or other formats
+            return [tag.strip() for tag in raw.split(',')]
+    except json.JSONDecodeError:
+        # If not valid JSON, treat as comma-separated string
+        return [tag.strip() for tag in raw.split(',')]
+
+def normalize_tag_names(raw):
+    """Distinct, non-empty tag names from a raw tags value, in input order."""
+    names = []
+    for name in parse_tags(raw):
+        name = name.strip()[:Tag.name.type.length]
+        if name and name not in names:
+            names.append(name)
+    return names
+
+note_tags = db.Table(
+    'note_tag',
+    db.Column('note_id', db.Integer, db.ForeignKey('learning_note.id'), primary_key=True),
+    db.Column('tag_id', db.Integer, db.ForeignKey('tag.id'), primary_key=True),
+    # The primary key serves note -> tags; this one serves tag -> notes
+    db.Index('ix_note_tag_tag_id_note_id', 'tag_id', 'note_id'),
+)
+
+# Inverted index of each note's weighted terms (see app/relations.py)
+note_terms = db.Table(
+    'note_term',
+    db.Column('term', db.String(64), primary_key=True),
+    db.Column('note_id', db.Integer, db.ForeignKey('learning_note.id'), primary_key=True),
+    db.Column('weight', db.Float, nullable=False),
+    db.Index('ix_note_term_note_id', 'note_id'),
+)
+
+# Precomputed "related" and "linked from" lists, read by view_note in one lookup;
+# kind is 'related' or 'backlink' (other_id links to note_id)
+note_relations = db.Table(
+    'note_relation',
+    db.Column('note_id', db.Integer, db.ForeignKey('learning_note.id'), primary_key=True),
+    db.Column('kind', db.String(10), primary_key=True),
+    db.Column('other_id', db.Integer, db.ForeignKey('learning_note.id'), primary_key=True),
+    db.Column('score', db.Float, nullable=False, default=0.0),
+    # Removing a note from every list it appears in
+    db.Index('ix_note_relation_other_id', 'other_id'),
+)
+
+# Uploaded images each note embeds, by file name (see app/image_refs.py)
+note_images = db.Table(
+    'note_image',
+    db.Column('note_id', db.Integer, db.ForeignKey('learning_note.id'), primary_key=True),
+    db.Column('filename', db.String(255), primary_key=True),
+    db.Index('ix_note_image_filename', 'filename'),
+)
+
+class Tag(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False, unique=True)
+    # Maintained on flush (see _refresh_tag_counts) for the tag cloud
+    note_count = db.Column(db.Integer, nullable=False, default=0, server_default='0', index=True)
+
+    def __repr__(self):
+        return f'<Tag {self.name}>'
+
+class CacheVersion(db.Model):
+    """Version stamps shared by all worker processes for invalidating local caches."""
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<CacheVersion {self.name}={self.version}>'
+
+class ImportCheckpoint(db.Model):
+    """Records of an import file already committed, written in each batch's transaction."""
+    # sha256 of the source file's path, size and mtime
+    source = db.Column(db.String(64), primary_key=True)
+    done = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<ImportCheckpoint {self.source[:8]}={self.done}>'
+
 class Category(db.Model):
+    __table_args__ = (
+        # Case-insensitive name lookups in add_category (see name_matches)
+        db.Index('ix_category_name_lower', db.func.lower(db.text('name'))),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(100), nullable=False, unique=True)
 
     def __repr__(self):
         return f'<Category {self.name}>'
 
+    @classmethod
+    def name_matches(cls, name):
+        """Case-insensitive equality on the name that can use ix_category_name_lower."""
+        # Fold both sides in the database so they agree on what lower() means
+        return db.func.lower(cls.name) == db.func.lower(name)
+
 class LearningNote(db.Model):
+    __table_args__ = (
+        # Keyset pagination on the listings walks this index newest first
+        db.Index('ix_learning_note_updated_at_id', 'updated_at', 'id'),
+        # The same walk within one category (category_view)
+        db.Index('ix_learning_note_category_id_updated_at_id', 'category_id', 'updated_at', 'id'),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(200), nullable=False)
     
@@ -19,23 +126,132 @@ class LearningNote(db.Model):
 
     content = db.Column(db.Text, nullable=False)
     tags = db.Column(db.String(200))
+    tag_objects = db.relationship('Tag', secondary=note_tags, order_by='Tag.name',
+                                  backref=db.backref('notes', lazy='dynamic'))
+
+    # Derived from `content` on save; see refresh_render()
+    content_html = db.Column(db.Text)
+    excerpt = db.Column(db.String(300))
+    render_version = db.Column(db.String(32))
+
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
 
     def __repr__(self):
         return f'<LearningNote {self.title}>'
 
+    @classmethod
+    def eager_query(cls):
+        """Query that loads everything a note card touches up front (no N+1)."""
+        return cls.query.options(
+            db.joinedload(cls.category),
+            db.selectinload(cls.tag_objects)
+        )
+
     @property
     def processed_tags(self):
-        if not self.tags: # If tags is None or empty string
-            return []
-        try:
-            tags_list = json.loads(self.tags)
-            if isinstance(tags_list, list) and all(isinstance(tag, dict) and 'value' in tag for tag in tags_list):
-                return [tag['value'] for tag in tags_list]
-            else:
-                # Fallback for non-Tagify JSON or other formats
-                return [tag.strip() for tag in self.tags.split(',')]
-        except json.JSONDecodeError:
-            # If not valid JSON, treat as comma-separated string
-            return [tag.strip() for tag in self.tags.split(',')]
\ No newline at end of file
+        names = [tag.name for tag in self.tag_objects]
+        # Rows not yet converted by migrate_tags.py only have the raw string
+        return names or normalize_tag_names(self.tags)
+
+    def set_tags(self, raw):
+        """Store the raw tags value and link the note to the matching Tag rows."""
+        names = normalize_tag_names(raw)
+        existing = {tag.name: tag for tag in Tag.query.filter(Tag.name.in_(names))} if names else {}
+        self.tag_objects = [existing.get(name) or Tag(name=name) for name in names]
+        self.tags = raw
+
+    @property
+    def is_render_current(self):
+        return self.content_html is not None and self.render_version == RENDER_VERSION
+
+    def refresh_render(self):
+        """Store the sanitized HTML and plain-text excerpt for the current content."""
+        self.content_html = render_markdown(self.content)
+        self.excerpt = markdown_excerpt(self.content, current_app.config['EXCERPT_LENGTH'])
+        self.render_version = RENDER_VERSION
+
+    @property
+    def rendered_html(self):
+        if self.is_render_current:
+            return self.content_html
+        # Row predates the current render configuration; the background
+        # refresh will persist it, meanwhile render through the cache.
+        return render_markdown(self.content)
+
+    @property
+    def summary(self):
+        """Plain-text teaser for note cards; never renders HTML."""
+        if self.is_render_current:
+            return self.excerpt
+        # Memoized per note version until the stored excerpt is refreshed
+        key = (self.id, self.updated_at, RENDER_VERSION)
+        text = excerpt_cache.get(key)
+        if text is None:
+            text = markdown_excerpt(self.content, current_app.config['EXCERPT_LENGTH'])
+            excerpt_cache.set(key, text)
+        return text
+
+
+class NoteRevision(db.Model):
+    """One saved version of a note's title and content; encoded by app/revisions.py."""
+    __table_args__ = (
+        db.UniqueConstraint('note_id', 'number', name='uq_note_revision_note_id_number'),
+    )
+
+    id = db.Column(db.Integer, primary_key=True)
+    note_id = db.Column(db.Integer, db.ForeignKey('learning_note.id'), nullable=False)
+    # 1, 2, ... per note; kept when older revisions are pruned
+    number = db.Column(db.Integer, nullable=False)
+    title = db.Column(db.String(200), nullable=False)
+    # 'full' stores the whole content, 'delta' line edits against the previous revision
+    kind = db.Column(db.String(5), nullable=False)
+    codec = db.Column(db.String(10), nullable=False)
+    # Deltas since the last full revision, so reconstruction stays bounded
+    chain = db.Column(db.Integer, nullable=False, default=0)
+    data = db.Column(db.LargeBinary, nullable=False)
+    size = db.Column(db.Integer, nullable=False)  # Content size in UTF-8 bytes
+    content_hash = db.Column(db.String(40), nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    def __repr__(self):
+        return f'<NoteRevision {self.note_id}#{self.number}>'
+
+
+@db.event.listens_for(LearningNote, 'before_insert')
+def _render_new_note(mapper, connection, note):
+    note.refresh_render()
+
+
+@db.event.listens_for(LearningNote, 'before_update')
+def _render_updated_note(mapper, connection, note):
+    content_changed = db.inspect(note).attrs.content.history.has_changes()
+    if content_changed or not note.is_render_current:
+        note.refresh_render()
+
+
+@db.event.listens_for(LearningNote.tag_objects, 'append')
+@db.event.listens_for(LearningNote.tag_objects, 'remove')
+def _track_tag_change(note, tag, initiator):
+    session = db.object_session(note) or db.session()
+    session.info.setdefault('tags_to_count', set()).add(tag)
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def _track_deleted_note_tags(session, flush_context, instances):
+    for obj in session.deleted:
+        if isinstance(obj, LearningNote):
+            session.info.setdefault('tags_to_count', set()).update(obj.tag_objects)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _refresh_tag_counts(session, flush_context):
+    tags = session.info.pop('tags_to_count', None)
+    tag_ids = [tag.id for tag in tags or () if tag.id is not None]
+    if not tag_ids:
+        return
+    tag_table = Tag.__table__
+    count = db.select(db.func.count()).where(note_tags.c.tag_id == tag_table.c.id).scalar_subquery()
+    session.connection().execute(
+        tag_table.update().where(tag_table.c.id.in_(tag_ids)).values(note_count=count)
+    )
@@ -1,18 +1,33 @@
-from flask import render_template, request, redirect, url_for, flash, jsonify, current_app, session
+from flask import render_template, request, redirect, url_for, flash, jsonify, current_app, session, abort
 from . import notes
 from .. import db
-from ..models import LearningNote, Category
+from ..models import LearningNote, Category, NoteRevision
+from ..rendering import RENDER_VERSION, render_cache
+from ..caching import category_cache, page_cache
+from ..images import image_processor, is_valid_image, content_filename
+from ..database import read_only
+from ..revisions import RevisionError, revision_store
+from ..relations import note_relations_for
 from datetime import datetime
+import hashlib
 import json
 import os
 import uuid
 from werkzeug.utils import secure_filename
-from PIL import Image
 
 
 def allowed_file(filename):
     return '.' in filename and            filename.rsplit('.', 1)[1].lower() in current_app.config['ALLOWED_EXTENSIONS']
 
+def _release_rendering(note):
+    """Free the cache slot of a body that is being replaced, unless another note has it too."""
+    # The cache is keyed on content alone, so a copied note or template shares the entry
+    shared = db.session.execute(
+        db.select(LearningNote.id).where(LearningNote.content == note.content, LearningNote.id != note.id).limit(1)
+    ).first()
+    if shared is None:
+        render_cache.discard(note.content)
+
 @notes.route('/add', methods=['GET', 'POST'])
 def add_note():
     if not session.get('is_admin'):
@@ -28,28 +43,66 @@ def add_note():
         if not all([title, category_id, content]):
             flash('標題、分類和內容為必填欄位。', 'danger')
             # Repopulate categories for the template
-            categories = Category.query.order_by(Category.name).all()
+            categories = category_cache.get()
             return render_template('add_note.html', categories=categories, note=request.form), 400
 
         note = LearningNote(
             title=title,
             category_id=category_id,
-            content=content,
-            tags=tags
+            content=content
         )
+        note.set_tags(tags)
         
         db.session.add(note)
         db.session.commit()
         flash('學習筆記已成功新增！', 'success')
         return redirect(url_for('main.index'))
     
-    categories = Category.query.order_by(Category.name).all()
+    categories = category_cache.get()
     return render_template('add_note.html', categories=categories)
 
 @notes.route('/<int:id>')
+@read_only
 def view_note(id):
-    note = LearningNote.query.get_or_404(id)
-    return render_template('view_note.html', note=note)
+    # Only the timestamp is needed to answer a conditional request
+    row = db.session.execute(
+        db.select(LearningNote.updated_at).where(LearningNote.id == id)
+    ).first()
+    if row is None:
+        abort(404)
+    updated_at = row.updated_at
+    # Other notes' edits change these panels without touching this note
+    relations = note_relations_for(id)
+
+    category_cache.get()
+    is_admin = bool(session.get('is_admin'))
+    # The sidebar (categories), admin links and related notes are part of the page too
+    stamp = (updated_at, RENDER_VERSION, category_cache.version, is_admin,
+             tuple(map(tuple, relations.values())))
+    etag = hashlib.sha1(repr((id,) + stamp).encode('utf-8')).hexdigest()
+
+    response = current_app.response_class(mimetype='text/html')
+    response.set_etag(etag)
+    response.last_modified = updated_at
+    response.cache_control.no_cache = True
+    response.vary.add('Cookie')
+
+    # Pending flash messages are rendered into the page, so skip both caches
+    has_flashes = '_flashes' in session
+    if not has_flashes:
+        response.make_conditional(request)
+        if response.status_code == 304:
+            return response
+
+    cacheable = not is_admin and not has_flashes
+    body = page_cache.get(id, stamp) if cacheable else None
+    if body is None:
+        note = LearningNote.eager_query().filter_by(id=id).first_or_404()
+        body = render_template('view_note.html', note=note, relations=relations)
+        if cacheable:
+            page_cache.set(id, stamp, body)
+    response.set_data(body)
+    return response
 
 @notes.route('/<int:id>/edit', methods=['GET', 'POST'])
 def edit_note(id):
@@ -65,25 +118,28 @@ def edit_note(id):
 
         if not all([title, category_id, content]):
             flash('標題、分類和內容為必填欄位。', 'danger')
-            categories = Category.query.order_by(Category.name).all()
+            categories = category_cache.get()
             # Pass the current note object so the form can be repopulated
             return render_template('edit_note.html', note=note, categories=categories), 400
 
+        if note.content != content:
+            _release_rendering(note)
+
         note.title = title
         note.category_id = category_id
         note.content = request.form['content']
-        note.tags = request.form['tags']
+        note.set_tags(request.form['tags'])
         note.updated_at = datetime.utcnow()
         
         db.session.commit()
         flash('學習筆記已成功更新！', 'success')
         return redirect(url_for('.view_note', id=id))
     
-    categories = Category.query.order_by(Category.name).all()
+    categories = category_cache.get()
     return render_template('edit_note.html', note=note, categories=categories)
 
 
-@notes.route('/<int:id>/delete')
+@notes.route('/<int:id>/delete', methods=['POST'])
 def delete_note(id):
     note = LearningNote.query.get_or_404(id)
     db.session.delete(note)
@@ -91,6 +147,53 @@ def delete_note(id):
     flash('學習筆記已成功刪除！', 'success')
     return redirect(url_for('main.index'))
 
+@notes.route('/<int:id>/revisions')
+def note_revisions(id):
+    if not session.get('is_admin'):
+        flash('此操作需要管理員權限。', 'warning')
+        return redirect(url_for('main.index'))
+    note = LearningNote.query.get_or_404(id)
+    return render_template('note_revisions.html', note=note, revisions=revision_store.history(id))
+
+
+@notes.route('/<int:id>/revisions/<int:number>')
+def view_revision(id, number):
+    if not session.get('is_admin'):
+        flash('此操作需要管理員權限。', 'warning')
+        return redirect(url_for('main.index'))
+    note = LearningNote.query.get_or_404(id)
+    revision = NoteRevision.query.filter_by(note_id=id, number=number).first_or_404()
+    try:
+        content = revision_store.content(id, number)
+    except RevisionError as exc:
+        flash(f'無法讀取第 {number} 版：{exc}', 'danger')
+        return redirect(url_for('.note_revisions', id=id))
+    return render_template('view_revision.html', note=note, revision=revision,
+                           content_html=render_cache.render(content))
+
+
+@notes.route('/<int:id>/revisions/<int:number>/restore', methods=['POST'])
+def restore_revision(id, number):
+    if not session.get('is_admin'):
+        flash('此操作需要管理員權限。', 'warning')
+        return redirect(url_for('main.index'))
+    note = LearningNote.query.get_or_404(id)
+    revision = NoteRevision.query.filter_by(note_id=id, number=number).first_or_404()
+    try:
+        content = revision_store.content(id, number)
+    except RevisionError as exc:
+        flash(f'無法還原第 {number} 版：{exc}', 'danger')
+        return redirect(url_for('.note_revisions', id=id))
+    if note.content != content:
+        _release_rendering(note)
+    # Saved as a new revision, so the restore itself can be undone
+    note.title = revision.title
+    note.content = content
+    note.updated_at = datetime.utcnow()
+    db.session.commit()
+    flash(f'已還原至第 {number} 版。', 'success')
+    return redirect(url_for('.view_note', id=id))
+
 @notes.route('/api/add_category', methods=['POST'])
 def add_category():
     data = request.get_json()
@@ -99,7 +202,7 @@ def add_category():
     
     name = data['name'].strip()
     
-    existing_category = Category.query.filter(Category.name.ilike(name)).first()
+    existing_category = Category.query.filter(Category.name_matches(name)).first()
     if existing_category:
         # Return the existing category's data
         return jsonify({
@@ -131,22 +234,31 @@ def upload_image():
     if file and file.filename and allowed_file(file.filename):
         filename = secure_filename(file.filename)
         ext = filename.rsplit('.', 1)[1].lower()
-        unique_filename = f"{uuid.uuid4()}.{ext}"
         
         upload_folder = os.path.join(current_app.static_folder, 'images')
         os.makedirs(upload_folder, exist_ok=True)
         
+        if not is_valid_image(file.stream):
+            return jsonify({'error': 'Uploaded file is not a valid image'}), 400
+
         try:
+            # Identical uploads resolve to the file that is already stored
+            unique_filename = content_filename(file.stream, ext)
             filepath = os.path.join(upload_folder, unique_filename)
-            img = Image.open(file.stream)
-            
-            if img.width > current_app.config['MAX_IMAGE_WIDTH']:
-                width_percent = (current_app.config['MAX_IMAGE_WIDTH'] / float(img.size[0]))
-                hsize = int((float(img.size[1]) * float(width_percent)))
-                img = img.resize((current_app.config['MAX_IMAGE_WIDTH'], hsize), Image.LANCZOS)
-            
-            img.save(filepath, quality=current_app.config['IMAGE_QUALITY'])
             location = url_for('static', filename=f'images/{unique_filename}', _external=True)
+            if os.path.exists(filepath):
+                image_processor.duplicates += 1
+                # Restart the garbage collector's grace period for the file
+                os.utime(filepath)
+                return jsonify({'location': location})
+
+            # Unique per request: the same image may be uploaded twice at once
+            tmp_path = f'{filepath}.{uuid.uuid4().hex}.upload'
+            file.save(tmp_path)
+            os.replace(tmp_path, filepath)
+
+            # The original is served at this URL until the resized image replaces it
+            image_processor.submit(filepath)
             return jsonify({'location': location})
         except Exception as e:
             return jsonify({'error': f'Failed to save file: {str(e)}'}), 500
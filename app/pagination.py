@@ -0,0 +1,103 @@
+import base64
+import json
+import time
+import threading
+from datetime import datetime
+
+import sqlalchemy as sa
+
+
+def encode_cursor(*values):
+    """Opaque, URL-safe token for the sort key of the last row on a page."""
+    payload = [v.isoformat() if isinstance(v, datetime) else v for v in values]
+    raw = json.dumps(payload, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    """Inverse of encode_cursor(); returns None for a missing or malformed token."""
+    if not token:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        values = json.loads(raw)
+    except (ValueError, TypeError):
+        return None
+    return values if isinstance(values, list) else None
+
+
+class KeysetPage:
+    """
+    One page of a cursor-paginated listing.
+
+    `count_query` is a callable returning the total number of matching rows;
+    it is only invoked when a view asks for count().
+    """
+
+    def __init__(self, items, next_cursor=None, count_query=None, snippets=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.count_query = count_query
+        self.snippets = snippets or {}
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def count(self):
+        return self.count_query() if self.count_query else len(self.items)
+
+    def __iter__(self):
+        return iter(self.items)
+
+
+def paginate_by_updated(query, model, cursor, per_page):
+    """
+    Page through `query` newest first on (updated_at, id).
+
+    Each page is a single indexed range scan: no OFFSET and no COUNT.
+    """
+    count_query = query.order_by(None).count
+    query = query.order_by(model.updated_at.desc(), model.id.desc())
+    values = decode_cursor(cursor)
+    if values and len(values) == 2:
+        try:
+            updated_at = datetime.fromisoformat(values[0])
+            last_id = int(values[1])
+        except (TypeError, ValueError):
+            pass
+        else:
+            query = query.filter(sa.tuple_(model.updated_at, model.id) < (updated_at, last_id))
+
+    rows = query.limit(per_page + 1).all()
+    items = rows[:per_page]
+    next_cursor = None
+    if len(rows) > per_page:
+        next_cursor = encode_cursor(items[-1].updated_at, items[-1].id)
+    return KeysetPage(items, next_cursor, count_query)
+
+
+class CountCache:
+    """Row counts cached for a short time; listings only show them as a hint."""
+
+    def __init__(self):
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def get(self, key, compute, ttl):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+        if entry and entry[1] > now:
+            return entry[0]
+        value = compute()
+        with self._lock:
+            self._data[key] = (value, now + ttl)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+
+count_cache = CountCache()
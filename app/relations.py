@@ -0,0 +1,355 @@
+import math
+import re
+from collections import Counter
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import AppGroup
+
+from . import db
+from .models import LearningNote, Tag, note_relations, note_tags, note_terms
+from .rendering import markdown_plaintext
+from .search import _CJK
+
+relations_cli = AppGroup('relations', help='Maintain the related-notes and backlink index.')
+
+# Title words count this many times over body words
+TITLE_BOOST = 3
+
+_CJK_RUN = re.compile(f'[{_CJK}]+')
+_LATIN_WORD = re.compile(r'[a-z][a-z0-9+#]*(?:[._-][a-z0-9+#]+)*')
+_STOPWORDS = frozenset(
+    'an and are as at be but by for from has have if in into is it its of on or that the '
+    'their then there these this to was were will with'.split()
+)
+# Markdown links, autolinks and HTML links to a note page, on any host
+_NOTE_LINK = re.compile(r'''(?:\]\(\s*<?|<|href=["'])(?:https?://[^/\s)>"']+)?/notes/(\d+)\b''')
+
+_relations_ready = set()
+
+
+def relations_available(connection):
+    url = str(connection.engine.url)
+    if url in _relations_ready:
+        return True
+    inspector = sa.inspect(connection)
+    if not (inspector.has_table(note_terms.name) and inspector.has_table(note_relations.name)):
+        return False
+    _relations_ready.add(url)
+    return True
+
+
+def _tokens(text):
+    text = text.lower()
+    for word in _LATIN_WORD.findall(_CJK_RUN.sub(' ', text)):
+        if len(word) > 1 and word not in _STOPWORDS:
+            yield word[:64]
+    # No word boundaries in CJK text: overlapping bigrams stand in for words
+    for run in _CJK_RUN.findall(text):
+        if len(run) == 1:
+            yield run
+        for index in range(len(run) - 1):
+            yield run[index:index + 2]
+
+
+def extract_terms(title, content, limit=48):
+    """
+    The note's `limit` most frequent terms with L2-normalized 1 + log(tf)
+    weights. Document frequencies change with every note, so IDF is applied
+    when the terms are compared, not stored.
+    """
+    counts = Counter(_tokens(markdown_plaintext(content, keep_code=True)))
+    for term in _tokens(title or ''):
+        counts[term] += TITLE_BOOST
+    weights = {term: 1 + math.log(count) for term, count in counts.most_common(limit)}
+    norm = math.sqrt(sum(weight * weight for weight in weights.values())) or 1.0
+    return {term: weight / norm for term, weight in weights.items()}
+
+
+def extract_links(content):
+    """Ids of the notes `content` links to."""
+    return {int(note_id) for note_id in _NOTE_LINK.findall(content or '')}
+
+
+def _write_terms(connection, note_id, terms):
+    connection.execute(note_terms.delete().where(note_terms.c.note_id == note_id))
+    if terms:
+        connection.execute(note_terms.insert(), [
+            {'term': term, 'note_id': note_id, 'weight': weight} for term, weight in terms.items()
+        ])
+
+
+def _write_backlinks(connection, note_id, content):
+    connection.execute(note_relations.delete().where(
+        note_relations.c.other_id == note_id, note_relations.c.kind == 'backlink'))
+    targets = extract_links(content) - {note_id}
+    if not targets:
+        return
+    table = LearningNote.__table__
+    existing = connection.execute(sa.select(table.c.id).where(table.c.id.in_(targets))).scalars().all()
+    if existing:
+        connection.execute(note_relations.insert(), [
+            {'note_id': target, 'kind': 'backlink', 'other_id': note_id, 'score': 0.0}
+            for target in existing
+        ])
+
+
+def _candidates(connection, note_id, category_id, tag_ids, terms, exclude=()):
+    """Scores of the notes most similar to one note, best first, leaving out `exclude`."""
+    config = current_app.config
+    limit = config['RELATED_NOTES_LIMIT']
+    max_postings = config['RELATED_MAX_POSTINGS']
+    table = LearningNote.__table__
+    scores = Counter()
+
+    if terms:
+        total = connection.execute(sa.select(sa.func.count()).select_from(table)).scalar() or 1
+        doc_freq = dict(connection.execute(
+            sa.select(note_terms.c.term, sa.func.count())
+            .where(note_terms.c.term.in_(list(terms))).group_by(note_terms.c.term)
+        ).all())
+        # Terms only this note has can't match anything; very common ones
+        # match too much to mean anything
+        query = {term: weight * math.log((total + 1) / doc_freq[term])
+                 for term, weight in terms.items() if 1 < doc_freq.get(term, 0) <= max_postings}
+        query = dict(sorted(query.items(), key=lambda item: item[1],
+                            reverse=True)[:config['RELATED_QUERY_TERMS']])
+        norm = math.sqrt(sum(weight * weight for weight in query.values())) or 1.0
+        if query:
+            postings = connection.execute(
+                sa.select(note_terms.c.note_id, note_terms.c.term, note_terms.c.weight)
+                .where(note_terms.c.term.in_(list(query)), note_terms.c.note_id != note_id)
+            ).all()
+            for other_id, term, weight in postings:
+                scores[other_id] += query[term] / norm * weight
+
+    if tag_ids:
+        tag_table = Tag.__table__
+        useful = connection.execute(
+            sa.select(tag_table.c.id).where(tag_table.c.id.in_(tag_ids), tag_table.c.note_count <= max_postings)
+        ).scalars().all()
+        if useful:
+            shared = connection.execute(
+                sa.select(note_tags.c.note_id, sa.func.count())
+                .where(note_tags.c.tag_id.in_(useful), note_tags.c.note_id != note_id)
+                .group_by(note_tags.c.note_id)
+            ).all()
+            for other_id, count in shared:
+                scores[other_id] += config['RELATED_TAG_WEIGHT'] * count / len(tag_ids)
+
+    # The newest notes of the same category fill in when little else matches
+    newest = connection.execute(
+        sa.select(table.c.id).where(table.c.category_id == category_id, table.c.id != note_id)
+        .order_by(table.c.updated_at.desc(), table.c.id.desc()).limit(limit)
+    ).scalars().all()
+    for other_id in newest:
+        scores.setdefault(other_id, 0.0)
+    for other_id in exclude:
+        scores.pop(other_id, None)
+
+    shortlist = [other_id for other_id, _ in scores.most_common(limit * 4)]
+    if shortlist:
+        same_category = connection.execute(
+            sa.select(table.c.id).where(table.c.id.in_(shortlist), table.c.category_id == category_id)
+        ).scalars().all()
+        for other_id in same_category:
+            scores[other_id] += config['RELATED_CATEGORY_WEIGHT']
+    return [(other_id, scores[other_id]) for other_id in
+            sorted(shortlist, key=lambda other_id: (-scores[other_id], -other_id))[:limit]]
+
+
+def _write_own_related(connection, note_id, related):
+    connection.execute(note_relations.delete().where(
+        note_relations.c.note_id == note_id, note_relations.c.kind == 'related'))
+    if related:
+        connection.execute(note_relations.insert(), [
+            {'note_id': note_id, 'kind': 'related', 'other_id': other_id, 'score': score}
+            for other_id, score in related
+        ])
+
+
+def _referrers(connection, note_id):
+    """Notes whose related list holds `note_id`."""
+    return set(connection.execute(sa.select(note_relations.c.note_id).where(
+        note_relations.c.other_id == note_id, note_relations.c.kind == 'related')).scalars())
+
+
+def _refill_related(connection, note_ids, exclude=()):
+    """Recompute the related lists of `note_ids` alone, e.g. after an entry was taken out."""
+    if not note_ids:
+        return
+    table = LearningNote.__table__
+    rows = connection.execute(
+        sa.select(table.c.id, table.c.category_id).where(table.c.id.in_(note_ids))).all()
+    tags = {}
+    for note_id, tag_id in connection.execute(
+            sa.select(note_tags.c.note_id, note_tags.c.tag_id).where(note_tags.c.note_id.in_(note_ids))):
+        tags.setdefault(note_id, []).append(tag_id)
+    for note_id, category_id in rows:
+        terms = dict(connection.execute(
+            sa.select(note_terms.c.term, note_terms.c.weight).where(note_terms.c.note_id == note_id)
+        ).all())
+        _write_own_related(connection, note_id,
+                           _candidates(connection, note_id, category_id, tags.get(note_id, []), terms, exclude))
+
+
+def _write_related(connection, note_id, related):
+    """
+    Replace the note's related list, and offer the note to each of those
+    notes' lists, which keep their RELATED_NOTES_LIMIT best entries. Notes
+    that listed it but are no longer related get their lists recomputed.
+    """
+    limit = current_app.config['RELATED_NOTES_LIMIT']
+    lost = _referrers(connection, note_id) - {other_id for other_id, _ in related}
+    connection.execute(note_relations.delete().where(
+        note_relations.c.other_id == note_id, note_relations.c.kind == 'related'))
+    _write_own_related(connection, note_id, related)
+    if related:
+        connection.execute(note_relations.insert(), [
+            {'note_id': other_id, 'kind': 'related', 'other_id': note_id, 'score': score}
+            for other_id, score in related
+        ])
+    for other_id, _ in related:
+        keep = (sa.select(note_relations.c.other_id)
+                .where(note_relations.c.note_id == other_id, note_relations.c.kind == 'related')
+                .order_by(note_relations.c.score.desc(), note_relations.c.other_id.desc())
+                .limit(limit))
+        connection.execute(note_relations.delete().where(
+            note_relations.c.note_id == other_id, note_relations.c.kind == 'related',
+            note_relations.c.other_id.not_in(keep)))
+    _refill_related(connection, lost)
+
+
+def index_notes(connection, notes):
+    """
+    Update the index for (id, title, content, category_id, tag ids) tuples
+    on `connection`.
+
+    Only the changed notes and their neighbours are touched; a neighbour
+    the note drops out of has its list recomputed, so it does not keep a gap.
+    """
+    if not notes:
+        return
+    terms = {}
+    limit = current_app.config['RELATED_TERMS_PER_NOTE']
+    # Terms and links first, so notes saved together can find each other
+    for note_id, title, content, _, _ in notes:
+        terms[note_id] = extract_terms(title, content, limit)
+        _write_terms(connection, note_id, terms[note_id])
+        _write_backlinks(connection, note_id, content)
+    for note_id, _, _, category_id, tag_ids in notes:
+        _write_related(connection, note_id,
+                       _candidates(connection, note_id, category_id, tag_ids, terms[note_id]))
+
+
+def remove_note(connection, note_id):
+    lost = _referrers(connection, note_id)
+    connection.execute(note_terms.delete().where(note_terms.c.note_id == note_id))
+    connection.execute(note_relations.delete().where(
+        sa.or_(note_relations.c.note_id == note_id, note_relations.c.other_id == note_id)))
+    # The row is only deleted after this, so keep it out of the new lists
+    _refill_related(connection, lost - {note_id}, exclude={note_id})
+
+
+def note_relations_for(note_id):
+    """
+    {'related': [(id, title), ...], 'backlink': [...]} for one note, read
+    with a single lookup on the note_relation primary key.
+    """
+    result = {'related': [], 'backlink': []}
+    if not relations_available(db.session.connection()):
+        return result
+    table = LearningNote.__table__
+    rows = db.session.execute(
+        sa.select(note_relations.c.kind, table.c.id, table.c.title)
+        .join(table, table.c.id == note_relations.c.other_id)
+        .where(note_relations.c.note_id == note_id)
+        .order_by(note_relations.c.kind, note_relations.c.score.desc(), table.c.title)
+    ).all()
+    for kind, other_id, title in rows:
+        result.setdefault(kind, []).append((other_id, title))
+    return result
+
+
+def rebuild_index(batch_size=200):
+    """Recompute the whole index: every note's terms and links, then every related list."""
+    engine = db.engine
+    table = LearningNote.__table__
+    limit = current_app.config['RELATED_TERMS_PER_NOTE']
+    with engine.begin() as connection:
+        connection.execute(note_relations.delete())
+        connection.execute(note_terms.delete())
+
+    def batches(columns):
+        last_id = 0
+        while True:
+            with engine.begin() as connection:
+                rows = connection.execute(
+                    sa.select(table.c.id, *columns).where(table.c.id > last_id)
+                    .order_by(table.c.id).limit(batch_size)
+                ).all()
+                if not rows:
+                    return
+                yield connection, rows
+            last_id = rows[-1][0]
+
+    total = 0
+    for connection, rows in batches([table.c.title, table.c.content]):
+        for note_id, title, content in rows:
+            _write_terms(connection, note_id, extract_terms(title, content, limit))
+            _write_backlinks(connection, note_id, content)
+        total += len(rows)
+
+    # Every list is computed here, so no note needs another's offered to it
+    for connection, rows in batches([]):
+        _refill_related(connection, [row[0] for row in rows])
+    return total
+
+
+_INDEXED_ATTRIBUTES = ('title', 'content', 'category_id', 'tag_objects')
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def _track_note_changes(session, flush_context, instances):
+    changed = [obj for obj in session.new if isinstance(obj, LearningNote)]
+    for obj in session.dirty:
+        if isinstance(obj, LearningNote):
+            state = db.inspect(obj)
+            if any(state.attrs[name].history.has_changes() for name in _INDEXED_ATTRIBUTES):
+                changed.append(obj)
+    if changed:
+        session.info.setdefault('notes_to_relate', set()).update(changed)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _relate_changed_notes(session, flush_context):
+    # After the flush, so new notes have ids and note_tag rows are written
+    notes = [note for note in session.info.pop('notes_to_relate', ()) if note not in session.deleted]
+    if not notes:
+        return
+    connection = session.connection()
+    if not relations_available(connection):
+        return
+    with session.no_autoflush:
+        rows = [(note.id, note.title, note.content, note.category_id,
+                 [tag.id for tag in note.tag_objects]) for note in notes]
+    index_notes(connection, rows)
+
+
+@db.event.listens_for(LearningNote, 'before_delete')
+def _unrelate_note(mapper, connection, note):
+    if relations_available(connection):
+        remove_note(connection, note.id)
+
+
+def init_app(app):
+    app.cli.add_command(relations_cli)
+
+
+@relations_cli.command('rebuild')
+@click.option('--batch-size', default=200, type=int, help='Rows per transaction.')
+def rebuild_command(batch_size):
+    """Recompute related notes and backlinks for every note."""
+    count = rebuild_index(batch_size)
+    click.echo(f'Indexed {count} notes.')
@@ -0,0 +1,354 @@
+import difflib
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import AppGroup
+
+from . import db
+from .rendering import RENDER_VERSION, markdown_excerpt, render_cache, render_markdown, render_uncached
+from .schema import add_missing_columns
+
+render_cli = AppGroup('render', help='Maintain the pre-rendered note columns.')
+
+_refresh_lock = threading.Lock()
+_refresh_started = False
+
+
+def _update_statement(table):
+    # updated_at is written back unchanged, overriding the column's onupdate.
+    # A note edited since its content was read has a newer updated_at and is
+    # skipped, so HTML of the old text never overwrites the new one.
+    return table.update().where(
+        table.c.id == sa.bindparam('note_id'),
+        table.c.updated_at.is_not_distinct_from(sa.bindparam('old_updated_at')),
+    ).values(
+        content_html=sa.bindparam('content_html'),
+        excerpt=sa.bindparam('excerpt'),
+        render_version=sa.bindparam('render_version'),
+        updated_at=sa.bindparam('old_updated_at'),
+    )
+
+
+def backfill(batch_size=100, only_stale=True):
+    """
+    Re-render notes in id order, committing one batch at a time.
+
+    Uses a Core executemany so that `updated_at` keeps its value instead of
+    being bumped by the column's onupdate default. Notes edited while their
+    batch was rendering are left alone. Returns the number of rows updated.
+    """
+    from .models import LearningNote
+    table = LearningNote.__table__
+    length = current_app.config['EXCERPT_LENGTH']
+    update_stmt = _update_statement(table)
+
+    last_id = 0
+    total = 0
+    while True:
+        query = sa.select(table.c.id, table.c.content, table.c.updated_at) \
+            .where(table.c.id > last_id)
+        if only_stale:
+            query = query.where(sa.or_(
+                table.c.render_version.is_(None),
+                table.c.render_version != RENDER_VERSION
+            ))
+        rows = db.session.execute(query.order_by(table.c.id).limit(batch_size)).all()
+        if not rows:
+            break
+
+        params = []
+        for note_id, content, updated_at in rows:
+            params.append({
+                'note_id': note_id,
+                'content_html': render_markdown(content),
+                'excerpt': markdown_excerpt(content, length),
+                'render_version': RENDER_VERSION,
+                'old_updated_at': updated_at,
+            })
+        total += db.session.execute(update_stmt, params).rowcount
+        db.session.commit()
+
+        last_id = rows[-1][0]
+    return total
+
+
+def rerender_image_notes(digest):
+    """
+    Re-render the notes that embed the upload `digest`, once its variants
+    are on disk. Notes saved before that still hold a plain <img>.
+
+    updated_at is bumped, so page caches and ETags keyed on it are renewed.
+    Returns the number of notes updated.
+    """
+    from .models import LearningNote
+    table = LearningNote.__table__
+    rows = db.session.execute(
+        sa.select(table.c.id, table.c.content, table.c.content_html, table.c.updated_at)
+        .where(table.c.content.contains(f'/static/images/{digest}.'))
+    ).all()
+    params = []
+    for row in rows:
+        html = render_markdown(row.content)
+        if html != row.content_html:
+            params.append({'note_id': row.id, 'content_html': html, 'old_updated_at': row.updated_at})
+    if not params:
+        return 0
+    stmt = table.update().where(
+        table.c.id == sa.bindparam('note_id'),
+        table.c.updated_at.is_not_distinct_from(sa.bindparam('old_updated_at')),
+    ).values(content_html=sa.bindparam('content_html'), render_version=RENDER_VERSION)
+    count = db.session.execute(stmt, params).rowcount
+    db.session.commit()
+    return count
+
+
+def _init_render_worker(images_dir):
+    from . import rendering
+    rendering.images_dir = images_dir
+    # Import markdown/bleach now so the first note timed is not an outlier
+    render_uncached('warm-up')
+
+
+def _render_chunk(rows, excerpt_length):
+    """Process-pool job: render (id, content) rows, bypassing every cache."""
+    results = []
+    for note_id, content in rows:
+        started = time.perf_counter()
+        try:
+            html = render_uncached(content)
+            excerpt = markdown_excerpt(content, excerpt_length)
+            error = None
+        except Exception as exc:
+            html = excerpt = None
+            error = f'{type(exc).__name__}: {exc}'
+        results.append((note_id, html, excerpt, time.perf_counter() - started, error))
+    return results
+
+
+class CheckReport:
+    """What check_renders() found; `notes` maps each changed or failed note id to its details."""
+
+    def __init__(self):
+        self.total = 0
+        self.unchanged = 0
+        self.changed = 0
+        self.new = 0
+        self.failed = 0
+        self.written = 0
+        self.cached = 0
+        self.timings = []
+        self.notes = {}
+
+    def outliers(self, factor=10.0, min_ms=5.0, limit=20):
+        """Notes that took more than `factor` times the median render time (and `min_ms`)."""
+        if not self.timings:
+            return []
+        median = statistics.median(ms for _, _, ms in self.timings)
+        slow = [entry for entry in self.timings if entry[2] >= max(min_ms, median * factor)]
+        return sorted(slow, key=lambda entry: entry[2], reverse=True)[:limit]
+
+
+def _diff(old, new):
+    return list(difflib.unified_diff(old.splitlines(), new.splitlines(), 'stored', 'rendered', lineterm='', n=1))
+
+
+def check_renders(jobs=None, batch_size=100, write=False, warm_cache=False):
+    """
+    Render every note again across a process pool and compare the result
+    with the stored HTML.
+
+    Rows are read in id order, batch_size at a time, and at most two
+    batches per worker are in flight, so memory stays flat however large
+    the corpus is. With `write`, notes whose HTML, excerpt or render
+    version differ are updated (keeping updated_at); with `warm_cache`,
+    every rendering is stored in the render cache.
+    """
+    from .models import LearningNote
+    from . import rendering
+    table = LearningNote.__table__
+    length = current_app.config['EXCERPT_LENGTH']
+    update_stmt = _update_statement(table)
+    jobs = jobs or os.cpu_count() or 1
+    report = CheckReport()
+
+    def chunks():
+        last_id = 0
+        while True:
+            rows = db.session.execute(
+                sa.select(table.c.id, table.c.title, table.c.content, table.c.content_html,
+                          table.c.excerpt, table.c.render_version, table.c.updated_at)
+                .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+            ).all()
+            # Release the read transaction between batches
+            db.session.commit()
+            if not rows:
+                return
+            last_id = rows[-1].id
+            yield rows
+
+    def collect(rows, results):
+        stored = {row.id: row for row in rows}
+        params = []
+        for note_id, html, excerpt, seconds, error in results:
+            row = stored[note_id]
+            report.total += 1
+            report.timings.append((note_id, row.title, seconds * 1000))
+            if error is not None:
+                report.failed += 1
+                report.notes[note_id] = {'title': row.title, 'status': 'failed', 'error': error}
+                continue
+            if row.content and not html.strip():
+                report.failed += 1
+                report.notes[note_id] = {'title': row.title, 'status': 'failed',
+                                         'error': 'Rendered to empty HTML'}
+                continue
+            if row.content_html is None:
+                report.new += 1
+                report.notes[note_id] = {'title': row.title, 'status': 'new'}
+            elif row.content_html != html:
+                report.changed += 1
+                report.notes[note_id] = {'title': row.title, 'status': 'changed',
+                                         'diff': _diff(row.content_html, html)}
+            else:
+                report.unchanged += 1
+            if warm_cache:
+                render_cache.store(row.content, html)
+                report.cached += 1
+            if write and (row.content_html != html or row.excerpt != excerpt
+                          or row.render_version != RENDER_VERSION):
+                params.append({'note_id': note_id, 'content_html': html, 'excerpt': excerpt,
+                               'render_version': RENDER_VERSION, 'old_updated_at': row.updated_at})
+        if params:
+            # Same guarded statement as backfill: notes edited meanwhile are skipped
+            report.written += db.session.execute(update_stmt, params).rowcount
+            db.session.commit()
+
+    pending = deque()
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_init_render_worker,
+                             initargs=(rendering.images_dir,)) as pool:
+        for rows in chunks():
+            job = [(row.id, row.content) for row in rows]
+            pending.append((rows, pool.submit(_render_chunk, job, length)))
+            if len(pending) >= jobs * 2:
+                rows, future = pending.popleft()
+                collect(rows, future.result())
+        while pending:
+            rows, future = pending.popleft()
+            collect(rows, future.result())
+    return report
+
+
+def _background_refresh(app):
+    with app.app_context():
+        try:
+            count = backfill(app.config['RENDER_BATCH_SIZE'], only_stale=True)
+            if count:
+                app.logger.info('Re-rendered %d notes for render version %s', count, RENDER_VERSION)
+        except Exception:
+            # Reads fall back to rendering on the fly, so this is not fatal.
+            app.logger.exception('Background note re-render failed')
+
+
+def start_background_refresh(app):
+    """Re-render outdated rows once per process, off the request thread."""
+    global _refresh_started
+    with _refresh_lock:
+        if _refresh_started:
+            return
+        _refresh_started = True
+    thread = threading.Thread(target=_background_refresh, args=(app,),
+                              name='note-render-refresh', daemon=True)
+    thread.start()
+
+
+def init_app(app):
+    app.cli.add_command(render_cli)
+
+    if app.config['RENDER_BACKGROUND_REFRESH']:
+        @app.before_request
+        def _kick_background_refresh():
+            if not _refresh_started:
+                start_background_refresh(current_app._get_current_object())
+
+
+@render_cli.command('backfill')
+@click.option('--batch-size', default=None, type=int, help='Rows per transaction.')
+@click.option('--all', 'render_all', is_flag=True, help='Re-render every note, not only outdated ones.')
+def backfill_command(batch_size, render_all):
+    """Add the rendered columns if needed and fill them in batches."""
+    from .models import LearningNote
+    db.create_all()
+    added = add_missing_columns(LearningNote.__table__)
+    if added:
+        click.echo(f"Added columns to 'learning_note': {', '.join(added)}")
+
+    batch_size = batch_size or current_app.config['RENDER_BATCH_SIZE']
+    count = backfill(batch_size, only_stale=not render_all)
+    click.echo(f'Rendered {count} notes (render version {RENDER_VERSION}).')
+
+
+@render_cli.command('check')
+@click.option('--jobs', '-j', default=None, type=int, help='Worker processes (default: one per CPU).')
+@click.option('--batch-size', default=None, type=int, help='Notes per job.')
+@click.option('--write', is_flag=True, help='Store the new HTML and excerpt of notes that differ.')
+@click.option('--warm-cache', is_flag=True, help='Put every rendering into the render cache.')
+@click.option('--diff', 'show_diff', default=0, type=int, help='Print the HTML diff of up to N changed notes.')
+@click.option('--slow-factor', default=10.0, type=float, show_default=True,
+              help='Report notes slower than this multiple of the median render time.')
+@click.option('--report', 'report_path', type=click.Path(dir_okay=False, writable=True),
+              help='Write per-note results as JSON.')
+def check_command(jobs, batch_size, write, warm_cache, show_diff, slow_factor, report_path):
+    """Re-render every note in parallel and report what changes, what fails and what is slow."""
+    batch_size = batch_size or current_app.config['RENDER_BATCH_SIZE']
+    if warm_cache and not render_cache.directory:
+        click.echo('MARKDOWN_CACHE_DIR is not set; --warm-cache only fills this process\'s memory.', err=True)
+    started = time.perf_counter()
+    report = check_renders(jobs, batch_size, write=write, warm_cache=warm_cache)
+    elapsed = time.perf_counter() - started
+
+    click.echo(f'Rendered {report.total} notes in {elapsed:.1f}s (render version {RENDER_VERSION}): '
+               f'{report.unchanged} unchanged, {report.changed} changed, {report.new} not rendered before, '
+               f'{report.failed} failed.')
+    if write:
+        click.echo(f'Updated {report.written} notes.')
+    if warm_cache:
+        click.echo(f'Cached {report.cached} renderings.')
+
+    shown = 0
+    for note_id, details in report.notes.items():
+        if details['status'] == 'failed':
+            click.echo(f"FAILED  #{note_id} {details['title']}: {details['error']}")
+        elif details['status'] == 'changed' and shown < show_diff:
+            shown += 1
+            click.echo(f"CHANGED #{note_id} {details['title']}")
+            click.echo('\n'.join(details['diff']))
+
+    outliers = report.outliers(slow_factor)
+    if outliers:
+        click.echo(f'Slowest notes (over {slow_factor:g}x the median):')
+        for note_id, title, ms in outliers:
+            click.echo(f'  {ms:8.1f} ms  #{note_id} {title}')
+
+    if report_path:
+        with open(report_path, 'w', encoding='utf-8') as f:
+            json.dump({
+                'render_version': RENDER_VERSION,
+                'total': report.total,
+                'unchanged': report.unchanged,
+                'changed': report.changed,
+                'new': report.new,
+                'failed': report.failed,
+                'notes': {str(note_id): details for note_id, details in report.notes.items()},
+                'timings_ms': {str(note_id): round(ms, 2) for note_id, _, ms in report.timings},
+            }, f, ensure_ascii=False, indent=2)
+    if report.failed:
+        sys.exit(1)
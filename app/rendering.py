@@ -0,0 +1,355 @@
+import hashlib
+import html
+import json
+import os
+import re
+import threading
+from collections import OrderedDict
+from importlib.metadata import version
+
+from .images import DIGEST_LENGTH, find_variants
+from .instrumentation import timed
+
+# Directory holding uploads and their variants; set by init_app()
+images_dir = None
+
+
+# Markdown extensions used for note content
+MARKDOWN_EXTENSIONS = [
+    'extra',  # Tables, fenced code blocks, etc.
+    'codehilite',  # Syntax highlighting
+    'nl2br',  # New line to <br>
+    'sane_lists'  # Better list handling
+]
+
+# Sanitize HTML to prevent XSS (allow common tags)
+ALLOWED_TAGS = [
+    'a', 'abbr', 'acronym', 'b', 'blockquote', 'code', 'em', 'i',
+    'li', 'ol', 'pre', 'strong', 'ul', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6',
+    'p', 'br', 'span', 'div', 'hr', 'table', 'thead', 'tbody', 'tr', 'th', 'td',
+    'img', 'del', 'ins', 'mark', 'sub', 'sup', 'picture', 'source'
+]
+ALLOWED_ATTRIBUTES = {
+    '*': ['class', 'id'],
+    'a': ['href', 'title', 'target', 'rel'],
+    'img': ['src', 'alt', 'title', 'width', 'height', 'loading', 'decoding'],
+    'source': ['srcset', 'type', 'sizes'],
+    'code': ['class'],
+    'pre': ['class'],
+    'span': ['class'],
+    'div': ['class']
+}
+
+
+# Bump when markdown_excerpt() output changes so stored excerpts are redone
+EXCERPT_VERSION = 2
+
+
+def _config_fingerprint():
+    payload = json.dumps({
+        'excerpt': EXCERPT_VERSION,
+        'markdown': version('markdown'),
+        'bleach': version('bleach'),
+        'extensions': MARKDOWN_EXTENSIONS,
+        'tags': ALLOWED_TAGS,
+        'attributes': ALLOWED_ATTRIBUTES,
+    }, sort_keys=True)
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+# Changes whenever the extension list or the allow-list changes, so cached
+# output produced under an older configuration is never served.
+RENDER_VERSION = _config_fingerprint()[:12]
+
+# Uploads embedded in a note; they render as <picture> once variants exist
+_UPLOADED_DIGEST = re.compile(r'/static/images/([0-9a-f]{%d})\.\w+' % DIGEST_LENGTH)
+
+
+def _variant_state(text):
+    """The variants on disk for every upload `text` embeds, as a cache key part."""
+    if images_dir is None:
+        return ''
+    digests = sorted(set(_UPLOADED_DIGEST.findall(text)))
+    if not digests:
+        return ''
+    return json.dumps({digest: find_variants(images_dir, digest) for digest in digests}, sort_keys=True)
+
+_local = threading.local()
+
+
+def _converter():
+    # markdown.Markdown and bleach.Cleaner are not thread-safe, so each
+    # thread keeps its own instances and resets them between documents.
+    # Both libraries are imported here, on the first render, so CLI commands
+    # and workers that only serve stored HTML never load them.
+    md = getattr(_local, 'md', None)
+    if md is None:
+        import bleach
+        import markdown
+        from .markdown_images import ResponsiveImageExtension
+        md = _local.md = markdown.Markdown(
+            extensions=MARKDOWN_EXTENSIONS + [ResponsiveImageExtension()]
+        )
+        _local.cleaner = bleach.Cleaner(
+            tags=ALLOWED_TAGS,
+            attributes=ALLOWED_ATTRIBUTES,
+            strip=False
+        )
+    return md, _local.cleaner
+
+
+def render_uncached(text):
+    """Convert Markdown to sanitized HTML without touching the cache."""
+    if not text:
+        return ''
+    md, cleaner = _converter()
+    md.reset()
+    with timed('markdown'):
+        html = md.convert(text)
+    with timed('bleach'):
+        return cleaner.clean(html)
+
+
+# One alternation covering the Markdown (and inline HTML) syntax that should
+# not appear in a plain-text teaser; see _strip_token() for the replacements.
+_EXCERPT_TOKENS = re.compile(r"""
+    (?P<fence>^[ \t]*(?P<fchar>```|~~~)[^\n]*\n(?P<fbody>.*?)(?:^[ \t]*(?P=fchar)[ \t]*$|\Z))
+  | (?P<comment><!--.*?(?:-->|\Z))
+  | (?P<image>!\[[^\]\n]*\]\([^)\n]*\))
+  | (?P<link>\[(?P<ltext>[^\]\n]*)\](?:\([^)\n]*\)|\[[^\]\n]*\]))
+  | (?P<refdef>^[ \t]*\[[^\]\n]+\]:[^\n]*$)
+  | (?P<tag></?[A-Za-z][^>]*(?:>|\Z))
+  | (?P<code>`+(?P<ctext>[^`]*)`+)
+  | (?P<rule>^[ \t]*(?:[-*_][ \t]*){3,}$|^[ \t]*\|?(?:[ \t]*:?-+:?[ \t]*\|)+[ \t]*:?-*:?[ \t]*$)
+  | (?P<prefix>^[ \t]*(?:(?:\#{1,6}|>|[-*+]|\d+[.)])[ \t]+)+)
+  | (?P<emphasis>\*{1,3}|_{2,3}|~~|\|)
+""", re.MULTILINE | re.DOTALL | re.VERBOSE)
+
+
+def _strip_token(match):
+    kind = match.lastgroup
+    if kind == 'link':
+        return match.group('ltext')
+    if kind == 'code':
+        return match.group('ctext')
+    if kind in ('fence', 'comment', 'tag', 'rule'):
+        return ' '
+    return ''
+
+
+def _strip_token_keep_code(match):
+    if match.lastgroup == 'fence':
+        return ' ' + match.group('fbody') + ' '
+    return _strip_token(match)
+
+
+def markdown_plaintext(text, keep_code=False):
+    """Markdown source reduced to whitespace-normalized plain text."""
+    if not text:
+        return ''
+    repl = _strip_token_keep_code if keep_code else _strip_token
+    return ' '.join(html.unescape(_EXCERPT_TOKENS.sub(repl, text)).split())
+
+
+def markdown_excerpt(text, length=100):
+    """
+    Plain-text teaser of Markdown source, truncated to `length` characters.
+
+    Strips syntax in a single regex pass without building HTML. Only a
+    prefix of the document is scanned; it grows until enough text is found.
+    """
+    if not text:
+        return ''
+    window = max(length * 8, 512)
+    while True:
+        plain = markdown_plaintext(text[:window])
+        if len(plain) > length or window >= len(text):
+            break
+        window *= 4
+    if len(plain) > length or window < len(text):
+        return plain[:length] + '...'
+    return plain
+
+
+class LRUCache:
+    """A small thread-safe LRU mapping with hit/miss counters."""
+
+    def __init__(self, maxsize=256):
+        self.maxsize = maxsize
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        with self._lock:
+            try:
+                value = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            self._data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        if self.maxsize <= 0:
+            return
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def discard(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+class RenderCache:
+    """
+    Content-addressed cache for rendered Markdown.
+
+    Entries are keyed by a hash of the source text, RENDER_VERSION and the
+    variants available for the uploads it embeds, so a rendering made
+    before an image's variants were written is not reused. The
+    in-process LRU is backed by an optional directory of HTML files that
+    survives restarts and is shared by all workers.
+    """
+
+    def __init__(self, maxsize=256, directory=None):
+        self.memory = LRUCache(maxsize)
+        self.directory = directory
+        self.disk_hits = 0
+        self.disk_writes = 0
+
+    def configure(self, maxsize=None, directory=None):
+        if maxsize is not None:
+            self.memory = LRUCache(maxsize)
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(text):
+        digest = hashlib.sha256(RENDER_VERSION.encode('ascii'))
+        digest.update(text.encode('utf-8'))
+        digest.update(_variant_state(text).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.html')
+
+    def _read_disk(self, key):
+        if not self.directory:
+            return None
+        try:
+            with open(self._path(key), encoding='utf-8') as f:
+                html = f.read()
+        except OSError:
+            return None
+        self.disk_hits += 1
+        return html
+
+    def _write_disk(self, key, html):
+        if not self.directory:
+            return
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(html)
+            os.replace(tmp_path, path)
+            self.disk_writes += 1
+        except OSError:
+            # The disk tier is best-effort; the in-process LRU still works.
+            pass
+
+    def render(self, text):
+        if not text:
+            return ''
+        key = self.key(text)
+        html = self.memory.get(key)
+        if html is not None:
+            return html
+        html = self._read_disk(key)
+        if html is None:
+            html = render_uncached(text)
+            self._write_disk(key, html)
+        self.memory.set(key, html)
+        return html
+
+    def store(self, text, html):
+        """Cache `html`, rendered elsewhere, as the rendering of `text`."""
+        if not text:
+            return
+        key = self.key(text)
+        self._write_disk(key, html)
+        self.memory.set(key, html)
+
+    def discard(self, text):
+        """Drop the cached rendering of `text` from every tier."""
+        if not text:
+            return
+        key = self.key(text)
+        self.memory.discard(key)
+        if self.directory:
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def clear(self):
+        self.memory.clear()
+
+    def stats(self):
+        return {
+            'render_version': RENDER_VERSION,
+            'size': len(self.memory),
+            'maxsize': self.memory.maxsize,
+            'hits': self.memory.hits,
+            'misses': self.memory.misses,
+            'evictions': self.memory.evictions,
+            'disk_enabled': bool(self.directory),
+            'disk_hits': self.disk_hits,
+            'disk_writes': self.disk_writes,
+        }
+
+
+render_cache = RenderCache()
+
+
+excerpt_cache = LRUCache(1024)
+
+
+def render_markdown(text):
+    """Convert Markdown to HTML with syntax highlighting support."""
+    return render_cache.render(text)
+
+
+def excerpt_filter(text, length=None):
+    """Template filter: plain-text teaser of a Markdown string."""
+    from flask import current_app
+    return markdown_excerpt(text, length or current_app.config['EXCERPT_LENGTH'])
+
+
+def init_app(app):
+    global images_dir
+    images_dir = os.path.join(app.static_folder, 'images')
+    render_cache.configure(
+        maxsize=app.config['MARKDOWN_CACHE_SIZE'],
+        directory=app.config['MARKDOWN_CACHE_DIR']
+    )
+    app.extensions['render_cache'] = render_cache
+    app.add_template_filter(render_markdown, 'markdown')
+    app.add_template_filter(excerpt_filter, 'excerpt')
@@ -0,0 +1,316 @@
+import hashlib
+import json
+import zlib
+from datetime import datetime, timedelta
+from difflib import SequenceMatcher
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import AppGroup
+
+from . import db
+from .models import LearningNote, NoteRevision
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+revisions_cli = AppGroup('revisions', help='Inspect and compact the note revision history.')
+
+
+class RevisionError(Exception):
+    """A revision could not be reconstructed (missing codec or corrupt chain)."""
+
+
+def content_hash(content):
+    return hashlib.sha1(content.encode('utf-8')).hexdigest()
+
+
+def diff_lines(old, new):
+    """
+    Line edits turning `old` into `new`: a [start, end] pair copies that run
+    of old lines, a string is inserted as is.
+    """
+    a = old.splitlines(keepends=True)
+    b = new.splitlines(keepends=True)
+    ops = []
+    for tag, i1, i2, j1, j2 in SequenceMatcher(None, a, b).get_opcodes():
+        if tag == 'equal':
+            ops.append([i1, i2])
+        elif j2 > j1:
+            ops.append(''.join(b[j1:j2]))
+    return ops
+
+
+def apply_delta(old, ops):
+    lines = old.splitlines(keepends=True)
+    return ''.join(op if isinstance(op, str) else ''.join(lines[op[0]:op[1]]) for op in ops)
+
+
+def _compress(codec, data):
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=10).compress(data)
+    return zlib.compress(data, 9)
+
+
+def _decompress(codec, data):
+    if codec == 'zstd':
+        if zstandard is None:
+            raise RevisionError('Revision is zstd-compressed but zstandard is not installed')
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+_table = NoteRevision.__table__
+
+
+class RevisionStore:
+    """
+    Every saved version of a note, compressed and delta-encoded.
+
+    A revision is stored either in full or as line edits against the
+    revision before it. At most SNAPSHOT_INTERVAL - 1 deltas follow a full
+    revision, so reading any revision decodes a bounded number of rows; a
+    delta that would not be smaller than the full text is stored in full.
+    """
+
+    def __init__(self):
+        self.codec = 'zlib'
+        self.snapshot_interval = 20
+
+    def init_app(self, app):
+        codec = app.config['REVISION_CODEC']
+        if codec == 'zstd' and zstandard is None:
+            codec = 'zlib'
+        self.codec = codec
+        self.snapshot_interval = max(1, app.config['REVISION_SNAPSHOT_INTERVAL'])
+
+    def encode(self, content, base=None, chain=0):
+        """
+        Column values storing `content`, as a delta against `base` (the
+        previous revision's content, `chain` deltas after a full one) when
+        that is allowed and smaller.
+        """
+        full = _compress(self.codec, content.encode('utf-8'))
+        values = {'kind': 'full', 'codec': self.codec, 'chain': 0, 'data': full}
+        if base is None or chain + 1 >= self.snapshot_interval:
+            return values
+        ops = json.dumps(diff_lines(base, content), ensure_ascii=False, separators=(',', ':'))
+        delta = _compress(self.codec, ops.encode('utf-8'))
+        if len(delta) < len(full):
+            values.update(kind='delta', chain=chain + 1, data=delta)
+        return values
+
+    @staticmethod
+    def decode(row, previous):
+        raw = _decompress(row.codec, row.data).decode('utf-8')
+        if row.kind == 'full':
+            return raw
+        if previous is None:
+            raise RevisionError(f'Revision {row.number} is a delta without a base')
+        return apply_delta(previous, json.loads(raw))
+
+    def _insert(self, connection, note_id, number, title, content, base=None, chain=0,
+                created_at=None):
+        values = self.encode(content, base, chain)
+        connection.execute(_table.insert().values(
+            note_id=note_id, number=number, title=title, size=len(content.encode('utf-8')),
+            content_hash=content_hash(content), created_at=created_at or datetime.utcnow(),
+            **values))
+
+    def record(self, connection, note, previous=None):
+        """
+        Append the note's current title and content as its next revision.
+
+        `previous` is the (title, content) the save replaced, if known; it
+        becomes the delta base, and the first revision of a note saved
+        before revisions existed.
+        """
+        latest = connection.execute(
+            sa.select(_table.c.number, _table.c.chain, _table.c.content_hash)
+            .where(_table.c.note_id == note.id)
+            .order_by(_table.c.number.desc()).limit(1)
+        ).first()
+        base = None
+        if latest is None and previous is not None:
+            self._insert(connection, note.id, 1, *previous, created_at=note.created_at)
+            latest = (1, 0, content_hash(previous[1]))
+        # Only delta against the old content if it is what the store holds
+        if latest is not None and previous is not None and latest[2] == content_hash(previous[1]):
+            base = previous[1]
+        number = latest[0] + 1 if latest else 1
+        self._insert(connection, note.id, number, note.title, note.content, base,
+                     latest[1] if latest else 0)
+
+    def content(self, note_id, number):
+        """The content of revision `number` of a note, or None if it does not exist."""
+        snapshot = sa.select(sa.func.max(_table.c.number)).where(
+            _table.c.note_id == note_id, _table.c.kind == 'full', _table.c.number <= number
+        ).scalar_subquery()
+        rows = db.session.execute(
+            sa.select(_table.c.number, _table.c.kind, _table.c.codec, _table.c.data, _table.c.content_hash)
+            .where(_table.c.note_id == note_id, _table.c.number.between(snapshot, number))
+            .order_by(_table.c.number)
+        ).all()
+        if not rows or rows[-1].number != number:
+            return None
+        content = None
+        for row in rows:
+            content = self.decode(row, content)
+        if content_hash(content) != rows[-1].content_hash:
+            raise RevisionError(f'Revision {number} of note {note_id} does not match its hash')
+        return content
+
+    def contents(self, note_id):
+        """(number, content) of every stored revision of a note, oldest first."""
+        rows = db.session.execute(
+            sa.select(_table.c.number, _table.c.kind, _table.c.codec, _table.c.data)
+            .where(_table.c.note_id == note_id).order_by(_table.c.number)
+        ).all()
+        content = None
+        for row in rows:
+            content = self.decode(row, content)
+            yield row.number, content
+
+    def history(self, note_id):
+        """Revision metadata of a note, newest first, without the stored data."""
+        return db.session.execute(
+            sa.select(_table.c.number, _table.c.title, _table.c.kind, _table.c.codec,
+                      _table.c.size, sa.func.length(_table.c.data).label('stored'),
+                      _table.c.created_at)
+            .where(_table.c.note_id == note_id)
+            .order_by(_table.c.number.desc())
+        ).all()
+
+    def compact(self, connection, note_id, keep=None, max_age_days=None, reencode=False):
+        """
+        Drop a note's revisions outside the retention policy and re-encode
+        what is left, so the oldest remaining revision is a full one.
+
+        A revision is dropped when it is not among the newest `keep` or is
+        older than `max_age_days`; the newest revision is always kept.
+        Returns (revisions dropped, stored bytes before, stored bytes after).
+        """
+        rows = connection.execute(
+            sa.select(_table).where(_table.c.note_id == note_id).order_by(_table.c.number)
+        ).all()
+        if not rows:
+            return 0, 0, 0
+        cutoff = datetime.utcnow() - timedelta(days=max_age_days) if max_age_days is not None else None
+        drop = set()
+        for index, row in enumerate(rows[:-1]):
+            if keep is not None and index < len(rows) - keep:
+                drop.add(row.id)
+            elif cutoff is not None and row.created_at is not None and row.created_at < cutoff:
+                drop.add(row.id)
+        before = sum(len(row.data) for row in rows)
+        if not drop and not reencode:
+            return 0, before, before
+
+        # Decode along the old chain while encoding the kept rows anew
+        after = 0
+        old_content = new_base = None
+        chain = 0
+        for row in rows:
+            old_content = self.decode(row, old_content)
+            if row.id in drop:
+                continue
+            values = self.encode(old_content, new_base, chain)
+            chain = values['chain']
+            new_base = old_content
+            after += len(values['data'])
+            connection.execute(_table.update().where(_table.c.id == row.id).values(**values))
+        if drop:
+            connection.execute(_table.delete().where(_table.c.id.in_(drop)))
+        return len(drop), before, after
+
+    def stats(self):
+        row = db.session.execute(sa.select(
+            sa.func.count(),
+            sa.func.count(sa.distinct(_table.c.note_id)),
+            sa.func.coalesce(sa.func.sum(_table.c.size), 0),
+            sa.func.coalesce(sa.func.sum(sa.func.length(_table.c.data)), 0),
+            sa.func.coalesce(sa.func.sum(sa.case((_table.c.kind == 'full', 1), else_=0)), 0),
+        )).one()
+        return {
+            'codec': self.codec,
+            'snapshot_interval': self.snapshot_interval,
+            'revisions': row[0],
+            'notes': row[1],
+            'content_bytes': row[2],
+            'stored_bytes': row[3],
+            'full_revisions': row[4],
+        }
+
+
+revision_store = RevisionStore()
+
+
+@db.event.listens_for(LearningNote, 'after_insert')
+def _record_new_note(mapper, connection, note):
+    revision_store.record(connection, note)
+
+
+@db.event.listens_for(LearningNote, 'after_update')
+def _record_edited_note(mapper, connection, note):
+    state = db.inspect(note)
+    title = state.attrs.title.history
+    content = state.attrs.content.history
+    if not (title.has_changes() or content.has_changes()):
+        return
+    previous = None
+    # The replaced values are only known if they were loaded before the edit
+    old_title = title.deleted[0] if title.deleted else (note.title if not title.has_changes() else None)
+    old_content = content.deleted[0] if content.deleted else (note.content if not content.has_changes() else None)
+    if old_title is not None and old_content is not None:
+        previous = (old_title, old_content)
+    revision_store.record(connection, note, previous)
+
+
+@db.event.listens_for(LearningNote, 'before_delete')
+def _delete_revisions(mapper, connection, note):
+    connection.execute(_table.delete().where(_table.c.note_id == note.id))
+
+
+def init_app(app):
+    revision_store.init_app(app)
+    app.extensions['revision_store'] = revision_store
+    app.cli.add_command(revisions_cli)
+
+
+@revisions_cli.command('compact')
+@click.option('--keep', default=None, type=int, help='Revisions kept per note (default: REVISION_KEEP).')
+@click.option('--days', default=None, type=int, help='Drop revisions older than this (default: REVISION_KEEP_DAYS).')
+@click.option('--reencode', is_flag=True, help='Re-encode every note, e.g. after changing REVISION_CODEC.')
+def compact_command(keep, days, reencode):
+    """Apply the retention policy and re-encode the revisions that remain."""
+    keep = keep if keep is not None else current_app.config['REVISION_KEEP']
+    days = days if days is not None else current_app.config['REVISION_KEEP_DAYS']
+    if keep is not None and keep < 1:
+        raise click.BadParameter('must be at least 1', param_hint='--keep')
+    note_ids = db.session.execute(sa.select(_table.c.note_id).distinct()).scalars().all()
+    db.session.remove()
+
+    dropped = before = after = 0
+    for note_id in note_ids:
+        # One transaction per note keeps locks short on a large history
+        with db.engine.begin() as connection:
+            counts = revision_store.compact(connection, note_id, keep, days, reencode)
+        dropped += counts[0]
+        before += counts[1]
+        after += counts[2]
+    click.echo(f'Dropped {dropped} revisions from {len(note_ids)} notes; '
+               f'stored size {before:,} -> {after:,} bytes.')
+
+
+@revisions_cli.command('stats')
+def stats_command():
+    """Show how many revisions are stored and how much space they take."""
+    stats = revision_store.stats()
+    ratio = stats['stored_bytes'] / stats['content_bytes'] if stats['content_bytes'] else 0
+    click.echo(f"{stats['revisions']} revisions of {stats['notes']} notes "
+               f"({stats['full_revisions']} full, codec {stats['codec']}, "
+               f"full revision at least every {stats['snapshot_interval']})")
+    click.echo(f"Content {stats['content_bytes']:,} bytes stored in {stats['stored_bytes']:,} bytes ({ratio:.1%})")
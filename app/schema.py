@@ -0,0 +1,154 @@
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+from . import db
+
+schema_cli = AppGroup('schema', help='Bring an existing database up to date with the models.')
+
+
+def add_missing_columns(table):
+    """
+    Add columns declared on `table` that the database table does not have yet.
+
+    db.create_all() won't alter existing tables, so new nullable columns are
+    added with ALTER TABLE (the same approach as migrate_categories.py).
+    Returns the names of the columns that were added.
+    """
+    engine = db.engine
+    inspector = sa.inspect(engine)
+    if not inspector.has_table(table.name):
+        return []
+    existing = {column['name'] for column in inspector.get_columns(table.name)}
+    added = []
+    with engine.begin() as connection:
+        for column in table.columns:
+            if column.name in existing:
+                continue
+            ddl_type = column.type.compile(dialect=engine.dialect)
+            connection.execute(sa.text(
+                f'ALTER TABLE {table.name} ADD COLUMN {column.name} {ddl_type}'
+            ))
+            added.append(column.name)
+    return added
+
+
+def _index_names(engine, table_name):
+    if engine.dialect.name == 'sqlite':
+        # Reflection skips expression indexes such as ix_category_name_lower
+        with engine.connect() as connection:
+            return set(connection.execute(sa.text(
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table"
+            ), {'table': table_name}).scalars())
+    return {index['name'] for index in sa.inspect(engine).get_indexes(table_name)}
+
+
+def create_missing_indexes(table):
+    """Create indexes declared on `table` that the database does not have yet."""
+    engine = db.engine
+    inspector = sa.inspect(engine)
+    if not inspector.has_table(table.name):
+        return []
+    existing = _index_names(engine, table.name)
+    created = []
+    for index in table.indexes:
+        if index.name not in existing:
+            index.create(bind=engine)
+            created.append(index.name)
+    return created
+
+
+def upgrade_schema():
+    """Create new tables, then add missing columns and indexes to existing ones."""
+    db.create_all()
+    changes = []
+    for table in db.metadata.sorted_tables:
+        changes += [f'{table.name}.{name}' for name in add_missing_columns(table)]
+        changes += create_missing_indexes(table)
+    return changes
+
+
+def init_db():
+    """
+    Create or upgrade the schema and seed an empty database with the example note.
+
+    Run once per deployment (`flask init_db`, or the server's master process)
+    rather than in every worker, so workers never race on CREATE TABLE.
+    Returns (schema changes, whether the example note was added).
+    """
+    from .models import LearningNote
+    from .seed import add_seed_note
+    changes = upgrade_schema()
+    seeded = False
+    if db.session.query(LearningNote.id).first() is None:
+        add_seed_note()
+        seeded = True
+    return changes, seeded
+
+
+def init_app(app):
+    app.cli.add_command(schema_cli)
+    app.cli.add_command(init_db_command)
+
+
+@click.command('init_db')
+def init_db_command():
+    """Create the database tables and add an example note to an empty database."""
+    changes, seeded = init_db()
+    for change in changes:
+        click.echo(f'Added {change}')
+    if seeded:
+        click.echo('Initial data has been added to the database.')
+    if not changes and not seeded:
+        click.echo('Database is already initialized.')
+
+
+@schema_cli.command('upgrade')
+def upgrade_command():
+    """Add tables, columns and indexes introduced since the database was created."""
+    changes = upgrade_schema()
+    if changes:
+        for change in changes:
+            click.echo(f'Added {change}')
+    else:
+        click.echo('Database schema is up to date.')
+
+
+def listing_queries():
+    """The lookups behind the listing pages, as (label, statement) pairs."""
+    from .models import LearningNote, Category
+    newest_first = (LearningNote.updated_at.desc(), LearningNote.id.desc())
+    # Stand-in for the cursor of the previous page
+    cursor = sa.tuple_(sa.literal_column("'9999-12-31'"), sa.literal_column('0'))
+    return [
+        ('index', sa.select(LearningNote.id).order_by(*newest_first).limit(10)),
+        ('index, next page', sa.select(LearningNote.id)
+            .where(sa.tuple_(LearningNote.updated_at, LearningNote.id) < cursor)
+            .order_by(*newest_first).limit(10)),
+        ('category_view', sa.select(LearningNote.id)
+            .where(LearningNote.category_id == 1).order_by(*newest_first).limit(10)),
+        ('category_view, next page', sa.select(LearningNote.id)
+            .where(LearningNote.category_id == 1,
+                   sa.tuple_(LearningNote.updated_at, LearningNote.id) < cursor)
+            .order_by(*newest_first).limit(10)),
+        ('category by name', sa.select(Category.id).where(Category.name == 'x')),
+        ('add_category', sa.select(Category.id).where(Category.name_matches('X'))),
+    ]
+
+
+def query_plan(statement):
+    """SQLite's EXPLAIN QUERY PLAN for `statement`, one detail line per step."""
+    compiled = statement.compile(dialect=db.engine.dialect,
+                                 compile_kwargs={'literal_binds': True})
+    rows = db.session.connection().exec_driver_sql(f'EXPLAIN QUERY PLAN {compiled}').all()
+    return [row[-1] for row in rows]
+
+
+@schema_cli.command('plans')
+def plans_command():
+    """Show how SQLite executes each listing query (SCAN = full table scan)."""
+    if db.engine.dialect.name != 'sqlite':
+        raise click.ClickException('Query plans are only shown for SQLite databases.')
+    for label, statement in listing_queries():
+        click.echo(f'{label}:')
+        for detail in query_plan(statement):
+            click.echo(f'  {detail}')
@@ -0,0 +1,246 @@
+import re
+
+import click
+import sqlalchemy as sa
+from flask.cli import AppGroup
+from markupsafe import Markup, escape
+
+from . import db
+from .models import LearningNote, parse_tags
+from .pagination import KeysetPage, decode_cursor, encode_cursor, paginate_by_updated
+from .rendering import markdown_plaintext
+
+search_cli = AppGroup('search', help='Maintain the full-text search index.')
+
+FTS_TABLE = 'note_fts'
+
+# Column weights for bm25(): title, body, tags
+BM25_WEIGHTS = (10.0, 1.0, 5.0)
+
+# unicode61 treats a whole run of CJK characters as one token, so CJK text is
+# indexed (and queried) one character per token. A quoted phrase of those
+# tokens then matches the exact substring, which is what `ilike` gave us.
+_CJK = (
+    '\u3040-\u30ff'  # Hiragana, Katakana
+    '\u3400-\u4dbf'  # CJK Extension A
+    '\u4e00-\u9fff'  # CJK Unified Ideographs
+    '\uf900-\ufaff'  # CJK Compatibility Ideographs
+    '\uac00-\ud7af'  # Hangul Syllables
+)
+_CJK_CHAR = re.compile(f'([{_CJK}])')
+# Private-use characters mark highlights until the snippet is escaped
+_HL_START, _HL_END = '\ue000', '\ue001'
+_CJK_GAP = re.compile(f'(?<=[{_CJK}])([{_HL_START}{_HL_END}]?) +([{_HL_START}{_HL_END}]?)(?=[{_CJK}])')
+_WORD = re.compile(r'\w', re.UNICODE)
+
+_fts_ready = set()
+
+
+def segment(text):
+    """Split CJK runs into single-character tokens for the FTS tokenizer."""
+    if not text:
+        return ''
+    return _CJK_CHAR.sub(r' \1 ', text)
+
+
+def _desegment(text):
+    return ' '.join(_CJK_GAP.sub(r'\1\2', text).split())
+
+
+def _highlight(snippet):
+    html = str(escape(_desegment(snippet)))
+    return Markup(html.replace(_HL_START, '<mark>').replace(_HL_END, '</mark>'))
+
+
+def build_match_query(query):
+    """
+    Turn free text into an FTS5 MATCH expression.
+
+    Every whitespace-separated term becomes a quoted phrase (so user input
+    can never be parsed as FTS syntax) and the terms are ANDed together. The
+    last term is a prefix match to suit search-as-you-type.
+    """
+    phrases = []
+    for term in query.split():
+        if not _WORD.search(term):
+            continue
+        phrases.append('"' + segment(term).strip().replace('"', '""') + '"')
+    if not phrases:
+        return None
+    phrases[-1] += '*'
+    return ' AND '.join(phrases)
+
+
+def fts_available(connection):
+    url = str(connection.engine.url)
+    if url in _fts_ready:
+        return True
+    if connection.dialect.name != 'sqlite':
+        return False
+    exists = connection.execute(
+        sa.text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': FTS_TABLE}
+    ).first() is not None
+    if exists:
+        _fts_ready.add(url)
+    return exists
+
+
+def create_index(connection):
+    connection.execute(sa.text(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLE} USING fts5("
+        "title, body, tags, tokenize = 'unicode61 remove_diacritics 2')"
+    ))
+
+
+def _index_row(note_id, title, content, tags):
+    return {
+        'id': note_id,
+        'title': segment(title),
+        'body': segment(markdown_plaintext(content, keep_code=True)),
+        'tags': segment(' '.join(parse_tags(tags))),
+    }
+
+
+_INSERT = sa.text(f'INSERT INTO {FTS_TABLE} (rowid, title, body, tags) VALUES (:id, :title, :body, :tags)')
+_DELETE = sa.text(f'DELETE FROM {FTS_TABLE} WHERE rowid = :id')
+
+
+def index_notes(connection, rows):
+    """(Re)index (id, title, content, tags) tuples on `connection`."""
+    params = [_index_row(*row) for row in rows]
+    if not params:
+        return
+    connection.execute(_DELETE, [{'id': p['id']} for p in params])
+    connection.execute(_INSERT, params)
+
+
+def rebuild_index(batch_size=200):
+    engine = db.engine
+    table = LearningNote.__table__
+    with engine.begin() as connection:
+        connection.execute(sa.text(f'DROP TABLE IF EXISTS {FTS_TABLE}'))
+        create_index(connection)
+    _fts_ready.discard(str(engine.url))
+
+    last_id = 0
+    total = 0
+    while True:
+        with engine.begin() as connection:
+            rows = connection.execute(
+                sa.select(table.c.id, table.c.title, table.c.content, table.c.tags)
+                .where(table.c.id > last_id).order_by(table.c.id).limit(batch_size)
+            ).all()
+            if not rows:
+                break
+            connection.execute(_INSERT, [_index_row(*row) for row in rows])
+        total += len(rows)
+        last_id = rows[-1][0]
+
+    with engine.begin() as connection:
+        connection.execute(sa.text(f"INSERT INTO {FTS_TABLE} ({FTS_TABLE}) VALUES ('optimize')"))
+    return total
+
+
+@db.event.listens_for(LearningNote.__table__, 'after_create')
+def _create_index_with_table(table, connection, **kw):
+    # Fresh databases (db.create_all()) get the index alongside the table
+    if connection.dialect.name == 'sqlite':
+        create_index(connection)
+
+
+@db.event.listens_for(LearningNote, 'after_insert')
+def _index_new_note(mapper, connection, note):
+    if fts_available(connection):
+        index_notes(connection, [(note.id, note.title, note.content, note.tags)])
+
+
+@db.event.listens_for(LearningNote, 'after_update')
+def _index_updated_note(mapper, connection, note):
+    state = db.inspect(note)
+    if not any(state.attrs[name].history.has_changes() for name in ('title', 'content', 'tags')):
+        return
+    if fts_available(connection):
+        index_notes(connection, [(note.id, note.title, note.content, note.tags)])
+
+
+@db.event.listens_for(LearningNote, 'after_delete')
+def _unindex_note(mapper, connection, note):
+    if fts_available(connection):
+        connection.execute(_DELETE, {'id': note.id})
+
+
+def _search_fts(match, cursor, per_page, base_query):
+    weights = ', '.join(str(w) for w in BM25_WEIGHTS)
+    rank = f'bm25({FTS_TABLE}, {weights})'
+    params = {'match': match, 'hl_start': _HL_START, 'hl_end': _HL_END, 'limit': per_page + 1}
+    after = ''
+    values = decode_cursor(cursor)
+    if values and len(values) == 2:
+        try:
+            params.update(rank=float(values[0]), last_id=int(values[1]))
+        except (TypeError, ValueError):
+            pass
+        else:
+            # Continue after the last (rank, rowid) of the previous page
+            after = f'AND ({rank} > :rank OR ({rank} = :rank AND rowid > :last_id)) '
+
+    rows = db.session.execute(sa.text(
+        f"SELECT rowid, {rank} AS score, snippet({FTS_TABLE}, 1, :hl_start, :hl_end, '…', 24) "
+        f"FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match {after}"
+        f"ORDER BY score, rowid LIMIT :limit"
+    ), params).all()
+
+    next_cursor = None
+    if len(rows) > per_page:
+        rows = rows[:per_page]
+        next_cursor = encode_cursor(rows[-1].score, rows[-1].rowid)
+
+    ids = [row.rowid for row in rows]
+    notes = {note.id: note for note in base_query.filter(LearningNote.id.in_(ids))}
+    return KeysetPage(
+        [notes[note_id] for note_id in ids if note_id in notes],
+        next_cursor,
+        count_query=lambda: db.session.execute(
+            sa.text(f'SELECT count(*) FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH :match'),
+            {'match': match}
+        ).scalar(),
+        snippets={row.rowid: _highlight(row[2]) for row in rows}
+    )
+
+
+def search_notes(query, cursor, per_page, base_query=None):
+    """
+    Return a KeysetPage of notes matching `query`, starting after `cursor`.
+
+    Uses the FTS5 index (ordered by BM25) when it exists and falls back to
+    the `ilike` scan otherwise. The page's `snippets` dict holds
+    highlighted excerpts. Notes are loaded through `base_query`, by
+    default LearningNote.eager_query().
+    """
+    if base_query is None:
+        base_query = LearningNote.eager_query()
+    if fts_available(db.session.connection()):
+        match = build_match_query(query)
+        if match is None:
+            return KeysetPage([])
+        return _search_fts(match, cursor, per_page, base_query)
+
+    search_query = base_query.filter(
+        LearningNote.title.ilike(f'%{query}%') |
+        LearningNote.content.ilike(f'%{query}%') |
+        LearningNote.tags.ilike(f'%{query}%')
+    )
+    return paginate_by_updated(search_query, LearningNote, cursor, per_page)
+
+
+def init_app(app):
+    app.cli.add_command(search_cli)
+
+
+@search_cli.command('rebuild')
+@click.option('--batch-size', default=200, type=int, help='Rows per transaction.')
+def rebuild_command(batch_size):
+    """Create (or recreate) the FTS5 index from all notes."""
+    count = rebuild_index(batch_size)
+    click.echo(f'Indexed {count} notes into {FTS_TABLE}.')
@@ -0,0 +1,275 @@
+import bisect
+import threading
+import time
+import unicodedata
+from collections import namedtuple
+from datetime import datetime
+
+import sqlalchemy as sa
+from flask import current_app
+
+from . import db
+from .caching import bump_version, category_cache, read_version
+from .models import Category, LearningNote, Tag, note_tags
+from .search import _CJK_CHAR
+
+KINDS = ('notes', 'tags', 'categories')
+
+# `weight` orders matches of the same kind: last update for notes, note count otherwise
+Suggestion = namedtuple('Suggestion', 'kind id label weight folded')
+
+
+def fold(text):
+    """Case- and width-insensitive form of `text` (full-width Latin, compatibility ideographs)."""
+    return unicodedata.normalize('NFKC', text or '').casefold()
+
+
+def _suggestion(kind, ident, label, weight):
+    return Suggestion(kind, ident, label, weight, fold(label))
+
+
+def _key_starts(folded, limit):
+    # Every word start, and every CJK character since CJK text has no spaces
+    starts = [0]
+    previous = ''
+    for index, char in enumerate(folded):
+        if len(starts) >= limit:
+            break
+        if index and (_CJK_CHAR.match(char) or (char.isalnum() and not previous.isalnum())):
+            starts.append(index)
+        previous = char
+    return starts
+
+
+class SuggestIndex:
+    """
+    Note titles, tag names and category names for search-as-you-type, in
+    a sorted array of (key, kind, id) searched with bisect.
+
+    A name is indexed from each of its word starts and CJK characters, so
+    "排放" finds "範疇三排放計算". Keys are cut to SUGGEST_KEY_LENGTH
+    characters; longer queries are checked against the whole name.
+
+    Writes made by this process update the array in place once they are
+    committed. The shared version stamp makes other processes rebuild it on
+    their next lookup, checked at most once per SUGGEST_CHECK_INTERVAL
+    seconds, so a keystroke normally costs no query at all.
+    """
+
+    VERSION_NAME = 'suggest'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._keys = None
+        self._entries = {}
+        self._version = None
+        self._checked_at = 0.0
+        self.key_length = 10
+        self.keys_per_name = 24
+        self.scan_limit = 2000
+        self.builds = 0
+        self.updates = 0
+        self.lookups = 0
+
+    def init_app(self, app):
+        self.key_length = app.config['SUGGEST_KEY_LENGTH']
+        self.keys_per_name = app.config['SUGGEST_KEYS_PER_NAME']
+        self.scan_limit = app.config['SUGGEST_SCAN_LIMIT']
+
+    def _entry_keys(self, entry):
+        return sorted({(entry.folded[start:start + self.key_length], entry.kind, entry.id)
+                       for start in _key_starts(entry.folded, self.keys_per_name)})
+
+    def _load(self):
+        table = LearningNote.__table__
+        tag_table = Tag.__table__
+        entries = [_suggestion('notes', row.id, row.title, row.updated_at.timestamp() if row.updated_at else 0.0)
+                   for row in db.session.execute(sa.select(table.c.id, table.c.title, table.c.updated_at))]
+        entries += [_suggestion('tags', row.id, row.name, row.note_count)
+                    for row in db.session.execute(sa.select(tag_table.c.id, tag_table.c.name, tag_table.c.note_count)
+                                                  .where(tag_table.c.note_count > 0))]
+        entries += [_suggestion('categories', category.id, category.name, category.note_count)
+                    for category in category_cache.get()]
+        return entries
+
+    def _refresh(self):
+        now = time.monotonic()
+        interval = current_app.config['SUGGEST_CHECK_INTERVAL']
+        with self._lock:
+            keys, version, checked_at = self._keys, self._version, self._checked_at
+        # A version of None marks the index stale (see apply)
+        if keys is not None and version is not None and now - checked_at < interval:
+            return
+        current = read_version(self.VERSION_NAME)
+        if keys is not None and current == version:
+            with self._lock:
+                self._checked_at = now
+            return
+
+        entries = {}
+        keys = []
+        for entry in self._load():
+            entries[(entry.kind, entry.id)] = entry
+            keys.extend(self._entry_keys(entry))
+        keys.sort()
+        with self._lock:
+            self._keys, self._entries, self._version, self._checked_at = keys, entries, current, now
+        self.builds += 1
+
+    def suggest(self, query, limit=8):
+        """{'notes': [...], 'tags': [...], 'categories': [...]}, up to `limit` Suggestions each."""
+        folded = ' '.join(fold(query).split())
+        results = {kind: [] for kind in KINDS}
+        if not folded:
+            return results
+        self._refresh()
+        self.lookups += 1
+        probe = folded[:self.key_length]
+        ranks = {}
+        with self._lock:
+            keys, entries = self._keys, self._entries
+            index = bisect.bisect_left(keys, (probe,))
+            end = min(len(keys), index + self.scan_limit)
+            while index < end and keys[index][0].startswith(probe):
+                _, kind, ident = keys[index]
+                index += 1
+                entry = entries[(kind, ident)]
+                if (kind, ident) in ranks or (len(folded) > self.key_length and folded not in entry.folded):
+                    continue
+                # Names that start with the query first, then the heaviest
+                ranks[(kind, ident)] = (not entry.folded.startswith(folded), -entry.weight, len(entry.label), entry)
+        for rank in sorted(ranks.values(), key=lambda rank: rank[:3]):
+            entry = rank[3]
+            if len(results[entry.kind]) < limit:
+                results[entry.kind].append(entry)
+        return results
+
+    def apply(self, changes, base, version):
+        """
+        Replace entries after a commit; `changes` holds (kind, id,
+        Suggestion or None) and `base` is the version the transaction
+        started from. If another process wrote in between, rebuild instead.
+        """
+        with self._lock:
+            if self._keys is None:
+                return
+            if self._version != base:
+                # Lookups already past _refresh() keep using the old array
+                self._version = None
+                return
+            keys = self._keys
+            for kind, ident, entry in changes:
+                old = self._entries.pop((kind, ident), None)
+                if old is not None:
+                    for key in self._entry_keys(old):
+                        index = bisect.bisect_left(keys, key)
+                        if index < len(keys) and keys[index] == key:
+                            del keys[index]
+                if entry is not None:
+                    self._entries[(kind, ident)] = entry
+                    for key in self._entry_keys(entry):
+                        bisect.insort(keys, key)
+            self._version = version
+        self.updates += 1
+
+    def invalidate(self):
+        """Rebuild on the next lookup."""
+        with self._lock:
+            self._version = None
+
+    def stats(self):
+        return {
+            'keys': len(self._keys) if self._keys is not None else None,
+            'entries': len(self._entries),
+            'version': self._version,
+            'builds': self.builds,
+            'updates': self.updates,
+            'lookups': self.lookups,
+        }
+
+
+suggest_index = SuggestIndex()
+
+
+def init_app(app):
+    suggest_index.init_app(app)
+
+
+@db.event.listens_for(db.session, 'before_flush')
+def _track_suggest_changes(session, flush_context, instances):
+    notes, categories, category_ids, tags = set(), set(), set(), set()
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        if isinstance(obj, Category):
+            categories.add(obj)
+        elif isinstance(obj, LearningNote):
+            state = db.inspect(obj)
+            notes.add(obj)
+            category_ids.update(value for value in state.attrs.category_id.history.sum() if value is not None)
+            tags.update(state.attrs.tag_objects.history.sum())
+            if obj in session.deleted:
+                tags.update(obj.tag_objects)
+    if notes or categories:
+        pending = session.info.setdefault('suggest_pending', (set(), set(), set(), set()))
+        for collected, found in zip(pending, (notes, categories, category_ids, tags)):
+            collected.update(found)
+
+
+@db.event.listens_for(db.session, 'after_flush')
+def _collect_suggest_changes(session, flush_context):
+    pending = session.info.pop('suggest_pending', None)
+    if pending is None:
+        return
+    notes, categories, category_ids, tags = pending
+    connection = session.connection()
+    changes = []
+    for note in notes:
+        if note in session.deleted:
+            changes.append(('notes', note.id, None))
+        else:
+            updated_at = note.updated_at or datetime.utcnow()
+            changes.append(('notes', note.id, _suggestion('notes', note.id, note.title, updated_at.timestamp())))
+            category_ids.add(note.category_id)
+
+    category_ids.update(category.id for category in categories)
+    category_ids.discard(None)
+    if category_ids:
+        table = Category.__table__
+        note_table = LearningNote.__table__
+        count = sa.select(sa.func.count()).where(note_table.c.category_id == table.c.id).scalar_subquery()
+        found = {row.id: row for row in connection.execute(
+            sa.select(table.c.id, table.c.name, count.label('note_count')).where(table.c.id.in_(category_ids)))}
+        for category_id in category_ids:
+            row = found.get(category_id)
+            changes.append(('categories', category_id,
+                            _suggestion('categories', row.id, row.name, row.note_count) if row else None))
+
+    tag_ids = {tag.id for tag in tags if tag.id is not None}
+    if tag_ids:
+        table = Tag.__table__
+        count = sa.select(sa.func.count()).where(note_tags.c.tag_id == table.c.id).scalar_subquery()
+        found = {row.id: row for row in connection.execute(
+            sa.select(table.c.id, table.c.name, count.label('note_count')).where(table.c.id.in_(tag_ids)))}
+        for tag_id in tag_ids:
+            row = found.get(tag_id)
+            changes.append(('tags', tag_id, _suggestion('tags', row.id, row.name, row.note_count)
+                            if row and row.note_count else None))
+
+    transaction = session.info.setdefault('suggest_changes', {'changes': [], 'base': None})
+    if transaction['base'] is None:
+        transaction['base'] = read_version(SuggestIndex.VERSION_NAME, connection)
+    bump_version(SuggestIndex.VERSION_NAME, connection)
+    transaction['version'] = read_version(SuggestIndex.VERSION_NAME, connection)
+    transaction['changes'].extend(changes)
+
+
+@db.event.listens_for(db.session, 'after_commit')
+def _apply_suggest_changes(session):
+    transaction = session.info.pop('suggest_changes', None)
+    if transaction is not None:
+        suggest_index.apply(transaction['changes'], transaction['base'], transaction['version'])
+
+
+@db.event.listens_for(db.session, 'after_soft_rollback')
+def _discard_suggest_changes(session, previous_transaction):
+    session.info.pop('suggest_changes', None)
+    session.info.pop('suggest_pending', None)
@@ -0,0 +1,362 @@
+import hashlib
+import json
+import os
+import re
+import zipfile
+from datetime import datetime
+
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import AppGroup
+
+from . import db, image_refs, relations
+from .caching import CategoryCache, bump_version, category_cache
+from .models import Category, ImportCheckpoint, LearningNote, Tag, note_tags, normalize_tag_names
+from .rendering import RENDER_VERSION, markdown_excerpt, render_markdown
+from .search import fts_available, index_notes
+from .suggest import SuggestIndex
+
+notes_cli = AppGroup('notes', help='Export and import notes in bulk.')
+
+FORMATS = ('jsonl', 'markdown')
+_FRONT_MATTER = '---'
+_FRONT_MATTER_FIELDS = ('title', 'category', 'tags', 'created_at', 'updated_at')
+_UNSAFE_PATH = re.compile(r'[^\w\-]+', re.UNICODE)
+
+
+def _format_for(path, fmt):
+    if fmt:
+        return fmt
+    return 'markdown' if path.lower().endswith('.zip') else 'jsonl'
+
+
+def _timestamp(value):
+    return value.isoformat() if value else None
+
+
+def _parse_timestamp(value):
+    return datetime.fromisoformat(value) if value else None
+
+
+# --- Export -----------------------------------------------------------------
+
+def iter_note_records(batch_size=500):
+    """
+    Yield every note as a plain dict, oldest first.
+
+    Rows are streamed with yield_per, so only one batch is held in memory
+    however many notes there are.
+    """
+    table = LearningNote.__table__
+    query = sa.select(
+        table.c.title, Category.__table__.c.name.label('category'), table.c.content,
+        table.c.tags, table.c.created_at, table.c.updated_at,
+    ).join(Category.__table__, Category.__table__.c.id == table.c.category_id) \
+        .order_by(table.c.id).execution_options(yield_per=batch_size)
+
+    for row in db.session.execute(query):
+        yield {
+            'title': row.title,
+            'category': row.category,
+            'tags': normalize_tag_names(row.tags),
+            'created_at': _timestamp(row.created_at),
+            'updated_at': _timestamp(row.updated_at),
+            'content': row.content,
+        }
+
+
+def _note_filename(number, record):
+    slug = _UNSAFE_PATH.sub('-', record['title']).strip('-')[:60] or 'note'
+    return f'notes/{number:06d}-{slug}.md'
+
+
+def _to_markdown(record):
+    lines = [_FRONT_MATTER]
+    # JSON-encoded values keep titles with colons or newlines on one line
+    lines += [f'{field}: {json.dumps(record[field], ensure_ascii=False)}' for field in _FRONT_MATTER_FIELDS]
+    lines += [_FRONT_MATTER, '']
+    return '\n'.join(lines) + record['content']
+
+
+def _from_markdown(text):
+    lines = text.split('\n')
+    if not lines or lines[0] != _FRONT_MATTER:
+        raise ValueError('missing front matter')
+    record = {}
+    for index, line in enumerate(lines[1:], start=1):
+        if line == _FRONT_MATTER:
+            body = lines[index + 1:]
+            if body and body[0] == '':
+                body = body[1:]
+            record['content'] = '\n'.join(body)
+            return record
+        field, _, value = line.partition(': ')
+        record[field] = json.loads(value)
+    raise ValueError('unterminated front matter')
+
+
+def export_notes(path, fmt, batch_size=500):
+    """Write every note to `path` as JSONL or a zip of Markdown files."""
+    categories = [name for (name,) in db.session.execute(sa.select(Category.name).order_by(Category.id))]
+    count = 0
+    if fmt == 'jsonl':
+        with open(path, 'w', encoding='utf-8') as out:
+            for name in categories:
+                out.write(json.dumps({'type': 'category', 'name': name}, ensure_ascii=False) + '\n')
+            for record in iter_note_records(batch_size):
+                out.write(json.dumps(dict(type='note', **record), ensure_ascii=False) + '\n')
+                count += 1
+    else:
+        with zipfile.ZipFile(path, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            # Categories without notes would otherwise be lost
+            archive.writestr('categories.json', json.dumps(categories, ensure_ascii=False))
+            for record in iter_note_records(batch_size):
+                count += 1
+                archive.writestr(_note_filename(count, record), _to_markdown(record))
+    return len(categories), count
+
+
+# --- Import -----------------------------------------------------------------
+
+def _read_jsonl(path):
+    with open(path, encoding='utf-8') as source:
+        for line_number, line in enumerate(source, start=1):
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except json.JSONDecodeError as e:
+                raise click.ClickException(f'{path}:{line_number}: invalid JSON ({e})')
+
+
+def _read_markdown_archive(path):
+    with zipfile.ZipFile(path) as archive:
+        names = archive.namelist()
+        if 'categories.json' in names:
+            for name in json.loads(archive.read('categories.json')):
+                yield {'type': 'category', 'name': name}
+        for name in names:
+            if not name.endswith('.md'):
+                continue
+            try:
+                record = _from_markdown(archive.read(name).decode('utf-8'))
+            except ValueError as e:
+                raise click.ClickException(f'{path}:{name}: {e}')
+            record['type'] = 'note'
+            yield record
+
+
+def _read_records(path, fmt):
+    return _read_jsonl(path) if fmt == 'jsonl' else _read_markdown_archive(path)
+
+
+class ImportProgress:
+    """
+    Number of records already committed from a source file.
+
+    Kept in the import_checkpoint table and written inside each batch's
+    transaction, so it always matches the notes that committed and an
+    interrupted import resumes at the first batch that did not. Tied to the
+    source file's path, size and mtime; a changed file starts over.
+    """
+
+    def __init__(self, source):
+        stat = os.stat(source)
+        fingerprint = json.dumps({'source': os.path.abspath(source), 'size': stat.st_size,
+                                  'mtime': stat.st_mtime}, sort_keys=True)
+        self.key = hashlib.sha256(fingerprint.encode('utf-8')).hexdigest()
+        self.done = 0
+
+    def load(self):
+        table = ImportCheckpoint.__table__
+        with db.engine.connect() as connection:
+            done = connection.execute(sa.select(table.c.done).where(table.c.source == self.key)).scalar()
+        self.done = done or 0
+        return self.done
+
+    def save(self, connection, done):
+        """Record `done` in the caller's transaction."""
+        table = ImportCheckpoint.__table__
+        result = connection.execute(table.update().where(table.c.source == self.key).values(done=done))
+        if result.rowcount == 0:
+            connection.execute(table.insert().values(source=self.key, done=done))
+        self.done = done
+
+    def finish(self):
+        table = ImportCheckpoint.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.delete().where(table.c.source == self.key))
+
+
+class NoteImporter:
+    """
+    Inserts records in batches with Core executemany statements.
+
+    Core inserts skip the ORM events, so the derived data those events
+    maintain (rendered HTML, tag links and counts, the search, related-notes
+    and image indexes) is written here, in the caller's transaction.
+    """
+
+    def __init__(self, excerpt_length):
+        self.excerpt_length = excerpt_length
+        self.category_ids = None
+        self.connection = None
+        self.notes = 0
+        self.categories = 0
+
+    def _category_id(self, name):
+        category_id = self.category_ids.get(name)
+        if category_id is None:
+            category_id = self.connection.execute(
+                Category.__table__.insert().values(name=name)
+            ).inserted_primary_key[0]
+            self.category_ids[name] = category_id
+            self.categories += 1
+        return category_id
+
+    def _tag_ids(self, names):
+        if not names:
+            return {}
+        tag_table = Tag.__table__
+        self.connection.execute(
+            tag_table.insert().prefix_with('OR IGNORE'),
+            [{'name': name, 'note_count': 0} for name in names]
+        )
+        return dict(self.connection.execute(
+            sa.select(tag_table.c.name, tag_table.c.id).where(tag_table.c.name.in_(names))
+        ).all())
+
+    def add_batch(self, connection, records):
+        """Insert `records` on `connection`; the caller owns the transaction."""
+        self.connection = connection
+        if self.category_ids is None:
+            self.category_ids = dict(connection.execute(sa.select(Category.name, Category.id)).all())
+        notes = []
+        for record in records:
+            if record.get('type') == 'category':
+                self._category_id(record['name'])
+            else:
+                notes.append(record)
+        if not notes:
+            return
+
+        params = []
+        tag_names = []
+        now = datetime.utcnow()
+        for record in notes:
+            # Stored the way the Tagify field submits it, so the edit form shows it
+            raw_tags = json.dumps([{'value': str(name)} for name in record.get('tags') or []],
+                                  ensure_ascii=False)
+            tag_names.append(normalize_tag_names(raw_tags))
+            content = record['content']
+            params.append({
+                'title': record['title'],
+                'category_id': self._category_id(record['category']),
+                'content': content,
+                'tags': raw_tags,
+                'content_html': render_markdown(content),
+                'excerpt': markdown_excerpt(content, self.excerpt_length),
+                'render_version': RENDER_VERSION,
+                'created_at': _parse_timestamp(record.get('created_at')) or now,
+                'updated_at': _parse_timestamp(record.get('updated_at')) or now,
+            })
+
+        table = LearningNote.__table__
+        ids = self.connection.execute(
+            table.insert().returning(table.c.id, sort_by_parameter_order=True), params
+        ).scalars().all()
+
+        tag_ids = self._tag_ids(sorted({name for names in tag_names for name in names}))
+        links = [{'note_id': note_id, 'tag_id': tag_ids[name]}
+                 for note_id, names in zip(ids, tag_names) for name in names]
+        if links:
+            self.connection.execute(note_tags.insert(), links)
+            tag_table = Tag.__table__
+            count = sa.select(sa.func.count()).where(note_tags.c.tag_id == tag_table.c.id).scalar_subquery()
+            self.connection.execute(
+                tag_table.update().where(tag_table.c.id.in_(list(tag_ids.values()))).values(note_count=count)
+            )
+
+        if fts_available(self.connection):
+            index_notes(self.connection, [(note_id, p['title'], p['content'], p['tags'])
+                                          for note_id, p in zip(ids, params)])
+        if image_refs.refs_available(self.connection):
+            for note_id, p in zip(ids, params):
+                image_refs.index_note_images(self.connection, note_id, p['content'])
+        if relations.relations_available(self.connection):
+            relations.index_notes(self.connection, [
+                (note_id, p['title'], p['content'], p['category_id'], [tag_ids[name] for name in names])
+                for note_id, p, names in zip(ids, params, tag_names)])
+        self.notes += len(ids)
+
+
+def _batches(records, size):
+    batch = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_notes(path, fmt, batch_size=500, resume=True):
+    """
+    Import an export file one transaction per batch.
+
+    Returns (categories added, notes added, records skipped as already done).
+    """
+    ImportCheckpoint.__table__.create(db.engine, checkfirst=True)
+    progress = ImportProgress(path)
+    skip = progress.load() if resume else 0
+    records = _read_records(path, fmt)
+    for _ in range(skip):
+        next(records, None)
+
+    done = skip
+    importer = NoteImporter(current_app.config['EXCERPT_LENGTH'])
+    for batch in _batches(records, batch_size):
+        with db.engine.begin() as connection:
+            importer.add_batch(connection, batch)
+            bump_version(CategoryCache.VERSION_NAME, connection)
+            bump_version(SuggestIndex.VERSION_NAME, connection)
+            done += len(batch)
+            progress.save(connection, done)
+    progress.finish()
+    category_cache.invalidate()
+    return importer.categories, importer.notes, skip
+
+
+def init_app(app):
+    app.cli.add_command(notes_cli)
+
+
+@notes_cli.command('export')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None,
+              help='Defaults to markdown for .zip paths and jsonl otherwise.')
+@click.option('--batch-size', default=None, type=int, help='Rows fetched per round trip.')
+def export_command(path, fmt, batch_size):
+    """Export all categories and notes to PATH."""
+    fmt = _format_for(path, fmt)
+    batch_size = batch_size or current_app.config['TRANSFER_BATCH_SIZE']
+    categories, notes = export_notes(path, fmt, batch_size)
+    click.echo(f'Exported {categories} categories and {notes} notes to {path} ({fmt}).')
+
+
+@notes_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(FORMATS), default=None,
+              help='Defaults to markdown for .zip paths and jsonl otherwise.')
+@click.option('--batch-size', default=None, type=int, help='Records per transaction.')
+@click.option('--restart', is_flag=True, help='Ignore saved progress and start from the beginning.')
+def import_command(path, fmt, batch_size, restart):
+    """Import categories and notes from an export file, resuming if interrupted."""
+    fmt = _format_for(path, fmt)
+    batch_size = batch_size or current_app.config['TRANSFER_BATCH_SIZE']
+    categories, notes, skipped = import_notes(path, fmt, batch_size, resume=not restart)
+    if skipped:
+        click.echo(f'Resumed after {skipped} records imported earlier.')
+    click.echo(f'Imported {notes} notes and {categories} new categories from {path}.')
@@ -0,0 +1,7 @@
+"""
+Reproducible benchmarks for the app: synthetic corpora, request scenarios
+driven through the Flask test client and a local WSGI server, and JSON
+reports of latency percentiles, throughput and peak RSS.
+
+Run with `python -m benchmarks run --help`.
+"""
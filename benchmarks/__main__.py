@@ -0,0 +1,205 @@
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import click
+
+from app import create_app
+from app.rendering import RENDER_VERSION, render_cache
+from app.caching import page_cache
+from app.pagination import count_cache
+from config import ProductionConfig, basedir, config
+from .corpus import CORPUS_SIZES, CORPUS_VERSION, prepare_database
+from .harness import DRIVERS, SCENARIOS, Workload, dump, peak_rss_mb, run_scenario
+from .startup import TARGETS, StartupError, measure
+
+DEFAULT_CACHE_DIR = os.path.join(basedir, 'instance', 'benchmarks')
+
+
+def build_app(uri, workdir=None):
+    """An app with production settings on `uri`; background refresh and the N+1 guard are off."""
+    class BenchmarkConfig(ProductionConfig):
+        SQLALCHEMY_DATABASE_URI = uri
+        MARKDOWN_CACHE_DIR = os.path.join(workdir, 'render_cache') if workdir else None
+        RENDER_BACKGROUND_REFRESH = False
+        QUERY_COUNT_LIMIT = None
+
+    config['benchmark'] = BenchmarkConfig
+    return create_app('benchmark')
+
+
+_CACHE_COUNTERS = ('hits', 'misses', 'evictions', 'purges', 'disk_hits', 'disk_writes')
+
+
+def _cache_stats(before, after):
+    """Cache stats with the counters limited to what happened since `before`."""
+    return {key: value - before.get(key, 0) if key in _CACHE_COUNTERS else value
+            for key, value in after.items()}
+
+
+def _git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+@click.group()
+def cli():
+    """Benchmarks for the study_web Flask app."""
+
+
+@cli.command('run')
+@click.option('--notes', 'note_count', default=1_000, type=int, show_default=True,
+              help=f'Corpus size; {", ".join(map(str, CORPUS_SIZES))} are the reference sizes.')
+@click.option('--seed', default=1, type=int, show_default=True, help='Seed for the corpus and the request mix.')
+@click.option('--driver', 'drivers', multiple=True, type=click.Choice(sorted(DRIVERS)),
+              help='How requests reach the app (default: all).')
+@click.option('--scenario', 'scenarios', multiple=True, type=click.Choice(SCENARIOS),
+              help='Scenarios to run (default: all).')
+@click.option('--requests', 'request_count', default=200, type=int, show_default=True,
+              help='Measured requests per scenario.')
+@click.option('--warmup', default=20, type=int, show_default=True, help='Unmeasured requests per scenario.')
+@click.option('--concurrency', default=4, type=int, show_default=True,
+              help='Client threads for the WSGI server driver.')
+@click.option('--cache-dir', default=DEFAULT_CACHE_DIR, show_default=True,
+              help='Where generated corpora are kept between runs.')
+@click.option('--output', '-o', default='-', help='JSON result file (default: stdout).')
+def run_command(note_count, seed, drivers, scenarios, request_count, warmup, concurrency, cache_dir, output):
+    """Run every scenario through each driver and report latency, throughput and RSS."""
+    drivers = drivers or tuple(DRIVERS)
+    scenarios = scenarios or SCENARIOS
+    results = {
+        'meta': {
+            'git_revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'corpus_version': CORPUS_VERSION,
+            'render_version': RENDER_VERSION,
+            'notes': note_count,
+            'seed': seed,
+            'requests': request_count,
+            'warmup': warmup,
+            'concurrency': concurrency,
+        },
+        'results': {},
+        'caches': {},
+    }
+
+    workdir = tempfile.mkdtemp(prefix='study-web-bench-')
+    try:
+        for driver_name in drivers:
+            # Each driver starts from a fresh copy of the corpus and cold caches
+            started = time.perf_counter()
+            target = os.path.join(workdir, f'{driver_name}.db')
+            prepare_database(cache_dir, target, note_count, seed,
+                             lambda uri: build_app(uri, workdir))
+            click.echo(f'[{driver_name}] corpus of {note_count} notes ready '
+                       f'in {time.perf_counter() - started:.1f}s', err=True)
+
+            app = build_app(f'sqlite:///{target}', os.path.join(workdir, driver_name))
+            render_cache.clear()
+            count_cache.clear()
+            workload = Workload(app, seed)
+            images_dir = os.path.join(app.static_folder, 'images')
+            existing = set(os.listdir(images_dir)) if os.path.isdir(images_dir) else set()
+
+            caches_before = {'render': render_cache.stats(), 'page': page_cache.stats()}
+            driver_results = results['results'][driver_name] = {}
+            driver = DRIVERS[driver_name](app, concurrency)
+            try:
+                with driver:
+                    for scenario in scenarios:
+                        requests = workload.requests(scenario, warmup + request_count)
+                        summary = run_scenario(driver, requests, warmup)
+                        driver_results[scenario] = summary
+                        click.echo(f"[{driver_name}] {scenario}: p50 {summary['p50_ms']} ms, "
+                                   f"p95 {summary['p95_ms']} ms, {summary['throughput_rps']} req/s, "
+                                   f"{summary['errors']} errors", err=True)
+            finally:
+                workload.cleanup(images_dir, existing)
+            results['caches'][driver_name] = {
+                'render': _cache_stats(caches_before['render'], render_cache.stats()),
+                'page': _cache_stats(caches_before['page'], page_cache.stats()),
+            }
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    results['meta']['peak_rss_mb'] = peak_rss_mb()
+    dump(results, output)
+
+
+@cli.command('startup')
+@click.option('--target', 'targets', multiple=True, type=click.Choice(sorted(TARGETS)),
+              help='Entry points to start (default: all).')
+@click.option('--runs', default=5, type=int, show_default=True, help='Measured starts per entry point.')
+@click.option('--output', '-o', default='-', help='JSON result file (default: stdout).')
+def startup_command(targets, runs, output):
+    """Time cold starts of the app, `flask shell` and migrate_categories.py with -X importtime."""
+    results = {
+        'meta': {
+            'git_revision': _git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'runs': runs,
+        },
+        'results': {'startup': {}},
+    }
+    workdir = tempfile.mkdtemp(prefix='study-web-startup-')
+    try:
+        for name in targets or tuple(TARGETS):
+            try:
+                summary = measure(name, runs, workdir)
+            except StartupError as error:
+                raise click.ClickException(str(error))
+            results['results']['startup'][name] = summary
+            heaviest = ', '.join(f"{item['module']} {item['ms']}" for item in summary['heaviest_imports'][:3])
+            click.echo(f"[startup] {name}: p50 {summary['p50_ms']} ms, imports {summary['import_ms']} ms "
+                       f"({summary['modules']} modules; {heaviest})", err=True)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    dump(results, output)
+
+
+@cli.command('compare')
+@click.argument('baseline', type=click.Path(exists=True, dir_okay=False))
+@click.argument('current', type=click.Path(exists=True, dir_okay=False))
+@click.option('--metric', default='p95_ms', show_default=True, help='Latency metric to compare.')
+@click.option('--threshold', default=0.15, type=float, show_default=True,
+              help='Relative slowdown reported as a regression.')
+def compare_command(baseline, current, metric, threshold):
+    """Compare two result files; exits with status 1 if any scenario regressed."""
+    with open(baseline, encoding='utf-8') as f:
+        before = json.load(f)
+    with open(current, encoding='utf-8') as f:
+        after = json.load(f)
+    for key in ('notes', 'seed', 'requests', 'corpus_version', 'runs'):
+        if before['meta'].get(key) != after['meta'].get(key):
+            click.echo(f"Warning: runs differ in {key} "
+                       f"({before['meta'].get(key)} vs {after['meta'].get(key)})", err=True)
+
+    regressions = 0
+    for driver, scenarios in after['results'].items():
+        for scenario, summary in scenarios.items():
+            old = before['results'].get(driver, {}).get(scenario, {}).get(metric)
+            new = summary.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else 0.0
+            flag = ''
+            if change > threshold:
+                flag = '  REGRESSION'
+                regressions += 1
+            click.echo(f'{driver:12} {scenario:14} {metric} {old:9.2f} -> {new:9.2f} ({change:+.0%}){flag}')
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    cli(prog_name='python -m benchmarks')
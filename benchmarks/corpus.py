@@ -0,0 +1,161 @@
+import os
+import random
+import shutil
+from datetime import datetime, timedelta
+
+from app import db
+from app.caching import CategoryCache, bump_version, category_cache
+from app.schema import upgrade_schema
+from app.search import rebuild_index
+from app.transfer import NoteImporter
+
+# Bump when the generator changes, so cached corpora are rebuilt
+CORPUS_VERSION = 1
+
+_TERMS = [
+    '碳盤查', '溫室氣體', '排放係數', '範疇一', '範疇二', '範疇三', '組織邊界', '營運邊界',
+    '活動數據', '盤查報告書', '第三方查驗', '碳足跡', '生命週期評估', '減量目標', '碳權',
+    '能源管理', '再生能源', '電力排放係數', '不確定性分析', '數據品質', '供應鏈', '淨零排放',
+    '碳定價', '內部碳價', '碳邊境調整機制', '永續報告書', '氣候相關財務揭露', '基準年',
+]
+_VERBS = ['建立', '確認', '計算', '檢視', '整合', '彙整', '評估', '追蹤', '揭露', '改善']
+_STANDARDS = ['ISO 14064-1', 'ISO 14067', 'GHG Protocol', 'ISO 50001', 'SBTi', 'TCFD', 'CBAM']
+_CATEGORIES = [
+    '基礎知識', '法規遵循', '計算方法', '查驗實務', '減量策略', '能源管理', '產品碳足跡',
+    '供應鏈管理', '揭露框架', '案例研究', '工具與系統', '國際趨勢',
+]
+_CODE = '''```python
+def emissions(activity, factor, gwp=1.0):
+    return activity * factor * gwp
+```'''
+
+CORPUS_SIZES = (1_000, 10_000, 100_000)
+
+
+def _sentence(rng):
+    term, other = rng.sample(_TERMS, 2)
+    return f'{rng.choice(_VERBS)}{term}與{other}的關係，並依照{rng.choice(_STANDARDS)}的要求記錄。'
+
+
+def _paragraph(rng):
+    sentences = ''.join(_sentence(rng) for _ in range(rng.randint(2, 5)))
+    # Emphasis the way the seed note uses it
+    term = rng.choice(_TERMS)
+    return sentences.replace(term, f'**{term}**', 1)
+
+
+def _image(rng):
+    digest = '%032x' % rng.getrandbits(128)
+    return f'![{rng.choice(_TERMS)}示意圖](/static/images/{digest}.png)'
+
+
+def note_content(rng):
+    """A Markdown body shaped like the seed note: headings, lists, emphasis, code, images."""
+    parts = [f'# {rng.choice(_TERMS)}概述', _paragraph(rng)]
+    for section in range(rng.randint(2, 5)):
+        parts.append(f'## {section + 1}. {rng.choice(_TERMS)}')
+        parts.append(_paragraph(rng))
+        parts.append('\n'.join(f'- {rng.choice(_VERBS)}{rng.choice(_TERMS)}'
+                               for _ in range(rng.randint(2, 6))))
+        if rng.random() < 0.25:
+            parts.append(_image(rng))
+        if rng.random() < 0.15:
+            parts.append(_CODE)
+    return '\n\n'.join(parts)
+
+
+def search_terms():
+    """Words that occur throughout the corpus, for building search queries."""
+    return _TERMS + _STANDARDS
+
+
+def tag_pool(size=200):
+    tags = list(_TERMS) + list(_STANDARDS)
+    number = 1
+    while len(tags) < size:
+        tags.append(f'{_TERMS[number % len(_TERMS)]}-{number}')
+        number += 1
+    return tags
+
+
+def generate_records(count, seed=1):
+    """
+    Yield `count` note records in the import format of app.transfer.
+
+    The same (count, seed) always yields the same records; tags follow a
+    long-tailed distribution so a few are on most notes.
+    """
+    rng = random.Random(seed)
+    tags = tag_pool()
+    weights = [1 / (rank + 1) for rank in range(len(tags))]
+    start = datetime(2024, 1, 1)
+    for number in range(count):
+        created = start + timedelta(minutes=7 * number)
+        updated = created + timedelta(minutes=rng.randint(0, 60 * 24 * 30))
+        yield {
+            'type': 'note',
+            'title': f'{rng.choice(_TERMS)}{rng.choice(_VERBS)}筆記 #{number + 1}',
+            'category': rng.choice(_CATEGORIES),
+            'tags': sorted(set(rng.choices(tags, weights, k=rng.randint(1, 5)))),
+            'created_at': created.isoformat(),
+            'updated_at': updated.isoformat(),
+            'content': note_content(rng),
+        }
+
+
+def corpus_path(cache_dir, count, seed):
+    return os.path.join(cache_dir, f'corpus-v{CORPUS_VERSION}-{count}-s{seed}.db')
+
+
+def populate(app, count, seed=1, batch_size=500):
+    """Fill the app's (empty) database with a synthetic corpus."""
+    with app.app_context():
+        upgrade_schema()
+        importer = NoteImporter(app.config['EXCERPT_LENGTH'])
+        batch = []
+        for record in generate_records(count, seed):
+            batch.append(record)
+            if len(batch) >= batch_size:
+                with db.engine.begin() as connection:
+                    importer.add_batch(connection, batch)
+                batch = []
+        with db.engine.begin() as connection:
+            if batch:
+                importer.add_batch(connection, batch)
+            bump_version(CategoryCache.VERSION_NAME, connection)
+        if not importer.notes:
+            return 0
+        # The importer indexes as it goes; rebuilding keeps the FTS table compact
+        rebuild_index()
+        with db.engine.connect() as connection:
+            connection.exec_driver_sql('ANALYZE')
+            connection.commit()
+        category_cache.invalidate()
+        return importer.notes
+
+
+def prepare_database(cache_dir, target, count, seed, build_app):
+    """
+    Copy a cached corpus to `target`, generating it first if needed.
+
+    `build_app(uri)` returns an app bound to that database. Every run starts
+    from a byte-identical copy, so results are comparable between runs.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    cached = corpus_path(cache_dir, count, seed)
+    if not os.path.exists(cached):
+        building = cached + '.building'
+        for suffix in ('', '-wal', '-shm'):
+            if os.path.exists(building + suffix):
+                os.remove(building + suffix)
+        app = build_app(f'sqlite:///{building}')
+        populate(app, count, seed)
+        with app.app_context():
+            # Fold the WAL into the main file so a plain copy is complete
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql('PRAGMA wal_checkpoint(TRUNCATE)')
+            for engine in db.engines.values():
+                engine.dispose()
+        os.replace(building, cached)
+    shutil.copyfile(cached, target)
+    return target
@@ -0,0 +1,306 @@
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+from werkzeug.serving import WSGIRequestHandler, make_server
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from app import db
+from app.images import content_filename, image_processor
+from app.models import Category, LearningNote
+from .corpus import search_terms
+
+SCENARIOS = ('index', 'index_scroll', 'search', 'category_view', 'view_note', 'upload_image')
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process so far, or None where unavailable."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS and in KiB elsewhere
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def percentile(sorted_values, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, round(pct / 100 * len(sorted_values)) - 1))
+    return sorted_values[rank]
+
+
+def summarize(latencies, errors, elapsed):
+    """Latency percentiles (ms) and throughput for one scenario."""
+    ms = sorted(value * 1000 for value in latencies)
+    return {
+        'requests': len(latencies) + errors,
+        'errors': errors,
+        'p50_ms': _round(percentile(ms, 50)),
+        'p95_ms': _round(percentile(ms, 95)),
+        'p99_ms': _round(percentile(ms, 99)),
+        'mean_ms': _round(statistics.fmean(ms)) if ms else None,
+        'max_ms': _round(ms[-1]) if ms else None,
+        'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed else None,
+        'peak_rss_mb': peak_rss_mb(),
+    }
+
+
+def _round(value):
+    return None if value is None else round(value, 3)
+
+
+# --- Requests -----------------------------------------------------------------
+
+class Request:
+    """One HTTP request of a scenario; `files` maps a field to (filename, bytes)."""
+
+    def __init__(self, method, path, headers=None, files=None):
+        self.method = method
+        self.path = path
+        self.headers = headers or {}
+        self.files = files
+
+
+def synthetic_image(rng, width=1600, height=1200):
+    """A PNG larger than MAX_IMAGE_WIDTH, so the upload is actually resized."""
+    img = Image.new('RGB', (width, height), tuple(rng.randrange(256) for _ in range(3)))
+    # A few random blocks make every image (and its content hash) distinct
+    for _ in range(8):
+        x, y = rng.randrange(width - 100), rng.randrange(height - 100)
+        img.paste(tuple(rng.randrange(256) for _ in range(3)), (x, y, x + 100, y + 100))
+    buffer = io.BytesIO()
+    img.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+class Workload:
+    """
+    Builds the request list of each scenario from the corpus.
+
+    Everything is drawn from a seeded RNG, so the same corpus and seed
+    produce the same request sequence on every run.
+    """
+
+    def __init__(self, app, seed=1):
+        self.app = app
+        self.seed = seed
+        with app.app_context():
+            self.note_ids = db.session.execute(db.select(LearningNote.id)).scalars().all()
+            self.category_names = db.session.execute(db.select(Category.name)).scalars().all()
+        self.uploaded = []
+
+    def _rng(self, scenario):
+        return random.Random(f'{self.seed}:{scenario}')
+
+    def requests(self, scenario, count):
+        return getattr(self, f'_{scenario}')(self._rng(scenario), count)
+
+    def _index(self, rng, count):
+        return [Request('GET', '/') for _ in range(count)]
+
+    def _index_scroll(self, rng, count):
+        # Follow the infinite-scroll cursor chain once to get real cursors
+        cursors = []
+        with self.app.test_client() as client:
+            cursor = None
+            while len(cursors) < 20:
+                response = client.get('/', query_string={'cursor': cursor} if cursor else None,
+                                      headers={'X-Requested-With': 'XMLHttpRequest'})
+                cursor = response.headers.get('X-Next-Cursor')
+                if not cursor:
+                    break
+                cursors.append(cursor)
+        if not cursors:
+            return self._index(rng, count)
+        return [Request('GET', f'/?cursor={rng.choice(cursors)}',
+                        headers={'X-Requested-With': 'XMLHttpRequest'}) for _ in range(count)]
+
+    def _search(self, rng, count):
+        terms = search_terms()
+        queries = []
+        for _ in range(count):
+            query = rng.choice(terms)
+            if rng.random() < 0.3:
+                query += ' ' + rng.choice(terms)
+            queries.append(Request('GET', '/search?' + urllib.parse.urlencode({'q': query})))
+        return queries
+
+    def _category_view(self, rng, count):
+        return [Request('GET', '/category/' + urllib.parse.quote(rng.choice(self.category_names)))
+                for _ in range(count)]
+
+    def _view_note(self, rng, count):
+        # A hot set of popular notes plus a long tail of cold ones
+        hot = rng.sample(self.note_ids, min(50, len(self.note_ids)))
+        return [Request('GET', f'/notes/{rng.choice(hot if rng.random() < 0.8 else self.note_ids)}')
+                for _ in range(count)]
+
+    def _upload_image(self, rng, count):
+        requests = []
+        # Every fourth upload repeats an earlier image and hits the dedup path
+        for number in range(count):
+            if number % 4 == 3 and requests:
+                files = rng.choice(requests).files
+            else:
+                files = {'file': (f'bench-{number}.png', synthetic_image(rng))}
+                self.uploaded.append(files['file'][1])
+            requests.append(Request('POST', '/notes/upload_image', files=files))
+        return requests
+
+    def cleanup(self, images_dir, existing):
+        """Remove the files the upload scenario created (originals and variants)."""
+        image_processor.wait_idle()
+        for data in self.uploaded:
+            digest = content_filename(io.BytesIO(data), 'png').rsplit('.', 1)[0]
+            for name in os.listdir(images_dir):
+                if name.startswith(digest) and name not in existing:
+                    os.remove(os.path.join(images_dir, name))
+        self.uploaded = []
+
+
+# --- Drivers ------------------------------------------------------------------
+
+class TestClientDriver:
+    """
+    Calls the app in-process through the Flask test client.
+
+    There is no network or server overhead, and requests always run one at
+    a time, whatever the concurrency.
+    """
+
+    name = 'test_client'
+
+    def __init__(self, app, concurrency=1):
+        self.app = app
+        self.concurrency = 1
+
+    def __enter__(self):
+        self.client = self.app.test_client()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.client = None
+
+    def send(self, req):
+        data = None
+        if req.files:
+            data = {field: (io.BytesIO(body), filename) for field, (filename, body) in req.files.items()}
+        response = self.client.open(req.path, method=req.method, headers=req.headers,
+                                    data=data, content_type='multipart/form-data' if data else None)
+        response.get_data()
+        return response.status_code
+
+
+def _multipart(files):
+    boundary = uuid.uuid4().hex
+    body = io.BytesIO()
+    for field, (filename, content) in files.items():
+        body.write(f'--{boundary}\r\n'.encode())
+        body.write(f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'.encode())
+        body.write(b'Content-Type: application/octet-stream\r\n\r\n')
+        body.write(content)
+        body.write(b'\r\n')
+    body.write(f'--{boundary}--\r\n'.encode())
+    return body.getvalue(), f'multipart/form-data; boundary={boundary}'
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+class WSGIServerDriver:
+    """Serves the app on a local threaded Werkzeug server and sends real HTTP requests."""
+
+    name = 'wsgi_server'
+
+    def __init__(self, app, concurrency=4):
+        self.app = app
+        self.concurrency = concurrency
+
+    def __enter__(self):
+        self.server = make_server('127.0.0.1', 0, self.app, threaded=True,
+                                  request_handler=_QuietHandler)
+        self.base_url = f'http://127.0.0.1:{self.server.server_port}'
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.server.shutdown()
+        self.thread.join()
+
+    def send(self, req):
+        data = None
+        headers = dict(req.headers)
+        if req.files:
+            data, headers['Content-Type'] = _multipart(req.files)
+        request = urllib.request.Request(self.base_url + req.path, data=data,
+                                         headers=headers, method=req.method)
+        try:
+            with urllib.request.urlopen(request, timeout=60) as response:
+                response.read()
+                return response.status
+        except urllib.error.HTTPError as error:
+            return error.code
+
+
+DRIVERS = {driver.name: driver for driver in (TestClientDriver, WSGIServerDriver)}
+
+
+def run_scenario(driver, requests, warmup):
+    """Send `requests` through `driver`; the first `warmup` are not measured."""
+    for req in requests[:warmup]:
+        driver.send(req)
+    measured = requests[warmup:]
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+
+    def timed(req):
+        nonlocal errors
+        started = time.perf_counter()
+        try:
+            status = driver.send(req)
+        except Exception:
+            status = None
+        elapsed = time.perf_counter() - started
+        with lock:
+            if status is not None and status < 400:
+                latencies.append(elapsed)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    if driver.concurrency > 1:
+        with ThreadPoolExecutor(max_workers=driver.concurrency) as pool:
+            list(pool.map(timed, measured))
+    else:
+        for req in measured:
+            timed(req)
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+def dump(results, path):
+    text = json.dumps(results, ensure_ascii=False, indent=2, sort_keys=True)
+    if path == '-':
+        print(text)
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text + '\n')
@@ -0,0 +1,78 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+from config import basedir
+
+# Entry points timed in a fresh interpreter; `flask shell` exits at once
+# because its stdin is closed.
+TARGETS = {
+    'create_app': ['-c', "from app import create_app; create_app('default')"],
+    'flask_shell': ['-m', 'flask', '--app', 'wsgi', 'shell'],
+    'migrate_categories': ['migrate_categories.py'],
+}
+
+
+class StartupError(RuntimeError):
+    pass
+
+
+def parse_importtime(stderr):
+    """
+    Total import time (ms), module count and the heaviest top-level imports
+    from the `-X importtime` report in `stderr`.
+    """
+    top_level = {}
+    modules = 0
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|', 2)
+        modules += 1
+        # Nested imports are indented below the module that triggered them
+        if not name[1:2].isspace():
+            top_level[name.strip()] = int(cumulative) / 1000
+    heaviest = sorted(top_level.items(), key=lambda item: item[1], reverse=True)
+    return round(sum(top_level.values()), 1), modules, heaviest
+
+
+def run_once(args, env):
+    started = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=basedir, env=env,
+                          stdin=subprocess.DEVNULL, capture_output=True, text=True)
+    elapsed = time.perf_counter() - started
+    if proc.returncode:
+        output = [line for line in (proc.stdout + proc.stderr).splitlines()
+                  if not line.startswith('import time:')]
+        raise StartupError(f"{' '.join(args)} exited with {proc.returncode}:\n" + '\n'.join(output[-20:]))
+    return elapsed, proc.stderr
+
+
+def measure(name, runs, workdir, top=10):
+    """Wall time and import time of starting `name` (see TARGETS) `runs` times."""
+    uri = f"sqlite:///{os.path.join(workdir, 'startup.db')}"
+    env = dict(os.environ, DEV_DATABASE_URL=uri, DATABASE_URL=uri,
+               MARKDOWN_CACHE_DIR=os.path.join(workdir, 'render_cache'))
+    env.pop('FLASK_APP', None)
+    # Unmeasured: writes bytecode caches and creates the database
+    run_once(TARGETS[name], env)
+
+    wall, imports = [], []
+    for _ in range(runs):
+        elapsed, stderr = run_once(TARGETS[name], env)
+        wall.append(elapsed * 1000)
+        imports.append(parse_importtime(stderr))
+    import_ms = [total for total, _, _ in imports]
+    _, modules, heaviest = imports[import_ms.index(statistics.median_low(import_ms))]
+    wall.sort()
+    return {
+        'runs': runs,
+        'p50_ms': round(statistics.median(wall), 1),
+        'min_ms': round(wall[0], 1),
+        'max_ms': round(wall[-1], 1),
+        'import_ms': round(statistics.median(import_ms), 1),
+        'modules': modules,
+        'heaviest_imports': [{'module': module, 'ms': round(ms, 1)} for module, ms in heaviest[:top]],
+    }
@@ -8,27 +8,151 @@ class Config:
     SECRET_KEY = os.environ.get('SECRET_KEY') or 'a-very-secret-key-that-you-should-change'
     ADMIN_PASSWORD = os.environ.get('ADMIN_PASSWORD') or 'admin1234'
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # Connection pool of each engine (SQLite file databases use a QueuePool)
+    SQLALCHEMY_ENGINE_OPTIONS = {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE') or 5),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW') or 10),
+        'pool_timeout': 10,
+    }
+    # Applied to every new SQLite connection. WAL lets readers keep reading
+    # while a note is being saved; busy_timeout (ms) makes a second writer
+    # wait instead of failing with "database is locked".
+    SQLITE_PRAGMAS = {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 256 * 1024 * 1024,
+        'cache_size': -32000,  # KiB
+        'temp_store': 'MEMORY',
+    }
+    # index, search and view_note read through a separate read-only engine:
+    # READ_DATABASE_URL if set, otherwise the same SQLite file opened with mode=ro
+    SQLALCHEMY_READ_DATABASE_URI = os.environ.get('READ_DATABASE_URL')
+    SQLITE_READ_ONLY_ROUTE = True
     NOTES_PER_PAGE = 9
+    # Seconds a listing's total note count may be reused
+    LISTING_COUNT_TTL = 60
+    TAG_CLOUD_SIZE = 30
+    # Seconds between checks of the shared category version stamp
+    CATEGORY_CACHE_CHECK_INTERVAL = 2
+    # Rendered view_note pages kept per process for non-admin viewers
+    PAGE_CACHE_SIZE = 128
+
+    # N+1 guard: log (or raise) when one request issues more SQL statements
+    QUERY_COUNT_LIMIT = None
+    QUERY_COUNT_RAISE = False
+
+    # Instrumentation: Server-Timing headers (always sent to admins), the
+    # Prometheus /metrics endpoint (open when METRICS_PUBLIC and no
+    # METRICS_TOKEN is set, otherwise for the token and admins only) and
+    # per-request profiles for admins sending "X-Profile: cprofile|pyinstrument"
+    SERVER_TIMING = False
+    METRICS_ENABLED = True
+    METRICS_PUBLIC = True
+    METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
+    PROFILING_ENABLED = True
+    PROFILE_DIR = os.path.join(basedir, 'instance', 'profiles')
+    PROFILE_KEEP = 50
+
+    # Asset bundles get a content hash in their file name (see app/bundles.py);
+    # the manifest maps each bundle to its current hash
+    ASSETS_VERSIONS = 'hash'
+    ASSETS_URL_EXPIRE = False
+    ASSETS_MANIFEST = 'json:' + os.path.join(basedir, 'app', 'static', 'gen', 'manifest.json')
+    ASSETS_AUTO_BUILD = True
 
     # Image Upload Settings
     UPLOAD_FOLDER = os.path.join(basedir, 'app', 'static', 'images')
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp'}
     MAX_IMAGE_WIDTH = 800
     IMAGE_QUALITY = 85
+    # Resizing runs on a background thread pool; beyond IMAGE_QUEUE_SIZE
+    # pending jobs an upload is processed inline
+    IMAGE_ASYNC = True
+    IMAGE_WORKERS = int(os.environ.get('IMAGE_WORKERS') or 2)
+    IMAGE_QUEUE_SIZE = 32
+    # Larger sources are rejected as decompression bombs
+    IMAGE_MAX_PIXELS = 64_000_000
+    # Responsive variants written next to each upload (formats Pillow can't encode are skipped)
+    IMAGE_VARIANT_WIDTHS = (320, 640, 800)
+    IMAGE_VARIANT_FORMATS = ('avif', 'webp')
+    # 'flask images gc' leaves unreferenced uploads younger than this alone
+    # (an image is uploaded before its note is saved)
+    IMAGE_GC_GRACE_HOURS = 24
+
+    # Markdown Render Cache Settings
+    MARKDOWN_CACHE_SIZE = int(os.environ.get('MARKDOWN_CACHE_SIZE') or 256)
+    # Optional directory tier that survives restarts (disabled when empty)
+    MARKDOWN_CACHE_DIR = os.environ.get('MARKDOWN_CACHE_DIR')
+    # Rows rendered under an older configuration are re-rendered in the background
+    RENDER_BACKGROUND_REFRESH = True
+    RENDER_BATCH_SIZE = 100
+    EXCERPT_LENGTH = 100
+    # 'flask notes export/import': rows per fetch / records per transaction
+    TRANSFER_BATCH_SIZE = 500
+    # JSON API (/api/v1): page sizes, ids per batch fetch, NDJSON batch size
+    # and the smallest response worth gzipping
+    API_PAGE_SIZE = 50
+    API_MAX_PAGE_SIZE = 200
+    API_MAX_IDS = 100
+    API_STREAM_BATCH = 500
+    API_GZIP_MIN_SIZE = 1024
+    # Note history: 'zstd' needs the zstandard package and falls back to zlib
+    REVISION_CODEC = os.environ.get('REVISION_CODEC') or 'zstd'
+    # A full revision at least every N saves bounds how many deltas a read decodes
+    REVISION_SNAPSHOT_INTERVAL = 20
+    # Defaults for 'flask revisions compact'; None keeps everything
+    REVISION_KEEP = None
+    REVISION_KEEP_DAYS = None
+    # Related notes (app/relations.py): list length, terms stored and compared
+    # per note, and how common a term or tag may be before it is ignored
+    RELATED_NOTES_LIMIT = 6
+    RELATED_TERMS_PER_NOTE = 48
+    RELATED_QUERY_TERMS = 16
+    RELATED_MAX_POSTINGS = 1000
+    # Added to the term similarity (0..1) for shared tags (all of them) and the same category
+    RELATED_TAG_WEIGHT = 0.3
+    RELATED_CATEGORY_WEIGHT = 0.1
+    # Search-as-you-type (/search/suggest): results per kind, seconds between
+    # checks of the shared version stamp, indexed key length and keys per
+    # name, and the most index entries one lookup may scan
+    SUGGEST_LIMIT = 8
+    SUGGEST_MAX_LIMIT = 20
+    SUGGEST_CHECK_INTERVAL = 2
+    SUGGEST_KEY_LENGTH = 10
+    SUGGEST_KEYS_PER_NAME = 24
+    SUGGEST_SCAN_LIMIT = 2000
 
 class DevelopmentConfig(Config):
     """開發環境設定"""
+    QUERY_COUNT_LIMIT = 10
+    SERVER_TIMING = True
     SQLALCHEMY_DATABASE_URI = os.environ.get('DEV_DATABASE_URL') or         'sqlite:///' + os.path.join(basedir, 'instance', 'carbon_learning.db')
 
 class TestingConfig(Config):
     """測試環境設定"""
     TESTING = True
+    RENDER_BACKGROUND_REFRESH = False
+    QUERY_COUNT_LIMIT = 10
+    QUERY_COUNT_RAISE = True
+    IMAGE_ASYNC = False
+    # The in-memory database uses a single static connection
+    SQLALCHEMY_ENGINE_OPTIONS = {}
     SQLALCHEMY_DATABASE_URI = os.environ.get('TEST_DATABASE_URL') or 'sqlite:///:memory:'
 
 class ProductionConfig(Config):
     """生產環境設定"""
+    # Bundles come from 'flask bundles build' (run by gunicorn.conf.py and serve.py)
+    ASSETS_AUTO_BUILD = False
+    # Endpoint names, request rates and cache internals are not for everyone
+    METRICS_PUBLIC = False
+    MARKDOWN_CACHE_DIR = os.environ.get('MARKDOWN_CACHE_DIR') or \
+        os.path.join(basedir, 'instance', 'render_cache')
+    # Where the original './instance/carbon_learning.db' resolved: Flask-SQLAlchemy
+    # puts relative SQLite paths under the instance folder. Spelled out so it
+    # can never be mistaken for the development database.
     SQLALCHEMY_DATABASE_URI = os.environ.get('DATABASE_URL') or \
-        'sqlite:///./instance/carbon_learning.db'
+        'sqlite:///' + os.path.join(basedir, 'instance', 'instance', 'carbon_learning.db')
 
 # 建立一個字典，方便根據環境名稱來選取設定
 config = {
@@ -0,0 +1,54 @@
+# Gunicorn settings for `gunicorn -c gunicorn.conf.py wsgi:app`.
+# Reload gracefully with `kill -HUP $(cat instance/gunicorn.pid)`: the
+# schema upgrade and bundle build run again, then new workers start on the
+# new code while old ones finish their requests.
+import multiprocessing
+import os
+import subprocess
+import sys
+
+basedir = os.path.abspath(os.path.dirname(__file__))
+
+bind = os.environ.get('WEB_BIND') or '0.0.0.0:5006'
+workers = int(os.environ.get('WEB_WORKERS') or multiprocessing.cpu_count())
+# gthread workers serve WEB_THREADS requests at once each
+worker_class = 'gthread'
+threads = int(os.environ.get('WEB_THREADS') or 4)
+# Each worker imports the app itself, so engines, caches and the image
+# thread pool are never shared across a fork
+preload_app = False
+timeout = 60
+graceful_timeout = 30
+keepalive = 5
+# Recycle workers now and then so slow leaks can't accumulate
+max_requests = 2000
+max_requests_jitter = 200
+pidfile = os.path.join(basedir, 'instance', 'gunicorn.pid')
+accesslog = '-'
+
+
+def _prepare(server):
+    # A separate interpreter does the work: app modules imported into the
+    # master would be inherited by every worker it forks, so a reload would
+    # keep serving the old code.
+    for command in (['init_db'], ['bundles', 'build']):
+        result = subprocess.run([sys.executable, '-m', 'flask', '--app', 'wsgi'] + command,
+                                cwd=basedir, capture_output=True, text=True)
+        for line in (result.stdout + result.stderr).splitlines():
+            server.log.info('%s: %s', ' '.join(command), line)
+        if result.returncode:
+            raise RuntimeError(f"'flask {' '.join(command)}' failed with exit status {result.returncode}")
+
+
+def on_starting(server):
+    """Upgrade the database and build the asset bundles once, before any worker starts."""
+    _prepare(server)
+
+
+def on_reload(server):
+    """Redo the setup on SIGHUP, so new workers find the schema and bundles their code expects."""
+    try:
+        _prepare(server)
+    except RuntimeError as exc:
+        # The old workers are replaced anyway; keep the master running
+        server.log.error('%s', exc)
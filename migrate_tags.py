@@ -0,0 +1,69 @@
+import os
+from app import create_app, db
+from app.models import LearningNote, Tag, note_tags, normalize_tag_names
+import sqlalchemy as sa
+
+BATCH_SIZE = 500
+
+def run_migration():
+    """
+    One-time script to convert the 'tags' string/JSON column of every note
+    into rows of the normalized 'tag' and 'note_tag' tables.
+    Safe to run more than once: existing tags and links are left as they are.
+    """
+    print("--- Starting Tag Data Migration ---")
+    app = create_app(os.getenv('FLASK_CONFIG') or 'default')
+
+    with app.app_context():
+        engine = db.engine
+        note_table = LearningNote.__table__
+        tag_table = Tag.__table__
+
+        # Step 1: Ensure the new 'tag' and 'note_tag' tables exist.
+        print("Creating new tables (if they don't exist)...")
+        db.create_all()
+
+        # Step 2: Read every note's raw tags value in one pass.
+        with engine.connect() as connection:
+            rows = connection.execute(
+                sa.select(note_table.c.id, note_table.c.tags).where(note_table.c.tags != '')
+            ).fetchall()
+        links = [(note_id, name) for note_id, raw in rows for name in normalize_tag_names(raw)]
+
+        if not links:
+            print("No tagged notes found to migrate.")
+            print("--- Migration Finished (or was not needed) ---")
+            return
+        print(f"Found {len(links)} tag references on {len(rows)} notes.")
+
+        with engine.begin() as connection:
+            # Step 3: Insert all tag names that don't exist yet with a single executemany.
+            names = sorted({name for _, name in links})
+            existing = {name for (name,) in connection.execute(sa.select(tag_table.c.name))}
+            new_names = [name for name in names if name not in existing]
+            print(f"Found {len(names)} unique tag names, {len(new_names)} of them new.")
+            if new_names:
+                connection.execute(tag_table.insert(), [{'name': name, 'note_count': 0} for name in new_names])
+
+            # Build the name -> id map after inserting
+            tag_map = dict(connection.execute(sa.select(tag_table.c.name, tag_table.c.id)).fetchall())
+
+            # Step 4: Link notes to tags in batches; links that already exist are skipped.
+            print("Linking notes to tags...")
+            insert_link = note_tags.insert().prefix_with('OR IGNORE')
+            params = [{'note_id': note_id, 'tag_id': tag_map[name]} for note_id, name in links]
+            for start in range(0, len(params), BATCH_SIZE):
+                connection.execute(insert_link, params[start:start + BATCH_SIZE])
+
+            # Step 5: Recompute every tag's note count in one statement.
+            print("Updating tag counts...")
+            count = sa.select(sa.func.count()).where(note_tags.c.tag_id == tag_table.c.id).scalar_subquery()
+            connection.execute(tag_table.update().values(note_count=count))
+
+        print("\n--- MIGRATION COMPLETE ---")
+        print("Tags have been migrated to the new Tag model.")
+        print("The original 'tags' column is kept so the edit form can show it.")
+
+
+if __name__ == '__main__':
+    run_migration()
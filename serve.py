@@ -0,0 +1,20 @@
+"""
+Production server for Windows, where gunicorn does not run: one process
+with WEB_THREADS worker threads (waitress).
+"""
+import os
+
+from waitress import serve
+
+from wsgi import app
+from app.bundles import build_bundles
+from app.schema import init_db
+
+
+if __name__ == '__main__':
+    with app.app_context():
+        init_db()
+        build_bundles()
+    serve(app, host=os.environ.get('WEB_HOST') or '0.0.0.0',
+          port=int(os.environ.get('WEB_PORT') or 5006),
+          threads=int(os.environ.get('WEB_THREADS') or 8))
@@ -1,5 +1,5 @@
 @echo off
-echo "Starting Flask development server..."
+echo "Starting study_web server (waitress)..."
 call venv\Scripts\activate
-python run.py
+python serve.py
 pause
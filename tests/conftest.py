@@ -0,0 +1,50 @@
+import pytest
+
+from app import create_app, db
+from app.caching import category_cache
+from app.models import Category, LearningNote
+from app.suggest import suggest_index
+
+
+@pytest.fixture
+def app():
+    app = create_app('testing')
+    with app.app_context():
+        db.create_all()
+        # Process-wide caches outlive a single app
+        category_cache.invalidate()
+        suggest_index.invalidate()
+        yield app
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def category(app):
+    category = Category(name='範疇排放')
+    db.session.add(category)
+    db.session.commit()
+    return category
+
+
+@pytest.fixture
+def make_note(category):
+    def make_note(title, content, category_id=None, tags=()):
+        note = LearningNote(title=title, content=content, category_id=category_id or category.id)
+        note.set_tags(', '.join(tags))
+        db.session.add(note)
+        db.session.commit()
+        return note
+    return make_note
+
+
+@pytest.fixture
+def client(app):
+    return app.test_client()
+
+
+@pytest.fixture
+def admin_client(client):
+    with client.session_transaction() as session:
+        session['is_admin'] = True
+    return client
@@ -0,0 +1,113 @@
+import os
+import time
+
+import pytest
+
+from app import db
+from app.image_refs import ImageIndexMissing, collect_garbage, storage_usage
+from app.models import note_images
+
+DAY = 24 * 3600
+
+
+def digest(char):
+    return char * 32
+
+
+def add_upload(directory, name, age=2 * DAY, size=100):
+    path = os.path.join(directory, name)
+    with open(path, 'wb') as f:
+        f.write(b'\0' * size)
+    mtime = time.time() - age
+    os.utime(path, (mtime, mtime))
+
+
+def embed(name):
+    return f'![圖](/static/images/{name})'
+
+
+def test_sweep_keeps_referenced_uploads_and_their_variants(app, make_note, tmp_path):
+    used, unused = digest('a'), digest('b')
+    for key in (used, unused):
+        add_upload(tmp_path, f'{key}.png')
+        add_upload(tmp_path, f'{key}-320.webp')
+    make_note('排放圖表', embed(f'{used}.png'))
+
+    result = collect_garbage(str(tmp_path), DAY)
+
+    assert (result.removed, result.removed_bytes, result.kept, result.too_new) == (2, 200, 2, 0)
+    assert sorted(os.listdir(tmp_path)) == [f'{used}-320.webp', f'{used}.png']
+
+
+def test_grace_period_protects_fresh_uploads(app, make_note, tmp_path):
+    make_note('沒有圖片', '純文字。')
+    fresh, old = digest('c'), digest('d')
+    add_upload(tmp_path, f'{fresh}.png', age=60)
+    # A variant written long after its source still counts as fresh
+    add_upload(tmp_path, f'{old}.png')
+    add_upload(tmp_path, f'{old}-320.webp', age=60)
+
+    result = collect_garbage(str(tmp_path), DAY)
+
+    assert (result.removed, result.too_new) == (0, 3)
+    assert len(os.listdir(tmp_path)) == 3
+
+
+def test_dry_run_removes_nothing(app, make_note, tmp_path):
+    make_note('沒有圖片', '純文字。')
+    add_upload(tmp_path, f'{digest("e")}.png')
+
+    result = collect_garbage(str(tmp_path), DAY, dry_run=True)
+
+    assert result.removed == 1
+    assert os.listdir(tmp_path) == [f'{digest("e")}.png']
+
+
+def test_images_of_older_revisions_are_kept_unless_ignored(app, make_note, tmp_path):
+    name = f'{digest("f")}.png'
+    add_upload(tmp_path, name)
+    note = make_note('排放圖表', embed(name))
+    note.content = '圖片已移除。'
+    db.session.commit()
+
+    assert collect_garbage(str(tmp_path), DAY).removed == 0
+    assert collect_garbage(str(tmp_path), DAY, include_revisions=False).removed == 1
+    assert os.listdir(tmp_path) == []
+
+
+def test_edits_and_deletes_update_the_index(app, make_note, tmp_path):
+    first, second = f'{digest("1")}.png', f'{digest("2")}.png'
+    note = make_note('排放圖表', embed(first))
+    assert db.session.execute(db.select(note_images.c.filename)).scalars().all() == [first]
+
+    note.content = embed(second)
+    db.session.commit()
+    assert db.session.execute(db.select(note_images.c.filename)).scalars().all() == [second]
+
+    db.session.delete(note)
+    db.session.commit()
+    assert db.session.execute(db.select(note_images.c.filename)).scalars().all() == []
+
+
+def test_empty_index_is_refused(app, make_note, tmp_path):
+    make_note('排放圖表', embed(f'{digest("9")}.png'))
+    db.session.execute(note_images.delete())
+    db.session.commit()
+
+    with pytest.raises(ImageIndexMissing):
+        collect_garbage(str(tmp_path), DAY)
+
+
+def test_usage_counts_shared_images_once_per_category(app, make_note, category, tmp_path):
+    name = f'{digest("7")}.png'
+    add_upload(tmp_path, name, size=300)
+    add_upload(tmp_path, f'{digest("8")}.png', size=50)
+    make_note('圖表一', embed(name))
+    make_note('圖表二', embed(name))
+
+    usage = storage_usage(str(tmp_path))
+
+    assert (usage['total_files'], usage['total_bytes']) == (2, 350)
+    assert (usage['referenced_bytes'], usage['unreferenced_bytes']) == (300, 50)
+    assert usage['categories'] == [(category.name, 1, 300)]
+    assert [row[4] for row in usage['notes']] == [300, 300]
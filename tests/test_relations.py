@@ -0,0 +1,91 @@
+import sqlalchemy as sa
+
+from app import db
+from app.models import Category, note_relations, note_terms
+from app.relations import note_relations_for, rebuild_index
+
+
+def related_ids(note_id):
+    return [other_id for other_id, _ in note_relations_for(note_id)['related']]
+
+
+def references_to(note_id):
+    return db.session.execute(sa.select(note_relations.c.note_id).where(
+        note_relations.c.other_id == note_id, note_relations.c.kind == 'related')).scalars().all()
+
+
+def scope3_notes(make_note):
+    bodies = ['範疇三排放包含價值鏈上下游的間接排放。',
+              '運輸是範疇三排放的主要來源之一。',
+              '廢棄物處理也屬於範疇三排放。',
+              '員工通勤同樣計入範疇三排放。']
+    return [make_note(f'範疇三 {index}', body, tags=['範疇三']) for index, body in enumerate(bodies)]
+
+
+def test_similar_notes_are_related(app, make_note):
+    first, second, *_ = scope3_notes(make_note)
+    other = Category(name='再生能源')
+    db.session.add(other)
+    db.session.commit()
+    solar = make_note('Solar panels', 'Photovoltaic panels turn sunlight into electricity.', other.id)
+
+    assert second.id in related_ids(first.id)
+    assert first.id in related_ids(second.id)
+    assert solar.id not in related_ids(first.id)
+
+
+def test_edit_refills_lists_the_note_drops_out_of(app, make_note):
+    app.config['RELATED_NOTES_LIMIT'] = 2
+    notes = scope3_notes(make_note)
+    moved = notes[-1]
+    assert references_to(moved.id)
+
+    other = Category(name='再生能源')
+    db.session.add(other)
+    db.session.commit()
+    moved.title = 'Solar panels'
+    moved.content = 'Photovoltaic panels turn sunlight into electricity.'
+    moved.category_id = other.id
+    moved.set_tags('solar')
+    db.session.commit()
+
+    assert references_to(moved.id) == []
+    for note in notes[:-1]:
+        related = related_ids(note.id)
+        # Two other scope 3 notes are left to fill each list
+        assert len(related) == 2
+        assert moved.id not in related
+
+
+def test_delete_removes_the_note_and_refills_neighbours(app, make_note):
+    app.config['RELATED_NOTES_LIMIT'] = 2
+    notes = scope3_notes(make_note)
+    deleted_id = notes[-1].id
+    assert references_to(deleted_id)
+
+    db.session.delete(notes[-1])
+    db.session.commit()
+
+    assert db.session.execute(sa.select(note_relations).where(sa.or_(
+        note_relations.c.note_id == deleted_id, note_relations.c.other_id == deleted_id))).all() == []
+    assert db.session.execute(sa.select(note_terms).where(note_terms.c.note_id == deleted_id)).all() == []
+    kept = notes[:-1]
+    for note in kept:
+        assert sorted(related_ids(note.id)) == sorted(other.id for other in kept if other is not note)
+
+
+def test_backlinks_follow_edits(app, make_note):
+    target = make_note('範疇三排放', '價值鏈上下游的間接排放。')
+    source = make_note('運輸', f'參見 [範疇三](/notes/{target.id})。')
+    assert note_relations_for(target.id)['backlink'] == [(source.id, source.title)]
+
+    source.content = '不再引用。'
+    db.session.commit()
+    assert note_relations_for(target.id)['backlink'] == []
+
+
+def test_rebuild_matches_incremental_lists(app, make_note):
+    notes = scope3_notes(make_note)
+    before = {note.id: sorted(related_ids(note.id)) for note in notes}
+    assert rebuild_index(batch_size=2) == len(notes)
+    assert {note.id: sorted(related_ids(note.id)) for note in notes} == before
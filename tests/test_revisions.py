@@ -0,0 +1,41 @@
+import pytest
+
+from app import db
+from app.image_refs import collect_garbage
+from app.models import LearningNote, NoteRevision
+from app.revisions import RevisionError
+
+
+def corrupt(note_id, **values):
+    NoteRevision.query.filter_by(note_id=note_id, number=1).update(values)
+    db.session.commit()
+
+
+def test_unreadable_revision_is_reported(admin_client, make_note):
+    note = make_note('範疇三排放計算', '第一版。')
+    corrupt(note.id, content_hash='0' * 40)
+
+    response = admin_client.get(f'/notes/{note.id}/revisions/1')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith(f'/notes/{note.id}/revisions')
+
+
+def test_unreadable_revision_is_not_restored(admin_client, make_note):
+    note = make_note('範疇三排放計算', '第一版。')
+    note.content = '第二版。'
+    db.session.commit()
+    corrupt(note.id, content_hash='0' * 40)
+
+    response = admin_client.post(f'/notes/{note.id}/revisions/1/restore')
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith(f'/notes/{note.id}/revisions')
+    assert db.session.get(LearningNote, note.id).content == '第二版。'
+
+
+def test_gc_names_notes_with_unreadable_revisions(app, make_note, tmp_path):
+    note = make_note('範疇三排放計算', '第一版。')
+    corrupt(note.id, kind='delta')
+
+    with pytest.raises(RevisionError, match=f'notes {note.id};'):
+        collect_garbage(str(tmp_path), 0)
+    assert collect_garbage(str(tmp_path), 0, include_revisions=False).removed == 0
@@ -0,0 +1,116 @@
+import pytest
+
+from app import db
+from app.instrumentation import QueryCountExceeded
+from app.models import Category, LearningNote
+from app.rendering import render_cache
+
+
+@pytest.fixture
+def notes(make_note, category):
+    # More than a page, spread over two categories and a few tags
+    other = Category(name='再生能源')
+    db.session.add(other)
+    db.session.commit()
+    return [make_note(f'排放筆記 {index}', f'第 {index} 篇的內容，談範疇三排放。',
+                      category.id if index % 2 else other.id, tags=[f'標籤{index % 3}', '排放'])
+            for index in range(12)]
+
+
+def test_listings_stay_within_the_query_limit(client, notes, category):
+    # QUERY_COUNT_RAISE turns an N+1 regression into an exception here
+    for url in ('/', f'/category/{category.name}', '/tag/排放', '/search?q=排放'):
+        response = client.get(url)
+        assert response.status_code == 200, url
+        assert '排放筆記' in response.text, url
+
+
+def test_next_page_of_the_index(client, notes):
+    response = client.get('/', headers={'X-Requested-With': 'XMLHttpRequest'})
+    assert response.status_code == 200
+
+
+def test_view_note(client, admin_client, notes):
+    note = notes[0]
+    response = client.get(f'/notes/{note.id}')
+    assert response.status_code == 200
+    assert note.title in response.text
+
+    assert client.get(f'/notes/{note.id}', headers={'If-None-Match': response.headers['ETag']}).status_code == 304
+    assert client.get('/notes/9999').status_code == 404
+
+
+def test_search_suggest(client, notes):
+    response = client.get('/search/suggest?q=排放筆記')
+    assert response.status_code == 200
+    assert len(response.json['notes']) == 8
+
+
+def test_query_guard_raises_on_n_plus_one(app, client, notes):
+    @app.route('/test/n-plus-one')
+    def n_plus_one():
+        return str(sum(len(note.tag_objects) for note in LearningNote.query.all()))
+
+    with pytest.raises(QueryCountExceeded):
+        client.get('/test/n-plus-one')
+
+
+def test_delete_note(admin_client, make_note):
+    note = make_note('範疇三排放計算', '價值鏈的間接排放。', tags=['範疇三'])
+    note_id = note.id
+
+    response = admin_client.post(f'/notes/{note_id}/delete')
+
+    assert response.status_code == 302
+    assert db.session.get(LearningNote, note_id) is None
+    assert admin_client.get(f'/notes/{note_id}').status_code == 404
+
+
+def test_delete_needs_post(admin_client, make_note):
+    note = make_note('範疇三排放計算', '價值鏈的間接排放。')
+    assert admin_client.get(f'/notes/{note.id}/delete').status_code == 405
+    assert db.session.get(LearningNote, note.id) is not None
+
+
+def test_metrics_are_private_unless_configured(app, client):
+    app.config['METRICS_PUBLIC'] = False
+    assert client.get('/metrics').status_code == 403
+
+    app.config['METRICS_TOKEN'] = 'secret'
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'}).status_code == 200
+    assert client.get('/metrics', headers={'Authorization': 'Bearer wrong'}).status_code == 403
+
+
+def test_metrics_for_admins(app, admin_client):
+    app.config['METRICS_PUBLIC'] = False
+    response = admin_client.get('/metrics')
+    assert response.status_code == 200
+    assert response.mimetype == 'text/plain'
+
+
+def cached(content):
+    return render_cache.key(content) in render_cache.memory._data
+
+
+def test_edit_keeps_a_rendering_other_notes_share(admin_client, make_note, category):
+    template = '## 範本\n\n共用的內容。'
+    note = make_note('範本一', template)
+    make_note('範本二', template)
+    render_cache.render(template)
+
+    response = admin_client.post(f'/notes/{note.id}/edit', data={
+        'title': note.title, 'category_id': category.id, 'content': '改寫後的內容。', 'tags': ''})
+
+    assert response.status_code == 302
+    assert cached(template)
+
+
+def test_edit_frees_a_rendering_no_other_note_uses(admin_client, make_note, category):
+    body = '## 只有一篇\n\n獨有的內容。'
+    note = make_note('獨有', body)
+    render_cache.render(body)
+
+    admin_client.post(f'/notes/{note.id}/edit', data={
+        'title': note.title, 'category_id': category.id, 'content': '改寫後的內容。', 'tags': ''})
+
+    assert not cached(body)
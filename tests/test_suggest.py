@@ -0,0 +1,70 @@
+import pytest
+
+from app import db
+from app.caching import bump_version
+from app.suggest import SuggestIndex, suggest_index
+
+
+@pytest.fixture
+def index(app):
+    # Only writes of this process may change the index during a test
+    app.config['SUGGEST_CHECK_INTERVAL'] = 3600
+    return suggest_index
+
+
+def titles(index, query):
+    return [entry.label for entry in index.suggest(query)['notes']]
+
+
+def test_commits_update_the_index_in_place(index, make_note):
+    make_note('範疇三排放計算', '價值鏈的間接排放。')
+    assert titles(index, '排放') == ['範疇三排放計算']
+    builds, updates = index.builds, index.updates
+
+    note = make_note('Scope 3 emissions', 'Value chain emissions.')
+    assert titles(index, 'scope') == ['Scope 3 emissions']
+
+    note.title = 'Scope three emissions'
+    db.session.commit()
+    assert titles(index, 'scope 3') == []
+    assert titles(index, 'scope three') == ['Scope three emissions']
+
+    db.session.delete(note)
+    db.session.commit()
+    assert titles(index, 'scope') == []
+    assert (index.builds, index.updates) == (builds, updates + 3)
+
+
+def test_tags_and_categories_are_suggested(index, make_note, category):
+    make_note('運輸排放', '運輸的排放係數。', tags=['運輸'])
+    results = index.suggest('運')
+    assert [entry.label for entry in results['tags']] == ['運輸']
+    assert [entry.label for entry in index.suggest('範疇')['categories']] == [category.name]
+
+
+def test_write_by_another_process_triggers_a_rebuild(index, make_note):
+    make_note('範疇三排放計算', '價值鏈的間接排放。')
+    assert titles(index, '排放') == ['範疇三排放計算']
+    builds = index.builds
+
+    # Another worker commits between our lookup and our next write
+    with db.engine.begin() as connection:
+        bump_version(SuggestIndex.VERSION_NAME, connection)
+    make_note('運輸排放係數', '運輸的排放係數。')
+
+    assert index.stats()['version'] is None
+    assert sorted(titles(index, '排放')) == ['範疇三排放計算', '運輸排放係數']
+    assert index.builds == builds + 1
+
+
+def test_stale_index_still_answers_lookups_in_flight(index, make_note, monkeypatch):
+    make_note('範疇三排放計算', '價值鏈的間接排放。')
+    assert titles(index, '排放') == ['範疇三排放計算']
+
+    with db.engine.begin() as connection:
+        bump_version(SuggestIndex.VERSION_NAME, connection)
+    make_note('運輸排放係數', '運輸的排放係數。')
+
+    # A lookup that passed _refresh() before the index went stale
+    monkeypatch.setattr(index, '_refresh', lambda: None)
+    assert titles(index, '排放') == ['範疇三排放計算']
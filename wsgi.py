@@ -0,0 +1,10 @@
+"""
+WSGI entry point for production servers, e.g. `gunicorn -c gunicorn.conf.py wsgi:app`.
+
+Creating the app does no database setup; run `flask init_db` once per
+deployment (gunicorn.conf.py does it in the master process).
+"""
+import os
+from app import create_app
+
+app = create_app(os.getenv('FLASK_CONFIG') or 'production')